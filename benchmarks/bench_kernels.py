@@ -0,0 +1,315 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Benchmarks the spectral analysis kernels.
+
+Synthetic Fourier-transformed ECEI data is generated for a range of shapes. Each kernel
+is timed for a number of channel pairs, split into batches that are executed on a
+thread pool, like the processor does. Throughput is reported in channel pairs per
+second and as the bandwidth of the input data read by the kernels, in GB/s.
+
+Backends that can't be imported are skipped:
+* numpy  - analysis/kernels_spectral.py
+* cython - analysis/kernels_spectral_cy, build with `python setup.py build_ext --inplace`
+* cupy   - analysis/kernels_spectral_cu.py
+* numba  - analysis/kernels_spectral_gpu.py, needs a CUDA device
+
+Note that the Cython kernels parallelize over channel pairs with OpenMP. Set OMP_NUM_THREADS
+to control the number of OpenMP threads per kernel call.
+
+Run from the repository root:
+
+    python benchmarks/bench_kernels.py --nfft 256 512 1024 --nbins 10 40 --output base.json
+    python benchmarks/bench_kernels.py --nfft 256 512 1024 --nbins 10 40 --compare base.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Modules of delta/ are imported relative to delta/, which needs to be on the path first.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "delta"))
+
+from data_models.kstar_ecei import ecei_chunk_ft  # noqa: E402
+from data_models.timebase import timebase_streaming  # noqa: E402
+from data_models.helpers import get_dispatch_sequence  # noqa: E402
+
+
+def gen_fft_data(nfft, nbins, num_channels=192, dtype=np.complex128, seed=0):
+    """Generates a synthetic Fourier-transformed time chunk.
+
+    Args:
+        nfft (int):
+            Number of Fourier coefficients
+        nbins (int):
+            Number of STFT bins
+        num_channels (int):
+            Number of channels. Defaults to 192, the size of a KSTAR ECEI device.
+        dtype (dtype):
+            Complex data type
+        seed (int):
+            Seed of the random number generator
+
+    Returns:
+        fft_chunk (ecei_chunk_ft):
+            Chunk with random Fourier coefficients
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((num_channels, nfft, nbins)) + \
+        1j * rng.standard_normal((num_channels, nfft, nbins))
+    tb = timebase_streaming(0.0, 1.0, 5e5, nfft * nbins, 0)
+    return ecei_chunk_ft(data.astype(dtype), tb, np.fft.fftfreq(nfft, 2e-6),
+                         params={"win_factor": 1.0})
+
+
+def get_kernels_numpy(float32):
+    """Returns the numpy kernels. They work on both precisions."""
+    from analysis import kernels_spectral
+    return {f"numpy.{name}": getattr(kernels_spectral, f"kernel_{name}")
+            for name in ["coherence", "crosspower", "crossphase", "crosscorr"]}
+
+
+def get_kernels_cython(float32):
+    """Returns the Cython kernels for the precision of the input data."""
+    from analysis import kernels_spectral_cy
+    suffix = "32_cy" if float32 else "64_cy"
+    return {f"cython.{name}": getattr(kernels_spectral_cy, f"kernel_{name}_{suffix}")
+            for name in ["coherence", "crosspower", "crossphase"]}
+
+
+def get_kernels_cupy(float32):
+    """Returns the cupy kernels. They work on both precisions."""
+    from analysis import kernels_spectral_cu
+    return {f"cupy.{name}": getattr(kernels_spectral_cu, f"kernel_{name}_cu")
+            for name in ["coherence", "crosspower", "crossphase"]}
+
+
+def get_kernels_numba(float32):
+    """Returns the fused numba kernel if a CUDA device is available."""
+    from numba import cuda
+    if not cuda.is_available():
+        return {}
+    return {"numba.spectral_GAP": kernel_spectral_GAP_numba}
+
+
+def get_backends(float32=False):
+    """Returns the kernels of all backends that can be imported.
+
+    Args:
+        float32 (bool):
+            If True, returns kernels for complex64 input data. Otherwise for complex128.
+
+    Returns:
+        backends (dict):
+            Keys are f.ex. numpy.coherence, values are kernels with the interface
+            kernel(fft_data, ch_it, fft_config).
+    """
+    backends = {}
+    for get_kernels in [get_kernels_numpy, get_kernels_cython, get_kernels_cupy,
+                        get_kernels_numba]:
+        try:
+            backends.update(get_kernels(float32))
+        except ImportError:
+            pass
+    return backends
+
+
+def kernel_spectral_GAP_numba(fft_data, ch_it, fft_config):
+    """Launches the fused numba kernel, as in analysis.task_spectral_numba.calc_and_store_numba."""
+    import math
+    from analysis.kernels_spectral_gpu import kernel_spectral_GAP
+    result = np.zeros([len(ch_it), fft_data.shape[1], 3], dtype=fft_data.dtype)
+    threads_per_block = (32, 32)
+    num_blocks = [math.ceil(s / t) for s, t in zip(result.shape, threads_per_block)]
+    ch1_idx_arr = np.array([c.ch1.get_idx() for c in ch_it])
+    ch2_idx_arr = np.array([c.ch2.get_idx() for c in ch_it])
+    kernel_spectral_GAP[num_blocks, threads_per_block](np.ascontiguousarray(fft_data), result,
+                                                       ch1_idx_arr, ch2_idx_arr, 1.0)
+    return result
+
+
+def get_batches(num_pairs, batch_size):
+    """Returns the first num_pairs unique channel pairs of an ECEI device, in batches.
+
+    Args:
+        num_pairs (int):
+            Number of channel pairs
+        batch_size (int):
+            Number of channel pairs per batch, as channel_chunk_size in the analysis section
+
+    Returns:
+        batches (list of list of channel_pair)
+    """
+    dispatch_seq = get_dispatch_sequence([1, 1, 24, 8], [1, 1, 24, 8], batch_size)
+    pairs = list(itertools.islice(itertools.chain(*dispatch_seq), num_pairs))
+    return [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+
+
+def time_kernel(kernel, fft_chunk, batches, executor, repeat=3):
+    """Times a kernel on all batches.
+
+    Args:
+        kernel (callable):
+            Analysis kernel
+        fft_chunk (ecei_chunk_ft):
+            Input data
+        batches (list of list of channel_pair):
+            Channel pairs, each batch is a single kernel call
+        executor (ThreadPoolExecutor):
+            Executor on which the batches are executed
+        repeat (int):
+            Number of repetitions. The fastest one is reported.
+
+    Returns:
+        t_best (float):
+            Time for all batches, in seconds
+    """
+    t_best = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        futures = [executor.submit(kernel, fft_chunk.data, batch, fft_chunk.params)
+                   for batch in batches]
+        for fut in futures:
+            fut.result()
+        t_best = min(t_best, time.perf_counter() - tic)
+    return t_best
+
+
+def run_benchmarks(nfft_list, nbins_list, pairs_list, threads_list, batch_size=512, repeat=3,
+                   backends=None, dtype=np.complex128):
+    """Runs all combinations of shapes, pair counts and thread counts.
+
+    Args:
+        nfft_list (list of int):
+            Number of Fourier coefficients
+        nbins_list (list of int):
+            Number of STFT bins
+        pairs_list (list of int):
+            Number of channel pairs
+        threads_list (list of int):
+            Number of threads that execute batches concurrently
+        batch_size (int):
+            Number of channel pairs per kernel call
+        repeat (int):
+            Number of repetitions of each benchmark
+        backends (dict):
+            Kernels to benchmark, see get_backends. Defaults to all available kernels.
+        dtype (dtype):
+            Complex data type of the input data
+
+    Returns:
+        results (list of dict):
+            One item for each benchmark
+    """
+    if backends is None:
+        backends = get_backends()
+    results = []
+    for nfft, nbins in itertools.product(nfft_list, nbins_list):
+        fft_chunk = gen_fft_data(nfft, nbins, dtype=dtype)
+        for num_pairs, num_threads in itertools.product(pairs_list, threads_list):
+            batches = get_batches(num_pairs, batch_size)
+            num_pairs = sum([len(batch) for batch in batches])
+            # Each pair reads the coefficients of two channels
+            bytes_read = num_pairs * 2 * nfft * nbins * fft_chunk.data.itemsize
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                for name, kernel in backends.items():
+                    t_best = time_kernel(kernel, fft_chunk, batches, executor, repeat)
+                    results.append({"kernel": name, "nfft": nfft, "nbins": nbins,
+                                    "num_pairs": num_pairs, "num_threads": num_threads,
+                                    "time": t_best,
+                                    "pairs_per_sec": num_pairs / t_best,
+                                    "GB_per_sec": bytes_read / t_best / 1e9})
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Finds benchmarks whose throughput dropped compared to a baseline.
+
+    Args:
+        results (list of dict):
+            Results of the current run, see run_benchmarks
+        baseline (list of dict):
+            Results of a previous run
+        tolerance (float):
+            Relative drop in throughput that is reported as a regression
+
+    Returns:
+        regressions (list of tuple):
+            (result, baseline result) for each regression
+    """
+    def key(res):
+        return (res["kernel"], res["nfft"], res["nbins"], res["num_pairs"], res["num_threads"])
+
+    baseline_dict = {key(res): res for res in baseline}
+    regressions = []
+    for res in results:
+        base = baseline_dict.get(key(res))
+        if base is not None and res["pairs_per_sec"] < (1.0 - tolerance) * base["pairs_per_sec"]:
+            regressions.append((res, base))
+    return regressions
+
+
+def main():
+    """Runs the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmarks spectral analysis kernels.")
+    parser.add_argument("--nfft", type=int, nargs="+", default=[256, 512, 1024],
+                        help="Number of Fourier coefficients")
+    parser.add_argument("--nbins", type=int, nargs="+", default=[10, 40],
+                        help="Number of STFT bins")
+    parser.add_argument("--pairs", type=int, nargs="+", default=[512, 4096],
+                        help="Number of channel pairs")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4],
+                        help="Number of threads that execute batches concurrently")
+    parser.add_argument("--batch_size", type=int, default=512,
+                        help="Number of channel pairs per kernel call")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of each benchmark")
+    parser.add_argument("--float32", action="store_true", help="Use complex64 input data")
+    parser.add_argument("--kernels", type=str, nargs="+", default=None,
+                        help="Benchmark only these kernels, f.ex. numpy.coherence")
+    parser.add_argument("--output", type=str, default=None, help="Store results as json")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="Report regressions against results stored with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative drop in throughput that counts as a regression")
+    args = parser.parse_args()
+
+    backends = get_backends(args.float32)
+    if args.kernels is not None:
+        backends = {name: kernel for name, kernel in backends.items() if name in args.kernels}
+    print(f"Benchmarking kernels: {list(backends.keys())}")
+
+    results = run_benchmarks(args.nfft, args.nbins, args.pairs, args.threads, args.batch_size,
+                             args.repeat, backends,
+                             np.complex64 if args.float32 else np.complex128)
+    print(f"{'kernel':>22s} {'nfft':>5s} {'nbins':>5s} {'pairs':>6s} {'thr':>3s} "
+          f"{'time [s]':>9s} {'pairs/s':>10s} {'GB/s':>7s}")
+    for res in results:
+        print(f"{res['kernel']:>22s} {res['nfft']:5d} {res['nbins']:5d} {res['num_pairs']:6d} "
+              f"{res['num_threads']:3d} {res['time']:9.4f} {res['pairs_per_sec']:10.1f} "
+              f"{res['GB_per_sec']:7.3f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as df:
+            json.dump(results, df, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as df:
+            baseline = json.load(df)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for res, base in regressions:
+            print(f"Regression: {res['kernel']} nfft={res['nfft']} nbins={res['nbins']} "
+                  f"pairs={res['num_pairs']} threads={res['num_threads']}: "
+                  f"{res['pairs_per_sec']:.1f} pairs/s, baseline {base['pairs_per_sec']:.1f}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# End of file bench_kernels.py
@@ -0,0 +1,270 @@
+# -*- Encoding: UTF-8 -*-
+
+r"""Benchmarks the throughput of the processing pipeline on a single machine.
+
+A synthetic ECEI HDF5 file is staged once into an ADIOS2 BP4 file with generator.py.
+The BP4 file stands in for the SST stream from KSTAR. processor.py then reads the file
+for each combination of the swept parameters:
+
+* --num_queue_threads
+* --num_ranks_preprocess
+* --num_ranks_analysis
+* channel_chunk_size of all analysis tasks
+
+Each processor run records traces, see streaming/tracing.py. From these, the number of
+chunks per second and the latency of each pipeline stage are calculated.
+
+Run from the repository root:
+
+    python benchmarks/bench_pipeline.py --workdir /tmp/delta_bench \
+        --num_queue_threads 1 4 --num_ranks_analysis 2 4 --channel_chunk_size 512 4096 \
+        --output pipeline.json
+
+The processor is started with --launcher. The default uses mpirun and mpi4py.futures,
+which requires num_ranks_analysis + 1 MPI slots.
+"""
+
+import argparse
+import copy
+import glob
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Modules of delta/ are imported relative to delta/, which needs to be on the path first.
+delta_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "delta")
+sys.path.append(delta_dir)
+
+from streaming.tracing import load_trace, chunk_latencies  # noqa: E402
+
+
+def write_synthetic_ecei(fname, num_samples, dev="L", seed=0):
+    """Writes a synthetic ECEI HDF5 file, using the layout of KSTAR ECEI files.
+
+    Each channel contains a few sine waves with random phases and noise.
+
+    Args:
+        fname (str):
+            Name of the HDF5 file. Needs to contain the device, f.ex. ECEI.012345.L.h5
+        num_samples (int):
+            Number of samples per channel
+        dev (str):
+            Name of the device
+        seed (int):
+            Seed of the random number generator
+
+    Returns:
+        None
+    """
+    import h5py
+
+    rng = np.random.default_rng(seed)
+    # Sampling at 500 kHz. The trigger time is chosen so that t_norm = [-0.099, -0.089]
+    # is included in the first time chunk
+    trg = -0.1 + np.arange(num_samples) * 2e-6
+    with h5py.File(fname, "w") as df:
+        grp = df.create_group("ECEI")
+        grp.attrs["SampleRate"] = np.array([500.0])
+        grp.attrs["TriggerTime"] = np.array([-0.1, -0.1 + num_samples * 2e-6, 60.0])
+        grp.attrs["TFcurrent"] = 18.0
+        grp.attrs["Mode"] = b"X"
+        grp.attrs["LoFreq"] = 79.5
+        grp.attrs["LensFocus"] = 503
+        grp.attrs["LensZoom"] = 200
+        for ch_v in range(1, 25):
+            for ch_h in range(1, 9):
+                signal = 10000.0 + rng.standard_normal(num_samples) * 100.0
+                for freq in [5e3, 1.2e4, 3e4]:
+                    signal += 500.0 * np.sin(2.0 * np.pi * freq * trg + rng.uniform(0, 2 * np.pi))
+                grp.create_dataset(f"ECEI_{dev}{ch_v:02d}{ch_h:02d}/Voltage",
+                                   data=signal.astype(np.int32), chunks=(min(num_samples, 10000), ))
+
+
+def make_config(workdir, num_chunks, chunk_size, analysis, channel_chunk_size, trace_dir=None):
+    """Generates the Delta configuration used by generator and processor.
+
+    Args:
+        workdir (str):
+            Directory that holds the HDF5 file and the BP4 file
+        num_chunks (int):
+            Number of time chunks
+        chunk_size (int):
+            Number of samples per chunk
+        analysis (list of str):
+            Names of the analysis tasks, f.ex. ["coherence", "crosspower"]
+        channel_chunk_size (int):
+            Number of channel pairs per analysis task
+        trace_dir (str):
+            If not None, tracing is enabled and trace files are written here.
+
+    Returns:
+        cfg (dict)
+    """
+    transport = {"engine": "BP4", "params": {"OpenTimeoutSecs": "10.0"}}
+    cfg = {"diagnostic": {"name": "kstarecei",
+                          "shotnr": 1,
+                          "dev": "L",
+                          "datasource": {"source_file": os.path.join(workdir, "ECEI.000001.L.h5"),
+                                         "chunk_size": chunk_size,
+                                         "num_chunks": num_chunks,
+                                         "channel_range": ["L0101-2408"],
+                                         "datatype": "float",
+                                         "t_norm": [-0.099, -0.089]}},
+           "transport_tx": copy.deepcopy(transport),
+           "transport_rx": copy.deepcopy(transport),
+           "storage": {"backend": "null"},
+           "preprocess": {"bandpass_fir": {"N": 5, "Wn": [0.02, 0.036], "btype": "bandpass",
+                                           "output": "sos"},
+                          "stft": {"nfft": 512, "fs": 500000, "window": "hann",
+                                   "overlap": 0.5, "noverlap": 256, "detrend": "constant",
+                                   "full": True}},
+           "analysis": {name: {"channel_chunk_size": channel_chunk_size,
+                               "ref_channels": [1, 1, 24, 8],
+                               "cmp_channels": [1, 1, 24, 8]} for name in analysis}}
+    if trace_dir is not None:
+        cfg["tracing"] = {"enabled": True, "dir": trace_dir}
+    return cfg
+
+
+def run_script(cmd, workdir, timeout):
+    """Runs a delta script in workdir and returns the wall-clock time.
+
+    Raises:
+        subprocess.CalledProcessError:
+            If the script fails
+    """
+    tic = time.perf_counter()
+    subprocess.run(cmd, cwd=workdir, check=True, timeout=timeout,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return time.perf_counter() - tic
+
+
+def summarize_traces(trace_dir):
+    """Calculates throughput and per-stage latency from the traces of a processor run.
+
+    Args:
+        trace_dir (str):
+            Directory with the trace files of a run
+
+    Returns:
+        summary (dict):
+            * num_chunks - Number of chunks seen in the traces
+            * chunks_per_sec - Chunks processed per second, from the start of the first
+              span to the end of the last span
+            * latency - Median and maximum time from receiving a chunk until its last span
+              ends, in seconds
+            * stages - For each span name: count, mean, median and 95th percentile of the
+              duration, in seconds
+    """
+    events = []
+    for fname in glob.glob(os.path.join(trace_dir, "trace_*.json")):
+        events += [event for event in load_trace(fname) if event.get("ph") == "X"]
+    if len(events) == 0:
+        return {"num_chunks": 0, "chunks_per_sec": 0.0, "latency": {}, "stages": {}}
+
+    t_start = min([event["ts"] for event in events])
+    t_end = max([event["ts"] + event["dur"] for event in events])
+    latencies = np.array([lat for lat, _ in chunk_latencies(events).values()])
+
+    stages = {}
+    for name in sorted(set([event["name"] for event in events])):
+        dur = np.array([event["dur"] for event in events if event["name"] == name]) * 1e-6
+        stages[name] = {"count": int(dur.size), "mean": dur.mean(),
+                        "median": np.median(dur), "p95": np.percentile(dur, 95)}
+
+    return {"num_chunks": int(latencies.size),
+            "chunks_per_sec": latencies.size / ((t_end - t_start) * 1e-6),
+            "latency": {"median": np.median(latencies), "max": latencies.max()},
+            "stages": stages}
+
+
+def main():
+    """Stages the stream and runs the parameter sweep."""
+    parser = argparse.ArgumentParser(description="Benchmarks the Delta processing pipeline.")
+    parser.add_argument("--workdir", type=str, required=True,
+                        help="Directory for the staged data, configurations, and traces")
+    parser.add_argument("--num_chunks", type=int, default=20, help="Number of time chunks")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Samples per time chunk")
+    parser.add_argument("--analysis", type=str, nargs="+", default=["coherence", "crosspower"],
+                        help="Analysis tasks to run")
+    parser.add_argument("--num_queue_threads", type=int, nargs="+", default=[4])
+    parser.add_argument("--num_ranks_preprocess", type=int, nargs="+", default=[4])
+    parser.add_argument("--num_ranks_analysis", type=int, nargs="+", default=[4])
+    parser.add_argument("--channel_chunk_size", type=int, nargs="+", default=[32768])
+    parser.add_argument("--launcher", type=str,
+                        default="mpirun -n {num_procs} {python} -m mpi4py.futures",
+                        help="Command that starts processor.py. {num_procs} is replaced by " +
+                        "num_ranks_analysis + 1, {python} by the python interpreter.")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="Time-out for a single processor run, in seconds")
+    parser.add_argument("--output", type=str, default=None, help="Store results as json")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    # The scripts load configs/logger.yaml relative to their working directory
+    if not os.path.exists(os.path.join(workdir, "configs")):
+        os.symlink(os.path.abspath(os.path.join(delta_dir, "configs")),
+                   os.path.join(workdir, "configs"))
+
+    # Stage the synthetic data into a BP4 file
+    cfg = make_config(workdir, args.num_chunks, args.chunk_size, args.analysis,
+                      args.channel_chunk_size[0])
+    write_synthetic_ecei(cfg["diagnostic"]["datasource"]["source_file"],
+                         args.num_chunks * args.chunk_size)
+    with open(os.path.join(workdir, "config_generator.json"), "w") as df:
+        json.dump(cfg, df)
+    dt = run_script([sys.executable, os.path.join(delta_dir, "generator.py"),
+                     "--config", "config_generator.json", "--slow", "0.0"],
+                    workdir, args.timeout)
+    print(f"Staged {args.num_chunks} chunks in {dt:6.2f}s")
+
+    results = []
+    sweep = itertools.product(args.num_queue_threads, args.num_ranks_preprocess,
+                              args.num_ranks_analysis, args.channel_chunk_size)
+    for run_idx, (nthreads, nrank_pre, nrank_anl, ch_chunk_size) in enumerate(sweep):
+        trace_dir = os.path.join(workdir, f"traces_{run_idx:03d}")
+        cfg = make_config(workdir, args.num_chunks, args.chunk_size, args.analysis,
+                          ch_chunk_size, trace_dir)
+        cfg_name = f"config_processor_{run_idx:03d}.json"
+        with open(os.path.join(workdir, cfg_name), "w") as df:
+            json.dump(cfg, df)
+
+        launcher = args.launcher.format(num_procs=nrank_anl + 1, python=sys.executable)
+        cmd = shlex.split(launcher) + [os.path.join(delta_dir, "processor.py"),
+                                       "--config", cfg_name,
+                                       "--num_queue_threads", str(nthreads),
+                                       "--num_ranks_preprocess", str(nrank_pre),
+                                       "--num_ranks_analysis", str(nrank_anl),
+                                       "--run_id", f"bench_{run_idx:03d}"]
+        params = {"num_queue_threads": nthreads, "num_ranks_preprocess": nrank_pre,
+                  "num_ranks_analysis": nrank_anl, "channel_chunk_size": ch_chunk_size}
+        try:
+            wall_time = run_script(cmd, workdir, args.timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            print(f"Run {run_idx} {params} failed: {e}")
+            continue
+
+        summary = summarize_traces(trace_dir)
+        results.append({**params, "wall_time": wall_time, **summary})
+        print(f"Run {run_idx:3d} {params}: {summary['chunks_per_sec']:6.2f} chunks/s, " +
+              f"median latency {summary['latency'].get('median', np.nan):7.3f}s")
+        for name, stage in summary["stages"].items():
+            print(f"    {name:>24s}: {stage['count']:5d} spans, mean {stage['mean']:8.4f}s, " +
+                  f"p95 {stage['p95']:8.4f}s")
+
+    if args.output is not None:
+        with open(args.output, "w") as df:
+            json.dump(results, df, indent=1)
+
+
+if __name__ == "__main__":
+    main()
+
+# End of file bench_pipeline.py
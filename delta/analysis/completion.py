@@ -0,0 +1,208 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Tracks the completion of analysis tasks for each time chunk.
+
+Analysis tasks return the futures of all batches they launch. The processor adds the
+futures of a time chunk to a chunk_tracker. Once all futures of the chunk are done,
+the tracker records whether the chunk was analyzed successfully and how long it took,
+and calls the registered callbacks.
+
+A deadline can be configured in the `completion` section of the configuration:
+
+.. code-block::
+
+    "completion": {"deadline": 30.0}
+
+Batches of a chunk that have not started when the deadline passes are cancelled.
+Batches that are already running can't be cancelled and are waited for.
+"""
+
+import logging
+import threading
+import time
+
+from streaming.stream_stats import metric
+
+
+class chunk_tracker():
+    """Tracks the futures of all time chunks that are being analyzed."""
+
+    def __init__(self, cfg=None):
+        """Initializes the tracker.
+
+        Args:
+            cfg (dict):
+                Completion section of the configuration. Optional.
+
+        Returns:
+            None
+
+        Used keys from cfg:
+            * deadline - Seconds after submission after which pending batches of a
+              chunk are cancelled. Optional, defaults to no deadline.
+            * capacity - Number of recent chunk durations kept for statistics.
+              Optional, defaults to 4096.
+        """
+        if cfg is None:
+            cfg = {}
+        self.logger = logging.getLogger("simple")
+        self.deadline = cfg.get("deadline", None)
+        # Records of chunks in flight, keyed by (stream_idx, chunk_idx)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        # Notified when a chunk completes
+        self.cond = threading.Condition(self.lock)
+        self.callbacks = []
+
+        # Statistics of completed chunks
+        self.num_ok = 0
+        self.num_failed = 0
+        self.num_expired = 0
+        self.durations = metric(cfg.get("capacity", 4096), 1e-4, 1e5)
+
+    def add_callback(self, fn):
+        """Adds a function that is called with the record of each completed chunk.
+
+        Callbacks are executed by the thread that completes the last future of a chunk.
+        See _complete for the keys of the record.
+        """
+        self.callbacks.append(fn)
+
+    def add_chunk(self, chunk_idx, futures, stream_idx=0):
+        """Starts tracking the futures of a time chunk.
+
+        Args:
+            chunk_idx (int):
+                Index of the time chunk
+            futures (list of Future):
+                Futures of all analysis batches of the chunk
+            stream_idx (int):
+                Index of the stream the chunk was received on
+
+        Returns:
+            None
+        """
+        key = (stream_idx, chunk_idx)
+        record = {"chunk_idx": chunk_idx, "stream_idx": stream_idx,
+                  "num_tasks": len(futures), "num_pending": len(futures),
+                  "num_failed": 0, "num_cancelled": 0, "errors": [],
+                  "t_submit": time.time(), "expired": False, "timer": None}
+        with self.lock:
+            self.in_flight[key] = record
+        if len(futures) == 0:
+            self._complete(key)
+            return
+
+        if self.deadline is not None:
+            record["timer"] = threading.Timer(self.deadline, self._expire, args=(key, futures))
+            record["timer"].daemon = True
+            record["timer"].start()
+
+        # Callbacks of futures that are already done are executed right away.
+        for future in futures:
+            future.add_done_callback(lambda fut, key=key: self._on_done(key, fut))
+
+    def _on_done(self, key, future):
+        """Updates the record of a chunk when one of its futures is done."""
+        with self.lock:
+            record = self.in_flight[key]
+            record["num_pending"] -= 1
+            if future.cancelled():
+                record["num_cancelled"] += 1
+            elif future.exception() is not None:
+                record["num_failed"] += 1
+                record["errors"].append(repr(future.exception()))
+            is_complete = record["num_pending"] == 0
+        if is_complete:
+            self._complete(key)
+
+    def _expire(self, key, futures):
+        """Cancels the batches of a chunk that have not started at the deadline."""
+        with self.lock:
+            if key not in self.in_flight:
+                return
+            self.in_flight[key]["expired"] = True
+        num_cancelled = sum([future.cancel() for future in futures])
+        self.logger.warning(f"chunk_tracker: Chunk {key[1]} of stream {key[0]} missed its " +
+                            f"deadline of {self.deadline}s. Cancelled {num_cancelled} batches.")
+
+    def _complete(self, key):
+        """Records a completed chunk and calls the callbacks.
+
+        The record passed to callbacks has the keys
+        chunk_idx, stream_idx, num_tasks, num_failed, num_cancelled, errors, t_submit, and
+
+        * duration - Time from add_chunk until the last future was done, in seconds
+        * status - 'ok', 'failed' if a batch raised an exception, or 'expired' if the
+          deadline passed before all batches were done.
+        """
+        with self.lock:
+            record = self.in_flight.pop(key)
+            record["duration"] = time.time() - record["t_submit"]
+            if record["num_failed"] > 0:
+                record["status"] = "failed"
+                self.num_failed += 1
+            elif record["expired"]:
+                record["status"] = "expired"
+                self.num_expired += 1
+            else:
+                record["status"] = "ok"
+                self.num_ok += 1
+            self.durations.add(record["duration"])
+            self.cond.notify_all()
+        if record["timer"] is not None:
+            record["timer"].cancel()
+        del record["num_pending"], record["expired"], record["timer"]
+
+        if record["status"] == "failed":
+            self.logger.error(f"chunk_tracker: Chunk {record['chunk_idx']} of stream " +
+                              f"{record['stream_idx']}: {record['num_failed']} of " +
+                              f"{record['num_tasks']} batches failed: {record['errors'][:3]}")
+        for fn in self.callbacks:
+            fn(record)
+
+    def num_in_flight(self):
+        """Returns the number of chunks whose analysis is not complete."""
+        with self.lock:
+            return len(self.in_flight)
+
+    def wait(self, max_in_flight=0, timeout=None):
+        """Waits until at most max_in_flight chunks are in flight.
+
+        Args:
+            max_in_flight (int):
+                Number of chunks that may remain in flight
+            timeout (float):
+                Maximum time to wait, in seconds. Defaults to no time-out.
+
+        Returns:
+            success (bool):
+                False if the time-out expired
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.in_flight) <= max_in_flight, timeout)
+
+    def to_dict(self):
+        """Returns chunk counts and duration statistics as a dictionary.
+
+        Counts are given for completed, failed, expired and in-flight chunks.
+        """
+        with self.lock:
+            return {"num_ok": self.num_ok, "num_failed": self.num_failed,
+                    "num_expired": self.num_expired, "num_in_flight": len(self.in_flight),
+                    "duration": self.durations.summary()}
+
+    def summary(self):
+        """Returns a human-readable summary."""
+        stats = self.to_dict()
+        du = stats["duration"]
+        stats_str = "Chunk completion:\n"
+        stats_str += f"    ok/failed/expired/in flight: {stats['num_ok']}/{stats['num_failed']}/" \
+                     f"{stats['num_expired']}/{stats['num_in_flight']}\n"
+        if du["count"] > 0:
+            stats_str += f"    duration p50/p95/p99 (sec): {du['p50']:.3e} {du['p95']:.3e} " \
+                         f"{du['p99']:.3e}, max {du['max']:.3e}\n"
+        return stats_str
+
+
+# End of file completion.py
@@ -0,0 +1,172 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Runs pre-processing and analysis of a time chunk on the same worker.
+
+By default, the processor pre-processes a time chunk on-node and sends the Fourier
+coefficients to the analysis workers with every batch of channel pairs. For a KSTAR
+ECEI chunk, these are channels x nfft x bins complex128 numbers, several times the size
+of the raw data.
+
+In locality-aware mode, each analysis worker receives the raw time chunk once, together
+with its share of the batches of all analysis tasks. The worker runs the pre-processing
+pipeline itself and computes its batches on the local Fourier coefficients. Only the
+results leave the worker. Each worker repeats the pre-processing, which costs less than
+sending the Fourier coefficients over the network.
+
+The batches of a chunk are split into several shares per worker. The pool executor
+hands out shares as workers become free, and a failed share loses fewer batches. Each
+share repeats the pre-processing of the chunk though. Adaptive batching only sets the
+size of the batches within a share, see :py:mod:`analysis.scheduler`.
+
+Enable this mode by passing --locality to processor.py.
+"""
+
+import copy
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from preprocess.helpers import get_preprocess_routine
+from streaming.tracing import get_tracer
+
+
+# Pre-processing pipelines of this worker process, keyed by their configuration
+_local_pipelines = {}
+# Executor passed to the pre-processing routines on the worker
+_local_executor = None
+
+
+def get_local_pipeline(cfg_preprocess):
+    """Returns the pre-processing routines of this process for a configuration.
+
+    Routines are instantiated once per process and configuration.
+
+    Args:
+        cfg_preprocess (dict):
+            preprocess section of the configuration
+
+    Returns:
+        preprocess_list (list):
+            Pre-processing routines, see :py:func:`preprocess.helpers.get_preprocess_routine`
+    """
+    key = json.dumps(cfg_preprocess, sort_keys=True)
+    if key not in _local_pipelines:
+        # Routines may modify their parameters
+        cfg_preprocess = copy.deepcopy(cfg_preprocess)
+        _local_pipelines[key] = [get_preprocess_routine(name, params)
+                                 for name, params in cfg_preprocess.items()]
+    return _local_pipelines[key]
+
+
+def preprocess_and_analyze(cfg_preprocess, timechunk, work_items, trace_cfg=None):
+    """Pre-processes a time chunk and computes a share of its analysis batches.
+
+    Executed on an analysis worker.
+
+    Args:
+        cfg_preprocess (dict):
+            preprocess section of the configuration
+        timechunk (ecei_chunk):
+            Raw, normalized time chunk
+        work_items (list of tuple):
+            Batches to compute, see :py:meth:`analysis.task_base.task_base.get_work_items`
+        trace_cfg (dict):
+            Tracing configuration of the processor. Optional.
+
+    Returns:
+        results (list):
+            Return value of the dispatch function for each work item
+    """
+    global _local_executor
+    if _local_executor is None:
+        _local_executor = ThreadPoolExecutor(max_workers=1)
+
+    tracer = get_tracer(trace_cfg, "analysis")
+    chunk_idx = timechunk.tb.chunk_idx
+    # Routines may modify the chunk in-place. Thread workers share the chunk of the caller.
+    timechunk = copy.deepcopy(timechunk)
+    for item in get_local_pipeline(cfg_preprocess):
+        with tracer.span(type(item).__name__, chunk_idx):
+            timechunk = item.process(timechunk, _local_executor)
+
+    return [dispatch_func(kernel, storage_backend, timechunk, ch_it, info_dict, pair_idx,
+                          trace_cfg)
+            for dispatch_func, kernel, storage_backend, ch_it, info_dict, pair_idx in work_items]
+
+
+class locality_dispatcher():
+    """Launches pre-processing and analysis of a time chunk together on the workers."""
+
+    def __init__(self, executor, num_workers, cfg_preprocess, my_task_list, my_preprocessor,
+                 shares_per_worker=2):
+        """Initializes the dispatcher.
+
+        Args:
+            executor (PEP-3148 executor):
+                Executor of the analysis workers
+            num_workers (int):
+                Number of analysis workers
+            cfg_preprocess (dict):
+                preprocess section of the configuration. Pre-processing routines may
+                modify their parameters, so pass a copy taken before the preprocessor
+                is instantiated.
+            my_task_list (tasklist):
+                Analysis tasks to compute
+            my_preprocessor (preprocessor):
+                Pre-processor of the stream. Only used to store the chunk metadata.
+            shares_per_worker (int):
+                The batches of a chunk are split into num_workers * shares_per_worker shares.
+
+        Returns:
+            None
+        """
+        self.logger = logging.getLogger("simple")
+        self.executor = executor
+        self.cfg_preprocess = cfg_preprocess
+        self.task_list = my_task_list
+        self.preprocessor = my_preprocessor
+        self.num_shares = num_workers * shares_per_worker
+
+    def _on_done(self, tasks, future):
+        """Updates the cost estimates of the tasks. Errors are reported by the chunk tracker."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        for task, result in zip(tasks, future.result()):
+            task.update_cost(result)
+
+    def execute(self, timechunk):
+        """Sends the raw time chunk with each share of the batches to the workers.
+
+        Batches of all tasks are distributed round-robin, so that each share has
+        batches of each task.
+
+        Args:
+            timechunk (ecei_chunk):
+                Raw, normalized time chunk
+
+        Returns:
+            futures (list of Future):
+                One future for each share
+        """
+        self.preprocessor.store_metadata(timechunk)
+        tracer = get_tracer()
+        trace_cfg = tracer.cfg if tracer.enabled else None
+
+        items = []
+        for task in self.task_list.tasklist:
+            items += [(task, item) for item in task.get_work_items(timechunk, self.executor)]
+
+        futures = []
+        for share_idx in range(min(self.num_shares, len(items))):
+            share = items[share_idx::self.num_shares]
+            future = self.executor.submit(preprocess_and_analyze, self.cfg_preprocess, timechunk,
+                                          [item for _, item in share], trace_cfg)
+            future.add_done_callback(lambda fut, tasks=[task for task, _ in share]:
+                                     self._on_done(tasks, fut))
+            futures.append(future)
+        self.logger.info(f"chunk_idx={timechunk.tb.chunk_idx}: Submitted {len(items)} batches " +
+                         f"as {len(futures)} shares")
+        return futures
+
+
+# End of file locality.py
@@ -0,0 +1,241 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Distributes the pair matrix of an all-to-all analysis over a 2D grid of MPI ranks.
+
+With the pool executors, every analysis batch receives the Fourier coefficients of all
+channels. pair_grid instead arranges the ranks of a communicator in a q x q grid and
+splits the channels into q blocks. The rank in grid row i and grid column j computes
+channel pairs between block i and block j.
+
+Each rank holds the spectra of a 1/q^2 share of the channels, f.ex. by pre-processing
+only these channels of the time chunk. Like in SUMMA, the blocks are then exchanged
+with two collectives:
+
+1. The ranks of grid row i assemble block i with an allgather over the row communicator.
+2. The diagonal rank (j, j) broadcasts block j to the ranks of grid column j.
+
+A rank then holds the spectra of 2 blocks, 2/q of all channels, instead of all channels.
+Only unique pairs (ch1 <= ch2) are computed. The pairs of blocks (i, j) and (j, i) are
+split between ranks (i, j) and (j, i) so that each rank computes about the same number
+of pairs.
+
+All ranks of the communicator must call exchange and compute in the same order.
+This fits SPMD programs launched with mpirun. It does not fit tasks on MPIPoolExecutor,
+which may run on any subset of workers, so processor.py doesn't use pair_grid. It is a
+building block for an SPMD analysis.
+
+Each rank passes the Fourier coefficients of the channels it owns:
+
+>>> grid = pair_grid(MPI.COMM_WORLD, 192)
+>>> start, stop = grid.get_owned_range()
+>>> pairs, result = grid.compute(kernel_crossphase, fft_data[start:stop], None)
+"""
+
+import logging
+import math
+
+import numpy as np
+
+from data_models.channels_2d import channel_pair
+
+
+def get_block_bounds(num_channels, num_blocks):
+    """Splits channels into contiguous blocks of about the same size.
+
+    Args:
+        num_channels (int):
+            Number of channels
+        num_blocks (int):
+            Number of blocks
+
+    Returns:
+        bounds (ndarray, int):
+            Block b spans channels bounds[b] to bounds[b + 1]
+    """
+    sizes = np.full(num_blocks, num_channels // num_blocks)
+    sizes[:num_channels % num_blocks] += 1
+    return np.concatenate([[0], np.cumsum(sizes)])
+
+
+def get_grid_pairs(num_channels, grid_size, row, col):
+    """Returns the unique channel pairs computed by a rank of the grid.
+
+    Pairs (a, b) with a <= b, a in block I and b in block J are computed by
+    rank (I, J) if a + b is even and by rank (J, I) otherwise. Pairs of diagonal blocks
+    are computed by the diagonal ranks.
+
+    Args:
+        num_channels (int):
+            Number of channels
+        grid_size (int):
+            Number of grid rows and columns
+        row (int):
+            Grid row of the rank
+        col (int):
+            Grid column of the rank
+
+    Returns:
+        pairs (ndarray, int):
+            shape=(num_pairs, 2). Zero-based channel indices of each pair, with the
+            smaller index first as in :py:func:`data_models.helpers.get_dispatch_sequence`.
+    """
+    bounds = get_block_bounds(num_channels, grid_size)
+    ch_row = np.arange(bounds[row], bounds[row + 1])
+    ch_col = np.arange(bounds[col], bounds[col + 1])
+    a, b = np.meshgrid(ch_row, ch_col, indexing="ij")
+    if row == col:
+        mask = a <= b
+    elif row < col:
+        mask = (a + b) % 2 == 0
+    else:
+        # Pairs of block (col, row). Here a > b.
+        mask = (a + b) % 2 == 1
+        a, b = b, a
+    return np.stack([a[mask], b[mask]], axis=1)
+
+
+class block_channel():
+    """Channel in a local block of spectra.
+
+    Provides get_idx, the part of the :py:class:`data_models.channels_2d.channel_2d`
+    interface that analysis kernels use.
+    """
+
+    def __init__(self, idx):
+        """Initializes with the zero-based index of the channel in the local spectra."""
+        self.idx = idx
+
+    def get_idx(self):
+        """Returns the zero-based index of the channel in the local spectra."""
+        return self.idx
+
+
+class pair_grid():
+    """Computes a share of the pair matrix on each rank of a communicator."""
+
+    def __init__(self, comm, num_channels):
+        """Arranges the ranks of a communicator in a square grid.
+
+        Args:
+            comm (MPI.Comm):
+                Communicator. The number of ranks needs to be a square number.
+            num_channels (int):
+                Number of channels
+
+        Returns:
+            None
+
+        Raises:
+            ValueError:
+                If the number of ranks is not a square number or exceeds the number
+                of channels.
+        """
+        self.logger = logging.getLogger("simple")
+        self.comm = comm
+        self.num_channels = num_channels
+        self.grid_size = math.isqrt(comm.Get_size())
+        if self.grid_size ** 2 != comm.Get_size():
+            raise ValueError(f"pair_grid needs a square number of ranks, got {comm.Get_size()}")
+        if comm.Get_size() > num_channels:
+            raise ValueError(f"pair_grid needs at most {num_channels} ranks, got " +
+                             f"{comm.Get_size()}")
+
+        self.row, self.col = divmod(comm.Get_rank(), self.grid_size)
+        # Ranks in the same grid row, ordered by column, and in the same grid column
+        self.row_comm = comm.Split(self.row, self.col)
+        self.col_comm = comm.Split(self.col, self.row)
+
+        self.bounds = get_block_bounds(num_channels, self.grid_size)
+        # Block row is split into grid_size pieces, one for each rank of the grid row.
+        row_start = self.bounds[self.row]
+        self.piece_bounds = row_start + get_block_bounds(self.bounds[self.row + 1] - row_start,
+                                                         self.grid_size)
+        self.pairs = get_grid_pairs(num_channels, self.grid_size, self.row, self.col)
+
+    def get_owned_range(self):
+        """Returns the channels whose spectra this rank passes to exchange and compute.
+
+        Returns:
+            start, stop (int):
+                The rank owns channels start to stop
+        """
+        return self.piece_bounds[self.col], self.piece_bounds[self.col + 1]
+
+    def _get_block_size(self, block):
+        """Returns the number of channels in a block."""
+        return self.bounds[block + 1] - self.bounds[block]
+
+    def exchange(self, local_data):
+        """Assembles the spectra of the row and column block of this rank.
+
+        Collective over the communicator.
+
+        Args:
+            local_data (ndarray):
+                Spectra of the owned channels, see get_owned_range. dim0: channel.
+
+        Returns:
+            row_block (ndarray):
+                Spectra of the channels in block row
+            col_block (ndarray):
+                Spectra of the channels in block col
+        """
+        local_data = np.ascontiguousarray(local_data)
+        start, stop = self.get_owned_range()
+        assert(local_data.shape[0] == stop - start)
+        shape_ch = local_data.shape[1:]
+        size_ch = int(np.prod(shape_ch))
+
+        row_block = np.empty((self._get_block_size(self.row),) + shape_ch, dtype=local_data.dtype)
+        counts = np.diff(self.piece_bounds) * size_ch
+        self.row_comm.Allgatherv(local_data, [row_block, counts])
+
+        if self.row == self.col:
+            col_block = row_block
+        else:
+            col_block = np.empty((self._get_block_size(self.col),) + shape_ch,
+                                 dtype=local_data.dtype)
+        # The rank in grid column col and grid row col has assembled block col
+        self.col_comm.Bcast(col_block, root=self.col)
+        return row_block, col_block
+
+    def compute(self, kernel, local_data, params, bad_channels=None):
+        """Exchanges the spectra and applies a kernel to the pairs of this rank.
+
+        Collective over the communicator.
+
+        Args:
+            kernel (callable):
+                Analysis kernel, called as kernel(data, ch_it, params)
+            local_data (ndarray):
+                Spectra of the owned channels, see get_owned_range. dim0: channel.
+            params (dict):
+                Passed to the kernel
+            bad_channels (ndarray, bool):
+                Bad channel mask, indexed by zero-based channel index. Pairs that include
+                a bad channel are skipped. Optional.
+
+        Returns:
+            pairs (ndarray, int):
+                shape=(num_pairs, 2). Zero-based channel indices of the computed pairs.
+            result (ndarray):
+                Kernel result, one row for each pair
+        """
+        row_block, col_block = self.exchange(local_data)
+        pairs = self.pairs
+        if bad_channels is not None:
+            pairs = pairs[~(bad_channels[pairs[:, 0]] | bad_channels[pairs[:, 1]])]
+
+        # Local spectra are the row block followed by the column block.
+        data = np.concatenate([row_block, col_block])
+        ch_row, ch_col = (0, 1) if self.row <= self.col else (1, 0)
+        idx = np.empty_like(pairs)
+        idx[:, ch_row] = pairs[:, ch_row] - self.bounds[self.row]
+        idx[:, ch_col] = pairs[:, ch_col] - self.bounds[self.col] + row_block.shape[0]
+        ch_it = [channel_pair(block_channel(i1), block_channel(i2)) for i1, i2 in idx]
+        result = kernel(data, ch_it, params)
+        self.logger.info(f"pair_grid: Rank ({self.row}, {self.col}) computed {len(pairs)} pairs")
+        return pairs, result
+
+
+# End of file pair_grid.py
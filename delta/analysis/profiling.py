@@ -0,0 +1,217 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Collects timing information of analysis tasks on the workers.
+
+Each worker process records one entry per executed task in a pre-allocated numpy
+structured array. Entries are written in bulk, when the array is full, after a
+time interval, and when the worker exits. Each worker appends to its own file,
+profile_{hostname}_{rank:03d}.npy, as a sequence of numpy arrays.
+
+Profiling is disabled by default. It is enabled by setting the environment variable
+DELTA_PROFILE_DIR to the directory where the profile files are written. The processor
+sets it for its workers from the profiling section of the configuration:
+
+.. code-block::
+
+    "profiling": {"basedir": "/scratch/delta/run_001"}
+
+Use summarize_profiles.py to calculate kernel throughput per rank and per node.
+"""
+
+import atexit
+import glob
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+
+# Layout of a single profiling entry
+profile_dtype = np.dtype([("analysis_name", "S32"),
+                          ("chunk_idx", np.int32),
+                          ("channel_batch", np.int16),
+                          ("num_pairs", np.int32),
+                          ("t_start", np.float64),
+                          ("t_end", np.float64),
+                          ("t_io", np.float64),
+                          ("nbytes", np.int64)])
+
+
+class task_profiler():
+    """Buffers profiling entries of analysis tasks and writes them in bulk."""
+
+    def __init__(self, rank, basedir=None, capacity=4096, flush_interval=60.0):
+        """Initializes the profiler.
+
+        Args:
+            rank (int):
+                MPI rank of the worker process
+            basedir (str):
+                Directory where the profile file is written. If None, profiling is disabled
+                and record does nothing.
+            capacity (int):
+                Number of entries that are buffered before they are written
+            flush_interval (float):
+                Entries are written at least every flush_interval seconds, in seconds.
+
+        Returns:
+            None
+        """
+        self.enabled = basedir is not None
+        if not self.enabled:
+            return
+        self.filename = os.path.join(basedir, f"profile_{socket.gethostname()}_{rank:03d}.npy")
+        self.entries = np.zeros(capacity, dtype=profile_dtype)
+        self.num_entries = 0
+        self.flush_interval = flush_interval
+        self.t_last_flush = time.perf_counter()
+        # record is called from the threads of thread pool executors
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def record(self, analysis_name, chunk_idx, channel_batch, num_pairs, t_start, t_end, t_io,
+               nbytes):
+        """Records a task.
+
+        Args:
+            analysis_name (str):
+                Name of the analysis
+            chunk_idx (int):
+                Index of the time chunk
+            channel_batch (int):
+                Index of the channel batch
+            num_pairs (int):
+                Number of channel pairs computed by the kernel
+            t_start (float):
+                Start of the kernel, in seconds since the epoch
+            t_end (float):
+                End of the kernel, in seconds since the epoch
+            t_io (float):
+                Time spent storing the result, in seconds
+            nbytes (int):
+                Size of the stored result, in bytes
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[self.num_entries] = (analysis_name.encode()[:32], chunk_idx,
+                                              channel_batch, num_pairs, t_start, t_end, t_io,
+                                              nbytes)
+            self.num_entries += 1
+            if (self.num_entries == self.entries.size) or \
+               (time.perf_counter() - self.t_last_flush > self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        """Appends all buffered entries to the profile file."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """Appends all buffered entries to the profile file. The caller holds the lock."""
+        self.t_last_flush = time.perf_counter()
+        if self.num_entries == 0:
+            return
+        with open(self.filename, "ab") as df:
+            np.save(df, self.entries[:self.num_entries])
+        self.num_entries = 0
+
+
+# The profiler of this process, see get_profiler.
+_profiler = None
+# Thread workers of a process share the profiler
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """Returns the profiler of this worker process. Creates it on the first call.
+
+    Profile files are written to the directory given by the environment variable
+    DELTA_PROFILE_DIR. If it is not set, the profiler is disabled.
+    """
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            from mpi4py import MPI
+            _profiler = task_profiler(MPI.COMM_WORLD.Get_rank(),
+                                      basedir=os.environ.get("DELTA_PROFILE_DIR", None))
+        return _profiler
+
+
+def load_profile(filename):
+    """Loads all entries from a profile file.
+
+    Args:
+        filename (str):
+            Name of a file written by a task_profiler
+
+    Returns:
+        entries (ndarray):
+            Structured array with dtype profile_dtype
+    """
+    arr_list = []
+    with open(filename, "rb") as df:
+        # The file is a sequence of arrays, one for each flush.
+        while df.peek(1):
+            arr_list.append(np.load(df))
+    if len(arr_list) == 0:
+        return np.zeros(0, dtype=profile_dtype)
+    return np.concatenate(arr_list)
+
+
+def summarize_profiles(filenames):
+    """Calculates kernel throughput per rank and per node.
+
+    Args:
+        filenames (list of str):
+            Profile files. Hostname and rank are parsed from the file names.
+
+    Returns:
+        per_rank (dict):
+            Keys are tuples (hostname, rank), values are dicts with the summary.
+        per_node (dict):
+            Keys are hostnames, values are dicts with the summary.
+    """
+    def summarize(entries, num_ranks=1):
+        t_kernel = (entries["t_end"] - entries["t_start"]).sum()
+        t_io = entries["t_io"].sum()
+        if entries.size > 0:
+            wall = (entries["t_end"] + entries["t_io"]).max() - entries["t_start"].min()
+        else:
+            wall = 0.0
+        return {"num_tasks": int(entries.size),
+                "num_pairs": int(entries["num_pairs"].sum()),
+                "t_kernel": t_kernel,
+                "t_io": t_io,
+                "pairs_per_sec": entries["num_pairs"].sum() / t_kernel if t_kernel > 0 else 0.0,
+                "io_MB_per_sec": entries["nbytes"].sum() / 1024 / 1024 / t_io if t_io > 0 else 0.0,
+                # Fraction of the time that the ranks spent in kernels or storage
+                "utilization": (t_kernel + t_io) / wall / num_ranks if wall > 0 else 0.0}
+
+    entries_rank = {}
+    for fname in filenames:
+        # File names are profile_{hostname}_{rank}.npy. Hostnames may contain underscores.
+        hostname, rank = os.path.basename(fname)[len("profile_"):-len(".npy")].rsplit("_", 1)
+        entries_rank[(hostname, int(rank))] = load_profile(fname)
+
+    per_rank = {key: summarize(entries) for key, entries in entries_rank.items()}
+    per_node = {}
+    for hostname in set([key[0] for key in entries_rank.keys()]):
+        entries_node = [entries for key, entries in entries_rank.items() if key[0] == hostname]
+        per_node[hostname] = summarize(np.concatenate(entries_node), len(entries_node))
+    return per_rank, per_node
+
+
+def find_profiles(basedir="."):
+    """Returns the names of all profile files in basedir."""
+    return sorted(glob.glob(os.path.join(basedir, "profile_*.npy")))
+
+
+# End of file profiling.py
@@ -0,0 +1,126 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Sizes batches of channel pairs from the measured cost of an analysis kernel.
+
+With a fixed channel_chunk_size, the last batches of a time chunk often run on only a
+few workers, while the other workers are idle. Kernels with different costs and
+workers on different nodes make this worse.
+
+adaptive_batcher uses guided self-scheduling. Pool executors, such as MPIPoolExecutor,
+keep a single queue of tasks, and idle workers take the next task from it. Batches are
+submitted with decreasing size: large batches at the start of a chunk keep the overhead
+per batch low, and small batches at the end fill up idle workers.
+The size of the large batches is chosen so that a batch takes about target_time
+seconds. The cost per channel pair is estimated from the run times of completed batches.
+
+To use adaptive batching for an analysis task, add to its parameters:
+
+.. code-block::
+
+    "adaptive_batching": {"target_time": 0.5, "min_batch_size": 64}
+
+The processor sets num_workers from --num_ranks_analysis.
+"""
+
+import logging
+import math
+import threading
+
+
+class adaptive_batcher():
+    """Splits channel pairs into batches with decreasing size."""
+
+    def __init__(self, cfg, initial_batch_size):
+        """Configures the batcher.
+
+        Args:
+            cfg (dict):
+                adaptive_batching section of the analysis task parameters
+            initial_batch_size (int):
+                Maximum batch size as long as no cost estimate is available.
+                Usually channel_chunk_size.
+
+        Returns:
+            None
+
+        Used keys from cfg:
+            * target_time - Time a batch should take to compute, in seconds. Optional,
+              defaults to 0.5.
+            * min_batch_size - Smallest batch size. Optional, defaults to 64.
+            * max_batch_size - Largest batch size. Optional, defaults to initial_batch_size.
+            * num_batches_per_worker - The remaining pairs of a chunk are split into batches
+              so that each worker gets this many batches. Optional, defaults to 2.
+            * smoothing - Weight of a new measurement in the moving average of the cost
+              per pair. Optional, defaults to 0.2.
+            * num_workers - Number of workers of the analysis executor. Optional,
+              defaults to 1.
+        """
+        self.logger = logging.getLogger("simple")
+        self.target_time = cfg.get("target_time", 0.5)
+        self.min_batch_size = cfg.get("min_batch_size", 64)
+        self.max_batch_size = cfg.get("max_batch_size", initial_batch_size)
+        self.initial_batch_size = min(initial_batch_size, self.max_batch_size)
+        self.num_batches_per_worker = cfg.get("num_batches_per_worker", 2)
+        self.smoothing = cfg.get("smoothing", 0.2)
+        self.num_workers = cfg.get("num_workers", 1)
+        # Moving average of the kernel time per channel pair, in seconds
+        self.pair_cost = None
+        # update is called from the callback threads of the executor
+        self.lock = threading.Lock()
+
+    def update(self, num_pairs, duration):
+        """Updates the cost estimate with the run time of a completed batch.
+
+        Args:
+            num_pairs (int):
+                Number of channel pairs in the batch
+            duration (float):
+                Time spent in the kernel, in seconds
+
+        Returns:
+            None
+        """
+        if num_pairs == 0:
+            return
+        cost = duration / num_pairs
+        with self.lock:
+            if self.pair_cost is None:
+                self.pair_cost = cost
+            else:
+                self.pair_cost = (1.0 - self.smoothing) * self.pair_cost + self.smoothing * cost
+
+    def get_batch_size(self):
+        """Returns the size of a batch that takes about target_time to compute."""
+        with self.lock:
+            pair_cost = self.pair_cost
+        if pair_cost is None or pair_cost <= 0.0:
+            return self.initial_batch_size
+        batch_size = int(self.target_time / pair_cost)
+        return max(self.min_batch_size, min(self.max_batch_size, batch_size))
+
+    def get_batches(self, num_pairs, num_workers):
+        """Splits num_pairs channel pairs into batches.
+
+        Args:
+            num_pairs (int):
+                Number of channel pairs to compute
+            num_workers (int):
+                Number of workers of the executor
+
+        Returns:
+            batches (list of tuple):
+                (offset, size) of each batch
+        """
+        batch_size = self.get_batch_size()
+        batches = []
+        offset = 0
+        while offset < num_pairs:
+            remaining = num_pairs - offset
+            size = math.ceil(remaining / (self.num_batches_per_worker * num_workers))
+            size = min(batch_size, max(self.min_batch_size, size), remaining)
+            batches.append((offset, size))
+            offset += size
+        return batches
+
+
+# End of file scheduler.py
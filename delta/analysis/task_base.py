@@ -1,13 +1,40 @@
 # -*- Encoding: UTF-8 -*-
 """Defines task objects that calculate spectra coherence."""
 
+import itertools
 import logging
 
-from data_models.helpers import get_dispatch_sequence
+import numpy as np
+
+from data_models.helpers import get_dispatch_sequence, filter_dispatch_sequence
 from storage.backend import get_storage_object
+from streaming.tracing import get_tracer
+from analysis.profiling import get_profiler
+from analysis.scheduler import adaptive_batcher
+
 
+def expand_result(result, pair_idx, num_pairs):
+    """Scatters the result of a filtered channel batch into the layout of the full batch.
+
+    Args:
+        result (ndarray):
+            Kernel result for the filtered batch. dim0 indices channel pairs.
+        pair_idx (ndarray, int):
+            Position of each computed pair in the full batch.
+        num_pairs (int):
+            Number of channel pairs in the full batch.
+
+    Returns:
+        result_full (ndarray):
+            Array with dim0 = num_pairs. Rows of pairs that were not computed are NaN.
+    """
+    result_full = np.full((num_pairs, ) + result.shape[1:], np.nan, dtype=result.dtype)
+    result_full[pair_idx, ...] = result[:]
+    return result_full
 
-def calc_and_store(kernel, storage_backend, timechunk, ch_it, info_dict):
+
+def calc_and_store(kernel, storage_backend, timechunk, ch_it, info_dict, pair_idx=None,
+                   trace_cfg=None):
     """Dispatch a kernel and store the result.
 
     Args:
@@ -18,35 +45,44 @@ def calc_and_store(kernel, storage_backend, timechunk, ch_it, info_dict):
             List of channels to iterate over
         info_dict (dict):
             Metadata for the fft_data object
+        pair_idx (ndarray, int):
+            If not None, ch_it is a filtered batch. Gives the position of each pair in
+            the full batch, see :py:func:`data_models.helpers.filter_dispatch_sequence`.
+        trace_cfg (dict):
+            Tracing configuration. If not None, kernel and storage spans are recorded
+            by the tracer of the worker process, see :py:mod:`streaming.tracing`.
 
     Returns:
-        None
+        num_pairs (int):
+            Number of channel pairs computed
+        t_kernel (float):
+            Time spent in the kernel, in seconds
+
+    Timings of the kernel and of the storage are recorded by the profiler of the
+    worker process, see :py:mod:`analysis.profiling`.
     """
-    from mpi4py import MPI
-    import datetime
-    from socket import gethostname
-    comm = MPI.COMM_WORLD
+    import time
     chunk_idx = info_dict['chunk_idx']
     an_name = info_dict["analysis_name"]
-    t1_calc = datetime.datetime.now()
+    t1_calc = time.time()
     result = kernel(timechunk.data, ch_it, timechunk.params)
-    t2_calc = datetime.datetime.now()
-    
-    t1_io = datetime.datetime.now()
+    t2_calc = time.time()
+    if pair_idx is not None:
+        result = expand_result(result, pair_idx, info_dict["num_pairs"])
+
+    t1_io = time.time()
     storage_backend.store_data(result, info_dict)
-    dt_io = datetime.datetime.now() - t1_io
+    t2_io = time.time()
 
-    #assert(False)
+    get_profiler().record(an_name, chunk_idx, info_dict["channel_batch"], len(ch_it),
+                          t1_calc, t2_calc, t2_io - t1_io, result.nbytes)
 
-    with open(f"outfile_{(comm.rank):03d}.txt", "a") as df:
-        # df.write("here")
-        df.write(f"rank {comm.rank:03d}/{comm.size:03d}: tidx={chunk_idx} {an_name} start " +
-                t1_calc.isoformat(sep=" ") + " end " + t2_calc.isoformat(sep=" ") +
-                f" Storage: {dt_io} " + f" {gethostname()}\n")
-        df.write(f"{an_name}: type is {type(result)} and shape is {result.shape}\n")
-        df.flush()
+    tracer = get_tracer(trace_cfg, "analysis")
+    tracer.add_span(an_name, chunk_idx, t1_calc, t2_calc,
+                    channel_batch=info_dict["channel_batch"])
+    tracer.add_span("storage", chunk_idx, t1_io, t2_io, channel_batch=info_dict["channel_batch"])
 
-    return None
+    return len(ch_it), t2_calc - t1_calc
 
 
 class task_base():
@@ -62,6 +98,15 @@ class task_base():
         self.dispatch_seq = get_dispatch_sequence(self.params["ref_channels"],
                                                   self.params["cmp_channels"],
                                                   self.params["channel_chunk_size"])
+        # Dispatch sequences with pairs of bad channels removed. Keyed by the bad channel mask.
+        self.skip_bad_channels = self.params.get("skip_bad_channels", True)
+        self.filtered_seq_cache = {}
+        # With adaptive batching, batches are cut from the flat list of channel pairs
+        self.batcher = None
+        if "adaptive_batching" in self.params:
+            self.batcher = adaptive_batcher(self.params["adaptive_batching"],
+                                            self.params["channel_chunk_size"])
+            self.pairs = list(itertools.chain(*self.dispatch_seq))
         storage_class = get_storage_object(cfg_storage)
         self.storage_backend = storage_class(cfg_storage)
         self.storage_backend.store_metadata(params)
@@ -74,9 +119,143 @@ class task_base():
         """Returns the dispatch function to use."""
         return calc_and_store
 
+    def _get_filtered_seq(self, bad_channels):
+        """Returns the dispatch sequence without channel pairs that include bad channels.
+
+        Bad channel masks rarely change between time chunks. Filtered sequences are
+        therefore cached, using the bytes of the mask as the key. With adaptive batching,
+        the sequence is the flat list of all channel pairs, as a single batch.
+
+        Args:
+            bad_channels (ndarray, bool):
+                Bad channel mask of the time chunk. May be None.
+
+        Returns:
+            filtered_seq (list of tuple):
+                List of (ch_it, pair_idx), see
+                :py:func:`data_models.helpers.filter_dispatch_sequence`
+        """
+        dispatch_seq = self.dispatch_seq if self.batcher is None else [self.pairs]
+        if (not self.skip_bad_channels) or (bad_channels is None) or (not bad_channels.any()):
+            return [(ch_it, None) for ch_it in dispatch_seq]
+
+        key = bad_channels.tobytes()
+        if key not in self.filtered_seq_cache:
+            # Keep the cache small. Masks that were seen long ago are unlikely to re-appear.
+            if len(self.filtered_seq_cache) >= 16:
+                self.filtered_seq_cache.clear()
+            self.filtered_seq_cache[key] = filter_dispatch_sequence(dispatch_seq, bad_channels)
+            self.logger.info(f"{self.__str__()}: {bad_channels.sum()} bad channels. Filtered "
+                             "dispatch sequence.")
+
+        return self.filtered_seq_cache[key]
+
+    def _get_batches(self, bad_channels):
+        """Returns the batches of channel pairs for a time chunk.
+
+        Args:
+            bad_channels (ndarray, bool):
+                Bad channel mask of the time chunk. May be None.
+
+        Returns:
+            batches (list of tuple):
+                (ch_it, pair_idx, num_pairs, pair_offset) for each batch. ch_it are the pairs
+                to compute. pair_idx is the position of these pairs in the full batch of
+                num_pairs pairs, see expand_result. pair_offset is the position of the
+                first pair of the full batch in the sequence of all pairs.
+        """
+        if self.batcher is None:
+            filtered_seq = self._get_filtered_seq(bad_channels)
+            offsets = itertools.accumulate([len(ch_it) for ch_it in self.dispatch_seq],
+                                           initial=0)
+            return [(ch_it, pair_idx, len(full_it), offset) for (ch_it, pair_idx), full_it, offset
+                    in zip(filtered_seq, self.dispatch_seq, offsets)]
+
+        # Cut the batches from the filtered list of all pairs. keep_idx are the positions
+        # of the remaining pairs in the list of all pairs.
+        batch_bounds = self.batcher.get_batches(len(self.pairs), self.batcher.num_workers)
+        [(good_pairs, keep_idx)] = self._get_filtered_seq(bad_channels)
+        if keep_idx is None:
+            return [(self.pairs[offset:offset + size], None, size, offset)
+                    for offset, size in batch_bounds]
+        batches = []
+        for offset, size in batch_bounds:
+            start, stop = np.searchsorted(keep_idx, [offset, offset + size])
+            pair_idx = keep_idx[start:stop] - offset
+            batches.append((good_pairs[start:stop], None if len(pair_idx) == size else pair_idx,
+                            size, offset))
+        return batches
+
+    def update_cost(self, result):
+        """Updates the cost estimate of the batcher with the result of a dispatch function.
+
+        Args:
+            result (tuple):
+                (num_pairs, t_kernel), as returned by calc_and_store. May be None.
+
+        Returns:
+            None
+        """
+        if self.batcher is not None and result is not None:
+            self.batcher.update(*result)
+
+    def _on_done(self, future):
+        """Callback for futures of the dispatch function.
+
+        Logs errors and updates the cost estimate of the batcher.
+        """
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.logger.error(f"{self.__str__()}: Analysis task failed: {exc!r}")
+            return
+        self.update_cost(future.result())
+
+    def get_work_items(self, timechunk, executor):
+        """Returns the batches of a time chunk as arguments for the dispatch function.
+
+        Args:
+            timechunk (data-model):
+                Time chunk to analyze. Only tb.chunk_idx and bad_channels are used.
+            executor (PEP-3148 executor):
+                Executor on which the batches are launched
+
+        Returns:
+            work_items (list of tuple):
+                For each batch (dispatch_func, kernel, storage_backend, ch_it, info_dict,
+                pair_idx). The dispatch function is called as
+                dispatch_func(kernel, storage_backend, timechunk, ch_it, info_dict, pair_idx,
+                trace_cfg). Batches in which all pairs include a bad channel are left out.
+        """
+        batches = self._get_batches(getattr(timechunk, "bad_channels", None))
+        info_dict_list = [{"analysis_name": self.__str__(),
+                           "chunk_idx": timechunk.tb.chunk_idx,
+                           "channel_batch": batch_idx,
+                           "num_pairs": num_pairs,
+                           "pair_offset": pair_offset}
+                          for batch_idx, (_, _, num_pairs, pair_offset) in enumerate(batches)]
+        # Processors that consume multiple streams tag results with the stream name
+        if "stream" in self.params:
+            for info_dict in info_dict_list:
+                info_dict["stream"] = self.params["stream"]
+
+        num_skipped = sum([num_pairs - len(ch_it) for ch_it, _, num_pairs, _ in batches])
+        self.logger.info((f"chunk_idx={timechunk.tb.chunk_idx} {self.__str__()}: "
+                          f"{len(batches)} tasks: {self._get_kernel()} "
+                          f"dispatch_function: {self._get_dispatch_func()} "
+                          f"skipped {num_skipped} channel pairs"))
+        return [(self._get_dispatch_func(), self._get_kernel(), self.storage_backend,
+                 ch_it, info_dict, pair_idx)
+                for (ch_it, pair_idx, _, _), info_dict in zip(batches, info_dict_list)
+                if len(ch_it) > 0]
+
     def execute(self, timechunk, executor):
         """Launches a spectral analysis kernel on an executor.
 
+        Channel pairs that include a channel marked in timechunk.bad_channels are not
+        computed. Their rows in the stored result are NaN.
+
         Args:
             executor (`PEP-3148 <https://www.python.org/dev/peps/pep-3148/>`_ compatible executor):
                 Executor to use
@@ -84,23 +263,19 @@ class task_base():
                 Fourier Coefficients of the data to analyze
 
         Returns:
-            None
+            futures (list of Future):
+                Futures of all launched batches
         """
-        info_dict_list = [{"analysis_name": self.__str__(),
-                           "chunk_idx": timechunk.tb.chunk_idx,
-                           "channel_batch": batch_idx}
-                          for batch_idx in range(len(self.dispatch_seq))]
-
-        _ = [executor.submit(self._get_dispatch_func(),
-                             self._get_kernel(),
-                             self.storage_backend,
-                             timechunk,
-                             ch_it,
-                             info_dict) for ch_it, info_dict in zip(self.dispatch_seq,
-                                                                    info_dict_list)]
-        self.logger.info((f"chunk_idx={timechunk.tb.chunk_idx} submitted {self.__str__()} "
-                          f"as {len(self.dispatch_seq)} tasks: {self._get_kernel()} "
-                          f"dispatch_function: {self._get_dispatch_func()}"))
-        return None
+        # Workers record spans if tracing is enabled in this process
+        tracer = get_tracer()
+        trace_cfg = tracer.cfg if tracer.enabled else None
+
+        futures = [executor.submit(dispatch_func, kernel, storage_backend, timechunk,
+                                   ch_it, info_dict, pair_idx, trace_cfg)
+                   for dispatch_func, kernel, storage_backend, ch_it, info_dict, pair_idx
+                   in self.get_work_items(timechunk, executor)]
+        for future in futures:
+            future.add_done_callback(self._on_done)
+        return futures
 
 # End of file task_base.py
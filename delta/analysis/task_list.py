@@ -48,10 +48,14 @@ class tasklist():
                 A time-chunk of 2D image data.
 
         Returns:
-            None
+            futures (list of Future):
+                Futures of all launched analysis batches
         """
         self.logger.info(f"Submitting timechunk {timechunk.tb.chunk_idx} to analysis tasklist")
+        futures = []
         for task in self.tasklist:
-            task.execute(timechunk, self.executor)
-        
+            futures += task.execute(timechunk, self.executor)
+        return futures
+
+
 # End of file task_list.py    
\ No newline at end of file
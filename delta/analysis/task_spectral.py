@@ -7,6 +7,10 @@ from analysis.kernels_spectral import kernel_coherence, kernel_crossphase, kerne
 
 class task_null(task_base):
     """Does nothing."""
+    def __init__(self, params, cfg_storage):
+        """kernel_null returns the input data. Its result can't be scattered into pair rows."""
+        super().__init__({**params, "skip_bad_channels": False}, cfg_storage)
+
     def __str__(self):
         return "task_null"
 
@@ -4,7 +4,8 @@ from analysis.task_base import task_base
 from analysis.kernels_spectral_gpu import kernel_spectral_GAP, increment_by_one, increment_by_two
 
 
-def calc_and_store_numba(kernel, storage_backend, fft_data, ch_it, info_dict):
+def calc_and_store_numba(kernel, storage_backend, fft_data, ch_it, info_dict, pair_idx=None,
+                         trace_cfg=None):
     """Dispatches a GPU numba kernel and store the result.
 
     Args:
@@ -15,18 +16,24 @@ def calc_and_store_numba(kernel, storage_backend, fft_data, ch_it, info_dict):
             List of channels to iterate over
         info_dict (dict):
             Metadata for the fft_data object
+        pair_idx (ndarray, int):
+            If not None, position of each pair of ch_it in the full batch.
+        trace_cfg (dict):
+            Tracing configuration, see :py:func:`analysis.task_base.calc_and_store`.
 
     Returns:
-        None
+        num_pairs (int):
+            Number of channel pairs computed
+        t_kernel (float):
+            Time spent in the kernel, in seconds
     """
-    from mpi4py import MPI
-    import datetime
-    from socket import gethostname
+    from analysis.task_base import expand_result
+    from analysis.profiling import get_profiler
+    from streaming.tracing import get_tracer
+    import time
     import numpy as np
     import math
 
-    comm = MPI.COMM_WORLD
-
     # Code below tests dummy kernel
     # out_arr = np.zeros(100)
     # threadsperblock = 32
@@ -52,25 +59,27 @@ def calc_and_store_numba(kernel, storage_backend, fft_data, ch_it, info_dict):
     dummy = np.zeros(fft_data.data.shape, dtype=fft_data.data.dtype)
     dummy[:] = fft_data.data[:]
 
-    t1_calc = datetime.datetime.now()
+    t1_calc = time.time()
     kernel[num_blocks, threads_per_block](dummy, result, ch1_idx_arr, ch2_idx_arr, win_factor)
-    t2_calc = datetime.datetime.now()
+    t2_calc = time.time()
+    if pair_idx is not None:
+        result = expand_result(result, pair_idx, info_dict["num_pairs"])
 
-    t1_io = datetime.datetime.now()
+    t1_io = time.time()
     storage_backend.store_data(result, info_dict)
-    dt_io = datetime.datetime.now() - t1_io
-
-    with open(f"outfile_{comm.rank:03d}.txt", "a") as df:
-        df.write(f"success: num_blocks={num_blocks}, tpb={threads_per_block}... {fft_data.data.dtype}, {fft_data.data.shape}... ")
-        df.write(f"dummy: {dummy.flags}, fft_data.data: {fft_data.data.flags}")
-        df.write((f"rank {comm.rank:03d}/{comm.size:03d}: "
-                  f"tidx={info_dict['chunk_idx']} {info_dict['analysis_name']} "
-                  f"start {t1_calc.isoformat(sep=' ')}  "
-                  f"end {t2_calc.isoformat(sep=' ')} "
-                  f"Storage: {dt_io} {gethostname()}\n"))
-        df.flush()
-
-    return None
+    t2_io = time.time()
+
+    get_profiler().record(info_dict["analysis_name"], info_dict["chunk_idx"],
+                          info_dict["channel_batch"], len(ch_it), t1_calc, t2_calc,
+                          t2_io - t1_io, result.nbytes)
+
+    tracer = get_tracer(trace_cfg, "analysis")
+    tracer.add_span(info_dict["analysis_name"], info_dict["chunk_idx"], t1_calc, t2_calc,
+                    channel_batch=info_dict["channel_batch"])
+    tracer.add_span("storage", info_dict["chunk_idx"], t1_io, t2_io,
+                    channel_batch=info_dict["channel_batch"])
+
+    return len(ch_it), t2_calc - t1_calc
 
 
 class task_spectral_GAP(task_base):
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+
+"""Converts a shot into a memory-mapped .npy file for fast replay.
+
+The converted shot can be streamed by setting diagnostic.datasource.format to 'memmap'
+and diagnostic.datasource.source_file to the .npy file.
+"""
+
+import json
+import argparse
+
+import numpy as np
+
+from sources.loader_memmap import convert_to_memmap
+
+parser = argparse.ArgumentParser(description="Converts a shot into a memory-mapped .npy file.")
+parser.add_argument('--config', type=str,
+                    help='Lists the configuration file',
+                    default='configs/test_generator.json')
+parser.add_argument('--output', type=str, help="Name of the .npy file to write", required=True)
+parser.add_argument('--float64', help="Store data as float64 instead of float32",
+                    action='store_true')
+args = parser.parse_args()
+
+with open(args.config, "r") as df:
+    cfg = json.load(df)
+
+convert_to_memmap(cfg, args.output, np.float64 if args.float64 else np.float32)
+
+# End of file convert_memmap.py
@@ -2,13 +2,14 @@
 
 """Helper functions common to all data models."""
 
+import copy
 import logging
 import numpy as np
 from itertools import filterfalse
 
 import more_itertools
 
-from data_models.kstar_ecei import ecei_chunk
+from data_models.kstar_ecei import ecei_chunk, bad_channel_summary
 from data_models.channels_2d import channel_2d, channel_range, channel_pair
 from data_models.timebase import timebase_streaming
 
@@ -68,10 +69,14 @@ class data_model_generator():
         if self.cfg["name"] == "kstarecei":
             # Adapt configuration file parameters for use in timebase_streaming constructor
             self.logger.info(f"New chunk: attrs = {stream_attrs}, chunk_idx = {chunk_idx}")
+            # A middleman may have decimated the data. See preprocess/reduction.py.
+            # SampleRate already refers to the reduced data.
+            cfg_reduction = stream_attrs.get("reduction", {})
+            chunk_size = self.chunk_size // cfg_reduction.get("decimate", {}).get("q", 1)
             tb_chunk = timebase_streaming(stream_attrs["TriggerTime"][0],
                                           stream_attrs["TriggerTime"][1],
                                           stream_attrs["SampleRate"],
-                                          self.chunk_size, chunk_idx)
+                                          chunk_size, chunk_idx)
             chunk = self.data_type(stream_data, tb_chunk, stream_attrs)
 
             # Determine whether we need to normalize the data
@@ -168,6 +173,40 @@ def gen_var_name(cfg: dict) -> str:
         raise ValueError
 
 
+def gen_stream_cfgs(cfg: dict) -> list:
+    """Generates one configuration for each stream that the processor consumes.
+
+    Each entry in diagnostic.datasource.channel_range is sent on a separate stream,
+    f.ex. by a generator for each ECEI device or channel shard. The configuration
+    of a stream is a copy of cfg with only this channel range. With more than one
+    stream, the name of the stream is added to the analysis parameters so that results
+    from different streams are stored separately.
+
+    Args:
+        cfg (dict):
+            Delta configuration
+
+    Returns:
+        stream_cfgs (list of dict):
+            Configuration for each stream. With a single channel range, this is [cfg].
+    """
+    channel_ranges = gen_var_name(cfg)
+    if len(channel_ranges) == 1:
+        return [cfg]
+
+    stream_cfgs = []
+    for rg in channel_ranges:
+        stream_cfg = copy.deepcopy(cfg)
+        stream_cfg["diagnostic"]["datasource"]["channel_range"] = [rg]
+        stream_name = gen_channel_name(stream_cfg["diagnostic"])
+        # Configurations of the generator and the middleman have no analysis section
+        for anl_params in stream_cfg.get("analysis", {}).values():
+            anl_params["stream"] = stream_name
+        stream_cfgs.append(stream_cfg)
+
+    return stream_cfgs
+
+
 def unique_everseen(iterable, key=None):
     """List unique elements, preserving order. Remember all elements ever seen.
 
@@ -220,6 +259,8 @@ class normalize_mean():
         self.offstd = data_norm.std(axis=-1, keepdims=True)
         self.siglev = None
         self.sigstd = None
+        # Bad channel reason codes of the last normalized chunk. Used to log only changes.
+        self.bad_channel_reason = None
         # self.logger.info(f"Calculating normalization using {data_norm.shape[-1]} samples")
         # self.logger.info(f"Calculated offlev: {self.offlev}")
         # self.logger.info(f"Calculated offstd: {self.offstd}")
@@ -249,12 +290,18 @@ class normalize_mean():
         chunk.offlev = self.offlev
         chunk.offstd = self.offstd
 
-        chunk.data[:] = chunk.data - self.offlev
+        np.subtract(chunk.data, self.offlev, out=chunk.data)
         chunk.siglev = np.median(chunk.data, axis=chunk.axis_t, keepdims=True)
         chunk.sigstd = chunk.data.std(axis=chunk.axis_t, keepdims=True)
-        chunk.data[:] = chunk.data / chunk.data.mean(axis=chunk.axis_t, keepdims=True) - 1.0
+        np.divide(chunk.data, chunk.data.mean(axis=chunk.axis_t, keepdims=True), out=chunk.data)
+        np.subtract(chunk.data, 1.0, out=chunk.data)
         chunk.is_normalized = True
-        chunk.mark_bad_channels(verbose=True)
+
+        bad_channel_reason = chunk.mark_bad_channels()
+        if (self.bad_channel_reason is None) or\
+           (not np.array_equal(bad_channel_reason, self.bad_channel_reason)):
+            self.logger.info(f"Bad channels changed: {bad_channel_summary(bad_channel_reason)}")
+            self.bad_channel_reason = bad_channel_reason.copy()
 
         return None
 
@@ -295,4 +342,41 @@ def get_dispatch_sequence(ref_channels, cmp_channels, niter=128):
     all_chunks = list(more_itertools.chunked(unique_channels, niter))
     return(all_chunks)
 
+
+def filter_dispatch_sequence(dispatch_seq, bad_channels):
+    """Removes channel pairs that include a bad channel from a dispatch sequence.
+
+    The layout of the dispatch sequence is preserved: Each batch is mapped to a
+    filtered batch and the positions of the remaining pairs in the original batch.
+
+    >>> filtered = filter_dispatch_sequence(get_dispatch_sequence(...), chunk.bad_channels)
+    >>> ch_it, pair_idx = filtered[0]
+    >>> result_full[pair_idx] = kernel(fft_data, ch_it, params)
+
+    Args:
+        dispatch_seq (list of list of channel_pair):
+            Dispatch sequence, as returned by get_dispatch_sequence
+        bad_channels (ndarray, bool):
+            Bad channel mask, indexed by linear, zero-based channel index.
+
+    Returns:
+        filtered_seq (list of tuple):
+            For each batch in dispatch_seq a tuple (ch_it, pair_idx). ch_it is the list of
+            channel pairs with both channels good. pair_idx is an integer array of the positions
+            of these pairs in the original batch. If no pair is removed from a batch, pair_idx
+            is None.
+    """
+    filtered_seq = []
+    for ch_it in dispatch_seq:
+        ch1_idx = np.array([ch_pair.ch1.get_idx() for ch_pair in ch_it], dtype=int)
+        ch2_idx = np.array([ch_pair.ch2.get_idx() for ch_pair in ch_it], dtype=int)
+        is_good = ~(bad_channels[ch1_idx] | bad_channels[ch2_idx])
+        if is_good.all():
+            filtered_seq.append((ch_it, None))
+        else:
+            pair_idx = np.flatnonzero(is_good)
+            filtered_seq.append(([ch_it[i] for i in pair_idx], pair_idx))
+
+    return filtered_seq
+
 # End of file helpers.py
@@ -9,9 +9,16 @@ This code is based on the `fluctana <https://github.com/minjunJchoi/fluctana>`_
 """
 
 import logging
+from functools import lru_cache
 import numpy as np
 
-from data_models.channels_2d import channel_2d, channel_range, num_to_vh
+from data_models.channels_2d import channel_2d, channel_range
+
+# Reason codes for bad channels, see :py:meth:`ecei_chunk.mark_bad_channels`.
+# Codes are bit-flags and can be combined.
+BAD_LOW_SIGNAL = 1
+BAD_SAT_BOTTOM = 2
+BAD_SAT_TOP = 4
 
 
 class ecei_chunk():
@@ -36,7 +43,7 @@ class ecei_chunk():
     
     """
 
-    def __init__(self, data, tb, params=None, num_v=24, num_h=8):
+    def __init__(self, data, tb, params=None, num_v=24, num_h=8, copy=True):
         # TODO: remove rarr and zarr and make them computable from params
         """Creates an ecei_chunk from a give dataset.
 
@@ -67,6 +74,10 @@ class ecei_chunk():
                 Number of vertical channels. Defaults to 24.
             num_h (int):
                 Number of horizontal channels. Defaults to 8.
+            copy (bool):
+                If True, data is converted to an owned, writable float64 array, copying if
+                necessary. If False, contiguous data is used as-is, f.ex. a read-only
+                memory-mapped array. Defaults to True.
 
         Returns:
             None
@@ -79,7 +90,10 @@ class ecei_chunk():
 
         # We should ensure that the data is contiguous so that we can remove this from
         # if not data.flags.contiguous:
-        self.ecei_data = np.require(data, dtype=np.float64, requirements=['C', 'O', 'W', 'A'])
+        if copy:
+            self.ecei_data = np.require(data, dtype=np.float64, requirements=['C', 'O', 'W', 'A'])
+        else:
+            self.ecei_data = data
         assert(self.ecei_data.flags.contiguous)
 
         # Time-base for the chunk
@@ -104,6 +118,8 @@ class ecei_chunk():
         self.sigstd = None
         # bad_channels is used as a mask and has shape=(nchannels)
         self.bad_channels = np.zeros((self.num_h * self.num_v), dtype=bool)
+        # Reason codes for bad channels, shape=(nchannels). See mark_bad_channels
+        self.bad_channel_reason = np.zeros((self.num_h * self.num_v), dtype=np.uint8)
 
     @property
     def data(self):
@@ -115,7 +131,7 @@ class ecei_chunk():
         """Forwards to self.ecei_data.shape."""
         return self.ecei_data.shape
 
-    def mark_bad_channels(self, verbose=False):
+    def mark_bad_channels(self):
         """Mark bad channels.
 
         A channel where any of the following three condition is true is marked as bad.
@@ -125,36 +141,29 @@ class ecei_chunk():
             * Saturated offset data(top saturation): std(signal) < 0.001
 
         Internally, bad channels is represented by an bool array of shape (self.num_h * self.num_v)
+        The reason why a channel is bad is stored in self.bad_channel_reason as a bit-wise
+        combination of BAD_LOW_SIGNAL, BAD_SAT_BOTTOM, and BAD_SAT_TOP.
+        New flags are added to channels that are already marked as bad.
+
+        Returns:
+            bad_channel_reason (ndarray, uint8):
+                Reason code for each channel. 0 for good channels.
         """
-        self.logger.info(f"offlev: {self.offlev.shape}, offstd: {self.offstd.shape}, siglev: {self.siglev.shape}, sigstd: {self.sigstd.shape}")
+        offstd = np.squeeze(self.offstd)
+        siglev = np.squeeze(self.siglev)
+        sigstd = np.squeeze(self.sigstd)
+
         # Check for low signal level
-        ref = 100. * self.offstd / self.siglev
-        ref[self.siglev < 0.01] = 100
-        # Squeeze singleton dimensions so that we can do indexing with ref
-        ref = np.squeeze(ref)
-
-        my_num_to_vh = num_to_vh(24, 8, "horizontal")
-
-        if verbose:
-            for item in np.argwhere(ref > 30.0):
-                self.logger.debug(f"LOW SIGNAL: channel({my_num_to_vh(item[0] + 1)}) ref = {ref[item[0]]:f}")
-        self.bad_channels[ref > 30.0] = True
-
-        # Mark bottom saturated channels
-        self.bad_channels[np.squeeze(self.offstd < 1e-3)] = True
-        if verbose:
-            for item in np.argwhere(self.offstd < 1e-3):
-                os = self.offstd[tuple(item)]
-                ol = self.offlev[tuple(item)]
-                self.logger.debug(f"SAT offset channel {my_num_to_vh(item[0] + 1)}: offstd = {os} offlevel = {ol}")
-
-        # Mark top saturated channels
-        self.bad_channels[np.squeeze(self.sigstd < 1e-3)] = True
-        if verbose:
-            for item in np.argwhere(self.sigstd < 1e-3):
-                os = self.offstd[tuple(item)]
-                ol = self.offlev[tuple(item)]
-                self.logger.debug(f"SAT signal channel {my_num_to_vh(item[0] + 1)}: offstd = {os} offlevel = {ol}")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ref = 100. * offstd / siglev
+        ref[siglev < 0.01] = 100
+
+        self.bad_channel_reason |= ((ref > 30.0) * BAD_LOW_SIGNAL |
+                                    (offstd < 1e-3) * BAD_SAT_BOTTOM |
+                                    (sigstd < 1e-3) * BAD_SAT_TOP).astype(np.uint8)
+        self.bad_channels |= self.bad_channel_reason > 0
+
+        return self.bad_channel_reason
 
     def create_ft(self, fft_data, params):
         """Returns a fourier-transformed object.
@@ -170,13 +179,14 @@ class ecei_chunk():
                 Chunk of Fourier-transformed data
         """
         return ecei_chunk_ft(fft_data, tb=self.tb,
-                             freqs=None, params=params)
+                             freqs=None, params=params, bad_channels=self.bad_channels)
 
 
 class ecei_chunk_ft():
     """Represents a fourier-transformed time-chunk of ECEI data."""
 
-    def __init__(self, data, tb, freqs, params=None, axis_ch=0, axis_t=1, num_v=24, num_h=8):
+    def __init__(self, data, tb, freqs, params=None, axis_ch=0, axis_t=1, num_v=24, num_h=8,
+                 bad_channels=None):
         """Initializes with data and meta-information.
 
         Args:
@@ -196,6 +206,8 @@ class ecei_chunk_ft():
                 Number of vertical channels
             num_h (int):
                 Number of horizontal channels
+            bad_channels (ndarray, bool):
+                Bad channel mask of the original data, shape=(nchannels). Defaults to None.
 
         Returns:
             None
@@ -208,6 +220,8 @@ class ecei_chunk_ft():
         self.axis_t = axis_t
         self.num_v = num_v
         self.num_h = num_h
+        # bad_channels is carried over from the ecei_chunk this object was created from
+        self.bad_channels = bad_channels
 
     # @property
     # def data(self):
@@ -265,6 +279,88 @@ def channel_range_from_str(range_str):
     return channel_range(ch_i, ch_f)
 
 
+def shard_channel_range(range_str, rank, size):
+    """Splits a channel range into blocks of vertical rows and returns the block of a rank.
+
+    Rows are distributed as evenly as possible. Each shard covers full horizontal rows,
+    so the rows of all shards, concatenated by rank, give the rows of the full range.
+
+    >>> shard_channel_range("L0101-2408", 1, 4)
+        ('L0701-1208', 48)
+
+    Args:
+        range_str (str):
+            KSTAR ECEI channel range, format DDVVHH-VVHH
+        rank (int):
+            Index of the shard
+        size (int):
+            Total number of shards. Must not be larger than the number of vertical rows.
+
+    Returns:
+        shard_str (str):
+            Channel range of the shard, format DDVVHH-VVHH
+        row_offset (int):
+            Index of the first channel of the shard in the full range
+    """
+    import re
+
+    ch_rg = channel_range_from_str(range_str)
+    rows = np.array_split(np.arange(ch_rg.ch_vi, ch_rg.ch_vf + 1), size)[rank]
+    if len(rows) == 0:
+        raise ValueError(f"Can't split {range_str} into {size} shards.")
+
+    dev = re.search('[A-Z]{1,2}', range_str)
+    dev = dev.group(0) if dev is not None else ""
+    shard_str = f"{dev}{rows[0]:02d}{ch_rg.ch_hi:02d}-{rows[-1]:02d}{ch_rg.ch_hf:02d}"
+    row_offset = (rows[0] - ch_rg.ch_vi) * (ch_rg.ch_hf - ch_rg.ch_hi + 1)
+    return shard_str, int(row_offset)
+
+
+def bad_channel_summary(bad_channel_reason, num_h=8):
+    """Summarizes bad channel reason codes in a single string.
+
+    >>> bad_channel_summary(chunk.mark_bad_channels())
+    'LOW SIGNAL: 2 [0103, 2408], SAT offset: 0 [], SAT signal: 1 [0101]'
+
+    Args:
+        bad_channel_reason (ndarray, uint8):
+            Reason codes, as returned by :py:meth:`ecei_chunk.mark_bad_channels`
+        num_h (int):
+            Number of horizontal channels. Defaults to 8.
+
+    Returns:
+        summary (str):
+            Number of channels and channel names (VVHH) for each reason code.
+    """
+    summary = []
+    for code, label in zip([BAD_LOW_SIGNAL, BAD_SAT_BOTTOM, BAD_SAT_TOP],
+                           ["LOW SIGNAL", "SAT offset", "SAT signal"]):
+        ch_idx = np.flatnonzero(bad_channel_reason & code)
+        ch_names = [f"{v:02d}{h:02d}" for v, h in zip(ch_idx // num_h + 1, ch_idx % num_h + 1)]
+        summary.append(f"{label}: {ch_idx.size} [{', '.join(ch_names)}]")
+
+    return ", ".join(summary)
+
+
+def _free_space(dist):
+    """Returns ABCD matrices for free-space propagation.
+
+    Args:
+        dist (float or ndarray):
+            Propagation distance, in mm.
+
+    Returns:
+        abcd (ndarray, float):
+            Stack of ABCD matrices, shape dist.shape + (2, 2)
+    """
+    dist = np.asarray(dist, dtype=np.float64)
+    abcd = np.zeros(dist.shape + (2, 2))
+    abcd[..., 0, 0] = 1.0
+    abcd[..., 0, 1] = dist
+    abcd[..., 1, 1] = 1.0
+    return abcd
+
+
 def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
     """Returns ABCD matrix for KSTAR ECEI diagnostic.
 
@@ -273,8 +369,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
             LensZoom
         LensFocus (float):
             LensFocus
-        Rinit (float):
-            Radial position of the channel, in meter
+        Rinit (float or ndarray):
+            Radial position of the channel, in meter. May be an array of positions.
         dev (char):
             Name ECEI device. Either one of 'L', 'H', 'G', 'GT', 'GR', 'HT'
         new_H (bool):
@@ -282,7 +378,7 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     Returns:
         ABCD (ndarray, float):
-            The ABCD matrix
+            The ABCD matrix. For array-valued Rinit, a stack of shape Rinit.shape + (2, 2).
 
     Raises:
         NameError:
@@ -291,12 +387,14 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
     if dev not in ['L', 'H', 'G', 'GT', 'GR', 'HT']:
         raise NameError(f"Device is {dev:s}, but needs to be 'L', 'H', 'G', 'GT', 'GR', or 'HT'.")
 
-    # ABCD matrix
+    # ABCD matrix of the optical system, starting at the first lens.
+    # Only the free-space propagation to the first lens, over dist0, depends on Rinit.
     abcd = None
+    dist0 = None
     if dev == 'L':
         sp = 3350 - Rinit * 1000  # [m] -> [mm]
-        abcd = np.array([[1, 250 + sp], [0, 1]]).dot(
-            np.array([[1, 0], [(1.52 - 1) / (-730), 1.52]])).dot(
+        dist0 = 250 + sp
+        abcd = np.array([[1, 0], [(1.52 - 1) / (-730), 1.52]]).dot(
             np.array([[1, 135], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.52) / (2700 * 1.52), 1 / 1.52]])).dot(
             np.array([[1, 1265 - LensZoom], [0, 1]])).dot(
@@ -315,8 +413,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     elif dev == 'H':
         sp = 3350 - Rinit * 1000
-        abcd = np.array([[1, 250 + sp], [0, 1]]).dot(
-            np.array([[1, 0], [(1.52 - 1) / (- 730), 1.52]])).dot(
+        dist0 = 250 + sp
+        abcd = np.array([[1, 0], [(1.52 - 1) / (- 730), 1.52]]).dot(
             np.array([[1, 135], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.52) / (2700 * 1.52), 1 / 1.52]])).dot(
             np.array([[1, 1265 - LensZoom], [0, 1]])).dot(
@@ -345,8 +443,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     elif dev == 'G':
         sp = 3150 - Rinit * 1000
-        abcd = np.array([[1, 1350 - LensZoom + sp], [0, 1]]).dot(
-            np.array([[1, 0], [0, 1.545]])).dot(
+        dist0 = 1350 - LensZoom + sp
+        abcd = np.array([[1, 0], [0, 1.545]]).dot(
             np.array([[1, 100], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.545) / (900 * 1.545), 1 / 1.545]])).dot(
             np.array([[1, 1430 - LensFocus + 660 + LensZoom + 470], [0, 1]])).dot(
@@ -361,8 +459,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     elif dev == 'GT':
         sp = 2300 - Rinit * 1000
-        abcd = np.array([[1, sp + (1954 - LensZoom)], [0, 1]]).dot(
-            np.array([[1, 0], [(1.52 - 1) / (- 1000), 1.52]])).dot(
+        dist0 = sp + (1954 - LensZoom)
+        abcd = np.array([[1, 0], [(1.52 - 1) / (- 1000), 1.52]]).dot(
             np.array([[1, 160], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.52) / (1000 * 1.52), 1 / 1.52]])).dot(
             np.array([[1, 2280 - (1954 + 160 - LensZoom)], [0, 1]])).dot(
@@ -381,8 +479,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     elif dev == 'GR':
         sp = 2300 - Rinit * 1000
-        abcd = np.array([[1, sp + (1954 - LensZoom)], [0, 1]]).dot(
-            np.array([[1, 0], [(1.52 - 1) / (-1000), 1.52]])).dot(
+        dist0 = sp + (1954 - LensZoom)
+        abcd = np.array([[1, 0], [(1.52 - 1) / (-1000), 1.52]]).dot(
             np.array([[1, 160], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.52) / (1000 * 1.52), 1 / 1.52]])).dot(
             np.array([[1, 2280 - (1954 + 160 - LensZoom)], [0, 1]])).dot(
@@ -401,8 +499,8 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
 
     elif dev == 'HT':
         sp = 2300 - Rinit * 1000
-        abcd = np.array([[1, sp + 2586], [0, 1]]).dot(
-            np.array([[1, 0], [0, 1.52]])).dot(
+        dist0 = sp + 2586
+        abcd = np.array([[1, 0], [0, 1.52]]).dot(
             np.array([[1, 140], [0, 1]])).dot(
             np.array([[1, 0], [(1 - 1.52) / (770 * 1.52), 1 / 1.52]])).dot(
             np.array([[1, 4929 - (2586 + 140) - LensZoom], [0, 1]])).dot(
@@ -419,7 +517,7 @@ def get_abcd(LensFocus, LensZoom, Rinit, dev, new_H=True):
             np.array([[1, 0], [0, 1 / 1.52]])).dot(
             np.array([[1, 7094.62 - (6489 + 25.62)], [0, 1]]))
 
-    return abcd
+    return np.matmul(_free_space(dist0), abcd)
 
 
 def get_geometry(cfg_diagnostic):
@@ -433,6 +531,9 @@ def get_geometry(cfg_diagnostic):
     * Mode - Either 'O' or 'X', ordinary/extra-ordinary
     * dev - In ['L', 'H', 'G', 'GT', 'GR', 'HT']
 
+    The geometry only depends on these parameters. It is calculated once and cached for
+    each parameter combination. The returned arrays are read-only.
+
     Args:
         cfg_diagnostic (dict):
             Parameters section of diagnostic configuration.
@@ -443,57 +544,62 @@ def get_geometry(cfg_diagnostic):
         zarr (ndarray):
             Array containing vertical coordinate of channels in m.
     """
+    # Set hn, depending on mode. If mode is undefined, set X-mode as default.
+    try:
+        mode = cfg_diagnostic["Mode"]
+    except KeyError as k:
+        print("ecei_cfg: key {0:s} not found. Defaulting to 2nd X-mode".format(k.__str__()))
+        cfg_diagnostic["Mode"] = 'X'
+        mode = 'X'
+
+    # Instead of TFcurrent multiplying by 1e3, put this in the config file
+    return _get_geometry_cached(cfg_diagnostic["dev"], float(cfg_diagnostic["TFcurrent"]),
+                                float(cfg_diagnostic["LoFreq"]),
+                                float(cfg_diagnostic["LensFocus"]),
+                                float(cfg_diagnostic["LensZoom"]), mode)
+
+
+@lru_cache(maxsize=16)
+def _get_geometry_cached(dev, TFcurrent, LoFreq, LensFocus, LensZoom, mode):
+    """Calculates channel geometry arrays. See get_geometry."""
     me = 9.1e-31             # electron mass, in kg
     e = 1.602e-19            # charge, in C
     mu0 = 4. * np.pi * 1e-7  # permeability
     ttn = 56 * 16              # total TF coil turns
 
-    # Unpack ecei_cfg
-    # Instead of TFcurrent multiplying by 1e3, put this in the config file
-    TFcurrent = cfg_diagnostic["TFcurrent"]
-    LoFreq = cfg_diagnostic["LoFreq"]
-    LensFocus = cfg_diagnostic["LensFocus"]
-    LensZoom = cfg_diagnostic["LensZoom"]
-    # Set hn, depending on mode. If mode is undefined, set X-mode as default.
     hn = 2
-    try:
-        if cfg_diagnostic["Mode"] == 'O':
-            hn = 1
-        elif cfg_diagnostic["Mode"] == 'X':
-            hn = 2
-
-    except KeyError as k:
-        print("ecei_cfg: key {0:s} not found. Defaulting to 2nd X-mode".format(k.__str__()))
-        cfg_diagnostic["Mode"] = 'X'
+    if mode == 'O':
+        hn = 1
+    elif mode == 'X':
         hn = 2
 
     # To vectorize calculation of the channel positions we flatten out
     # horizontal and vertical channel indices in horizontal order.
-    arr_ch_hv = np.zeros([24 * 8, 2], dtype=int)
-    for idx_v in range(1, 25):
-        for idx_h in range(1, 9):
-            ch = channel_2d(idx_v, idx_h, 24, 8, "horizontal")
-            arr_ch_hv[ch.get_idx(), 0] = ch.ch_h
-            arr_ch_hv[ch.get_idx(), 1] = ch.ch_v
+    ch_idx = np.arange(24 * 8)
+    ch_h = ch_idx % 8 + 1
+    ch_v = ch_idx // 8 + 1
 
     rpos_arr = hn * e * mu0 * ttn * TFcurrent /\
-        (4. * np.pi * np.pi * me * ((arr_ch_hv[:, 0] - 1) * 0.9 + 2.6 + LoFreq) * 1e9)
+        (4. * np.pi * np.pi * me * ((ch_h - 1) * 0.9 + 2.6 + LoFreq) * 1e9)
 
     # With radial positions at hand, continue the calculations from beam_path
     # This is an (192, 2, 2) array, where the first dimension indices each individual channel
-    abcd_array = np.array([get_abcd(LensFocus, LensZoom, rpos,
-                                    cfg_diagnostic["dev"]) for rpos in rpos_arr])
+    abcd_array = get_abcd(LensFocus, LensZoom, rpos_arr, dev)
     # vertical position from the reference axis (vertical center of all lens, z=0 line)
     zz = (np.arange(24, 0, -1) - 12.5) * 14  # [mm]
     # angle against the reference axis at ECEI array box
     aa = np.zeros_like(zz)
 
-    # vertical posistion and angle at rpos
-    za_array = np.dot(abcd_array, [zz, aa])
+    # vertical posistion and angle at rpos. Only the column of the vertical channel is needed
+    za_array = np.matmul(abcd_array, np.stack([zz[ch_v - 1], aa[ch_v - 1]],
+                                              axis=-1)[:, :, np.newaxis])
+
+    zpos_arr = za_array[:, 0, 0] * 1e-3
+    apos_arr = za_array[:, 1, 0]
 
-    zpos_arr = np.array([za_array[i, 0, v - 1] for
-                         i, v in zip(np.arange(192), arr_ch_hv[:, 1])]) * 1e-3
-    apos_arr = np.array([za_array[i, 1, v - 1] for i, v in zip(np.arange(192), arr_ch_hv[:, 1])])
+    for arr in [rpos_arr, zpos_arr, apos_arr]:
+        arr.setflags(write=False)
 
     return(rpos_arr, zpos_arr, apos_arr)
+
 # End of file kstar_ecei.py
@@ -4,6 +4,11 @@
 
 Reads diagnostic data and stages it chunk-wise for transport.
 Data stream can be received with middleman or processor.
+
+When started on multiple MPI ranks, the channel range is split into blocks of rows.
+Each rank loads and writes only its block of a single global variable:
+
+    mpirun -n 4 python generator.py --config configs/test_generator.json
 """
 
 from mpi4py import MPI
@@ -13,13 +18,17 @@ import yaml
 import argparse
 
 import time
+import numpy as np
 
 import logging
 import logging.config
 
-from streaming.writers import writer_gen
+from streaming.helpers import get_writer
+from streaming.pacing import step_pacer
+from streaming.tracing import get_tracer
 from sources.helpers import get_loader
-from data_models.helpers import gen_channel_name, gen_var_name
+from data_models.helpers import gen_channel_name, gen_var_name, gen_stream_cfgs
+from data_models.kstar_ecei import shard_channel_range, channel_range_from_str
 
 # Initialize MPI
 comm = MPI.COMM_WORLD
@@ -36,6 +45,10 @@ parser.add_argument('--kstar', help='kstar', action='store_true')
 parser.add_argument('--slow', type=float,
                     help="Adds a small break in-between sending packages.",
                     default=0.1)
+parser.add_argument('--rate', type=str,
+                    help="Paces sending to a target rate. Either 'realtime', to stream at the " +
+                    "rate the diagnostic acquires data, or a bandwidth in MB/s. Replaces --slow.",
+                    default=None)
 args = parser.parse_args()
 
 # set up the configuration
@@ -48,43 +61,110 @@ with open('configs/logger.yaml', 'r') as f:
 logging.config.dictConfig(log_cfg)
 logger = logging.getLogger("generator")
 logger.info("Starting up...")
+tracer = get_tracer(cfg.get("tracing", None), "generator")
+
+# With multiple ranks, each rank loads a block of rows of the channel range and
+# writes it into a single global variable.
+cfg_loader = cfg
+if size > 1:
+    if isinstance(cfg["diagnostic"]["datasource"]["source_file"], list):
+        raise ValueError("Multi-device sources can't be sharded across ranks.")
+    shard_str, row_offset = shard_channel_range(gen_var_name(cfg)[0], rank, size)
+    cfg_loader = {**cfg, "diagnostic": {**cfg["diagnostic"]}}
+    cfg_loader["diagnostic"]["datasource"] = {**cfg["diagnostic"]["datasource"],
+                                              "channel_range": [shard_str]}
+    logger.info(f"Rank {rank}/{size} loads channels {shard_str}")
 
 # Instantiate a dataloader
-dataloader = get_loader(cfg)
+dataloader = get_loader(cfg_loader)
 sectionname = "transport_tx" if not args.kstar else "transport_rx"
-logger.info(f"Creating writer_gen: engine={cfg[sectionname]['engine']}")
-
-writer = writer_gen(cfg[sectionname], gen_channel_name(cfg["diagnostic"]))
-logger.info(f"Streaming channel name = {gen_channel_name(cfg['diagnostic'])}")
-# Give the writer hints on what kind of data to transfer
-
-writer.DefineVariable(gen_var_name(cfg)[rank],
-                      dataloader.get_chunk_shape(),
-                      dataloader.dtype)
-# TODO: Clean up naming conventions for stream attributes
-logger.info(f"Writing attributes: {dataloader.attrs}")
-
-writer.Open()
-writer.DefineAttributes("stream_attrs", dataloader.attrs)
+logger.info(f"Creating writer: engine={cfg[sectionname]['engine']}")
+
+# A multi-device loader streams each device on its own stream, as the processor and the
+# middleman expect one stream per channel range. The attributes of each stream are those
+# of its device. Otherwise we stream a single variable.
+if hasattr(dataloader, "var_names"):
+    stream_cfgs = gen_stream_cfgs(cfg)
+    attrs_list = [dataloader.attrs[var_name] for var_name in dataloader.var_names]
+else:
+    stream_cfgs = [cfg]
+    attrs_list = [dataloader.attrs]
+
+writer_list = []
+for stream_cfg, attrs in zip(stream_cfgs, attrs_list):
+    writer = get_writer(cfg[sectionname], gen_channel_name(stream_cfg["diagnostic"]),
+                        MPI.COMM_WORLD if size > 1 else None)
+    logger.info(f"Streaming channel name = {gen_channel_name(stream_cfg['diagnostic'])}")
+    # Give the writer hints on what kind of data to transfer
+    var_name = gen_var_name(stream_cfg)[0]
+    if size > 1:
+        num_channels = channel_range_from_str(var_name).length()
+        writer.DefineVariable(var_name,
+                              (num_channels, dataloader.chunk_size),
+                              dataloader.dtype,
+                              start=(row_offset, 0),
+                              count=dataloader.get_chunk_shape())
+    else:
+        writer.DefineVariable(var_name,
+                              dataloader.get_chunk_shape(),
+                              dataloader.dtype)
+    # TODO: Clean up naming conventions for stream attributes
+    logger.info(f"Writing attributes: {attrs}")
+
+    # Send the trace context with each step. With multiple ranks, rank 0 sends it.
+    if tracer.enabled and rank == 0:
+        writer.DefineTraceVariable()
+    writer.Open()
+    writer.DefineAttributes("stream_attrs", attrs)
+    writer_list.append(writer)
+
+# Set up pacing. Without a target rate, sleep a fixed time after each step.
+# Pacing is recorded in the statistics of the first stream.
+pacer = None
+if args.rate == "realtime":
+    pacer = step_pacer.from_realtime(dataloader.chunk_size, attrs_list[0]["SampleRate"],
+                                     writer_list[0].stats)
+elif args.rate is not None:
+    bytes_per_step = len(writer_list) * np.prod(dataloader.get_chunk_shape()) * \
+        np.dtype(dataloader.dtype).itemsize
+    pacer = step_pacer.from_bandwidth(bytes_per_step, float(args.rate), writer_list[0].stats)
+if pacer is not None:
+    logger.info(f"Pacing steps to {1.0 / pacer.step_interval} steps/sec")
 
 logger.info("Start sending on channel:")
 batch_gen = dataloader.batch_generator()
+t_load = time.time()
 for nstep, chunk in enumerate(batch_gen):
-    # TODO: Do we want to place filtering in the generator? This would allow us to
-    # send fewer data to the processor.
+    tracer.add_span("load", nstep, t_load, time.time())
+    # Filtering and decimation to send fewer data to the processor are done by the
+    # middleman, before forwarding over the WAN. See preprocess/reduction.py
     # if rank == 0:
     #     logger.info(f"Filtering time_chunk {nstep} / {dataloader.num_chunks}")
 
     if rank == 0:
         logger.info(f"Sending time_chunk {nstep} / {dataloader.num_chunks}")
-    writer.BeginStep()
-    writer.put_data(chunk)
-    writer.EndStep()
-    time.sleep(args.slow)
-
-
-writer.writer.Close()
-logger.info(writer.transfer_stats())
+    if pacer is not None:
+        pacer.wait()
+    # A multi-device loader yields a chunk for each device. Put the chunks of all devices
+    # deferred, so that no stream waits for the transfer of another in its Put. The
+    # transfers are performed in EndStep. The chunks stay valid until then.
+    chunk_list = chunk if isinstance(chunk, list) else [chunk]
+    with tracer.span("send", nstep):
+        for writer, dev_chunk in zip(writer_list, chunk_list):
+            writer.BeginStep()
+            writer.put_data(dev_chunk, deferred=True)
+            writer.put_trace(nstep)
+        for writer in writer_list:
+            writer.EndStep()
+    if pacer is None:
+        time.sleep(args.slow)
+    t_load = time.time()
+
+
+for writer in writer_list:
+    writer.Close()
+    logger.info(writer.transfer_stats())
+tracer.flush()
 logger.info("Finished")
 
 # End of file generator.py
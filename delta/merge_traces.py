@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+
+"""Merges the trace files of a run into a single Chrome trace/Perfetto JSON file.
+
+Also prints the end-to-end latency of each chunk, from the first to the last recorded span.
+
+    python merge_traces.py --output trace.json traces/trace_*.json
+"""
+
+import json
+import argparse
+
+import numpy as np
+
+from streaming.tracing import load_trace, chunk_latencies
+
+parser = argparse.ArgumentParser(description="Merges trace files into a single file.")
+parser.add_argument('--output', type=str, help="Name of the merged trace file",
+                    default="trace.json")
+parser.add_argument('files', type=str, nargs='+', help="Trace files to merge")
+args = parser.parse_args()
+
+events = []
+for fname in args.files:
+    events += load_trace(fname)
+
+with open(args.output, "w") as df:
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, df)
+
+latencies = chunk_latencies(events)
+for chunk_idx in sorted(latencies.keys()):
+    print(f"chunk {chunk_idx:5d}: {latencies[chunk_idx][0]:8.4f}s, last span: "
+          f"{latencies[chunk_idx][1]}")
+if len(latencies) > 0:
+    arr = np.array([latency for latency, _ in latencies.values()])
+    print(f"{len(arr)} chunks: median {np.median(arr):8.4f}s, max {arr.max():8.4f}s")
+
+# End of file merge_traces.py
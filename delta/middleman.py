@@ -1,7 +1,18 @@
 # Endocing: UTF-8 -*-
 
 
-"""Receives data from generator and forwards them to processor."""
+"""Receives data from generator and forwards them to processor.
+
+Each entry in diagnostic.datasource.channel_range is relayed as a separate stream.
+With multiple MPI ranks, the streams are distributed round-robin over the ranks.
+For each stream, a receive thread reads each step once into a buffer from a pool.
+A forward thread writes the same buffer to the outgoing stream and returns it to the
+pool after EndStep. If the forward thread fails, the pool is aborted. The receive thread
+then stops and the error is raised by the middleman.
+
+If the configuration has a `reduction` section, each step is reduced before it is
+forwarded, see :py:mod:`preprocess.reduction`.
+"""
 
 from mpi4py import MPI
 
@@ -9,14 +20,17 @@ import logging
 import logging.config
 import queue
 import threading
+import time
 import attr
 import json
 import yaml
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-from streaming.writers import writer_gen
-from streaming.reader_mpi import reader_gen
-from data_models.helpers import gen_channel_name, gen_var_name
+from streaming.helpers import get_reader, get_writer
+from streaming.tracing import get_tracer
+from data_models.helpers import gen_channel_name, gen_var_name, gen_stream_cfgs
+from preprocess.reduction import reduction
 
 
 @attr.s
@@ -25,58 +39,261 @@ class AdiosMessage:
     tstep_idx = attr.ib(repr=True)
     data = attr.ib(repr=False)
     attrs = attr.ib(repr=False)
+    # Index of the chunk, taken from the trace context of the stream
+    chunk_idx = attr.ib(repr=False, default=None)
+
+
+class buffer_pool():
+    """Bounded pool of receive buffers.
+
+    Buffers are allocated by the first reads and re-used once they are released.
+    get blocks while all buffers are in flight, which limits the memory used by
+    the middleman when the outgoing stream is slower than the incoming one.
+    The forward thread aborts the pool when it fails, so that get doesn't block forever.
+    """
+
+    def __init__(self, num_buffers):
+        """Initializes the pool.
+
+        Args:
+            num_buffers (int):
+                Maximum number of buffers in flight
+
+        Returns:
+            None
+        """
+        self.free_q = queue.Queue()
+        self.error = None
+        for _ in range(num_buffers):
+            self.free_q.put(None)
+
+    def get(self):
+        """Returns a free buffer. None if the buffer still needs to be allocated.
+
+        Raises:
+            RuntimeError:
+                If the pool has been aborted
+        """
+        buffer = self.free_q.get()
+        if self.error is not None:
+            raise RuntimeError("Forwarding failed, buffer pool was aborted") from self.error
+        return buffer
+
+    def abort(self, error):
+        """Fails the current and all further calls to get with error."""
+        self.error = error
+        # Wakes up a call to get that waits for a buffer
+        self.free_q.put(None)
+
+    def release(self, buffer):
+        """Returns a buffer to the pool."""
+        self.free_q.put(buffer)
 
 
-def forward(Q, cfg, args, timeout):
-    """To be executed by a local thread. Pops items from the queue and forwards them."""
-    global comm, rank
+def receive(reader, stream_varname, Q, pool):
+    """Reads steps from a stream and queues them for forwarding.
+
+    Executed by a local thread for each stream. Each step is read once, into a
+    buffer from pool. A None is queued at the end of the stream.
+
+    Args:
+        reader (reader_gen or reader_shm):
+            Opened reader for the incoming stream
+        stream_varname (str):
+            Name of the variable to read
+        Q (queue.Queue):
+            Queue of the forward thread
+        pool (buffer_pool):
+            Pool of receive buffers
+
+    Returns:
+        rx_list (list):
+            Steps that have been received
+
+    Raises:
+        RuntimeError:
+            If the forward thread failed, see :py:meth:`buffer_pool.abort`
+    """
     logger = logging.getLogger("middleman")
-    logger.info(f"Worker: Creating writer_gen: engine={cfg[args.transport_tx]['engine']}")
+    tracer = get_tracer()
 
-    # suffix = ""  # if not args.debug else '-MM'
-    ch_name = gen_channel_name(cfg["diagnostic"])
-    writer = writer_gen(cfg[args.transport_tx], ch_name)
-    logger.info(f"Worker: Streaming channel name = {ch_name}")
+    stream_attrs = None
+    rx_list = []
+    while True:
+        t_begin = time.time()
+        stepStatus = reader.BeginStep()
+        logger.info(f"Main: stepStatus = {stepStatus}, currentStep = {reader.CurrentStep()}")
+        if stepStatus:
+            if stream_attrs is None:
+                if reader.InquireAttribute("stream_attrs"):
+                    stream_attrs = reader.get_attrs("stream_attrs")
+
+            # Read data. The buffer is released by the forward thread after sending it.
+            stream_data = reader.Get(stream_varname, save=False, out=pool.get())
+            rx_list.append(reader.CurrentStep())
+
+            # Use the chunk index of the trace context, if the writer sends one.
+            chunk_idx = reader.CurrentStep()
+            trace_ctx = reader.get_trace()
+            if trace_ctx is not None:
+                chunk_idx, t_send = trace_ctx
+                tracer.add_span("transport", chunk_idx, t_send, time.time())
+
+            # Generate message id and publish is
+            msg = AdiosMessage(tstep_idx=reader.CurrentStep(), data=stream_data, attrs=stream_attrs,
+                               chunk_idx=chunk_idx)
+            Q.put_nowait(msg)
+            logger.info(f"Main: Published message {msg}")
+            reader.EndStep()
+            tracer.add_span("receive", chunk_idx, t_begin, time.time())
+        else:
+            logger.info(f"Main: Exiting: StepStatus={stepStatus}")
+            break
+
+    Q.put(None)
+    return rx_list
+
+
+def forward(Q, writer, stream_varname, pool, my_reduction=None):
+    """To be executed by a local thread. Pops items from the queue and forwards them.
+
+    Data is written with a deferred Put, directly from the receive buffer. The buffer
+    is returned to the pool after EndStep. Exits when a None is popped from the queue.
+    With a reduction, the reduced data is written and the buffer is returned right away.
+
+    Args:
+        Q (queue.Queue):
+            Queue filled by receive
+        writer (writer_gen or writer_shm):
+            Writer for the outgoing stream. Opened when the first item arrives.
+        stream_varname (str):
+            Name of the variable to write
+        pool (buffer_pool):
+            Pool of receive buffers
+        my_reduction (reduction):
+            Reduction applied before forwarding. Optional.
+
+    Returns:
+        tx_list (list):
+            Steps that have been forwarded
+    """
+    logger = logging.getLogger("middleman")
+    tracer = get_tracer()
+    logger.info(f"Worker: Streaming channel name = {writer.stream_name}")
 
     tx_list = []
     is_first = True
     while True:
-        # msg = None
-        try:
-            msg = Q.get(timeout=timeout)
-            logger.info(f"Worker: Receiving from Queue: {msg} - {msg.data.shape}, {msg.data.dtype}")
-            if is_first:
-                writer.DefineVariable(gen_var_name(cfg)[rank], msg.data.shape, msg.data.dtype)
-                #if msg.attrs is not None:
-                writer.DefineAttributes("stream_attrs", msg.attrs)
-                logger.info(f"Worker: Defining stream_attrs for forwarded stream: {msg.attrs}")
-                writer.Open()
-                logger.info("Worker: Starting forwarding process")
-                is_first = False
-        except queue.Empty:
-            logger.info("Worker: Empty queue after waiting until time-out. Exiting")
+        msg = Q.get()
+        if msg is None:
+            logger.info("Worker: End of stream. Exiting")
+            Q.task_done()
             break
 
+        logger.info(f"Worker: Receiving from Queue: {msg} - {msg.data.shape}, {msg.data.dtype}")
+        if my_reduction is not None:
+            with tracer.span("reduce", msg.chunk_idx):
+                data = my_reduction.process(msg.data)
+            pool.release(msg.data)
+            # Stream attributes are only defined once, with the first step
+            attrs = msg.attrs
+            if is_first and attrs is not None:
+                attrs = my_reduction.update_attrs(attrs)
+            msg = AdiosMessage(tstep_idx=msg.tstep_idx, data=data, attrs=attrs,
+                               chunk_idx=msg.chunk_idx)
+        if is_first:
+            writer.DefineVariable(stream_varname, msg.data.shape, msg.data.dtype)
+            writer.DefineAttributes("stream_attrs", msg.attrs)
+            logger.info(f"Worker: Defining stream_attrs for forwarded stream: {msg.attrs}")
+            if tracer.enabled:
+                writer.DefineTraceVariable()
+            writer.Open()
+            logger.info("Worker: Starting forwarding process")
+            is_first = False
+
         logger.info(f"Worker Forwarding chunk {msg.tstep_idx}. Data = {msg.data.shape}")
-        writer.BeginStep()
-        writer.put_data(msg)
-        writer.EndStep()
+        with tracer.span("forward", msg.chunk_idx):
+            writer.BeginStep()
+            writer.put_data(msg, deferred=True)
+            writer.put_trace(msg.chunk_idx)
+            writer.EndStep()
+        if my_reduction is None:
+            pool.release(msg.data)
         logger.info(f"Worker: Done writing chunk {msg.tstep_idx}.")
         tx_list.append(msg.tstep_idx)
 
         Q.task_done()
         logger.info(f"Consumed tidx={msg.tstep_idx}")
 
-    writer.Close()
+    if not is_first:
+        writer.Close()
     logger.info(f"Worker: Exiting send loop. Transmitted {len(tx_list)} time chunks: {tx_list}")
     logger.info(writer.transfer_stats())
+    return tx_list
+
+
+def forward_or_abort(Q, writer, stream_varname, pool, my_reduction=None):
+    """Runs :py:func:`forward`. If it fails, aborts the pool, which stops receive.
+
+    Args and return value are the same as for forward.
+    """
+    try:
+        return forward(Q, writer, stream_varname, pool, my_reduction)
+    except Exception as err:
+        logging.getLogger("middleman").error(f"Worker: Forwarding failed: {err}")
+        pool.abort(err)
+        raise
+
+
+def relay(stream_cfg, args):
+    """Relays a single stream. Receives in this thread and forwards in a worker thread.
+
+    Args:
+        stream_cfg (dict):
+            Delta configuration of the stream, see
+            :py:func:`data_models.helpers.gen_stream_cfgs`
+        args (argparse.Namespace):
+            Command line arguments
+
+    Returns:
+        None
+    """
+    logger = logging.getLogger("middleman")
+    ch_name = gen_channel_name(stream_cfg["diagnostic"])
+    stream_varname = gen_var_name(stream_cfg)[0]
+    logger.info(f"Main: Relaying {ch_name}, varname: {stream_varname}")
+
+    # Create ADIOS reader object
+    reader = get_reader(stream_cfg[args.transport_rx], ch_name)
+    reader.Open()
+    logger.info(f"Worker: Creating writer: engine={stream_cfg[args.transport_tx]['engine']}")
+    writer = get_writer(stream_cfg[args.transport_tx], ch_name)
+
+    my_reduction = None
+    if "reduction" in stream_cfg:
+        my_reduction = reduction(stream_cfg["reduction"])
+
+    dq = queue.Queue()
+    pool = buffer_pool(args.num_buffers)
+    worker = threading.Thread(target=forward_or_abort, args=(dq, writer, stream_varname, pool,
+                                                             my_reduction))
+    worker.start()
+
+    rx_list = receive(reader, stream_varname, dq, pool)
+    logger.info(f"Main: Exiting main loop. Received {len(rx_list)} time chunks from {ch_name}")
+    logger.info(reader.transfer_stats())
+    reader.stats.close()
+    worker.join()
+    logger.info("Main: Workers have joined")
+    dq.join()
+    logger.info("Main: Queue joined")
 
 
 def main():
     """Reads items from a ADIOS2 connection and forwards them."""
-    global comm, rank, args
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
+    size = comm.Get_size()
 
     parser = argparse.ArgumentParser(description="Receive data and dispatch" +
                                      "analysis tasks to a mpi queue")
@@ -86,11 +303,13 @@ def main():
                         default="transport_rx")
     parser.add_argument("--transport_tx", help="Specifies the name of the transport section that is used to configure the writer",
                         default="transport_tx")
+    parser.add_argument("--num_buffers", type=int,
+                        help="Number of receive buffers per stream that are in flight",
+                        default=4)
     args = parser.parse_args()
 
     with open(args.config, "r") as df:
         cfg = json.load(df)
-    timeout = 5
 
     # The middleman uses both a reader and a writer. Each is configured with using
     # their respective section of the config file. Therefore some keys are duplicated,
@@ -100,50 +319,18 @@ def main():
         log_cfg = yaml.safe_load(f.read())
     logging.config.dictConfig(log_cfg)
     logger = logging.getLogger('middleman')
+    tracer = get_tracer(cfg.get("tracing", None), "middleman")
 
-    # Create ADIOS reader object
-    reader = reader_gen(cfg[args.transport_rx], gen_channel_name(cfg["diagnostic"]))
-    reader.Open()
-    stream_attrs = None
-    stream_varname = gen_var_name(cfg)[rank]
-    logger.info(f"Main: Stream varname: {stream_varname}")
-
-    dq = queue.Queue()
-    msg = None
-    worker = threading.Thread(target=forward, args=(dq, cfg, args, timeout))
-    worker.start()
-
-    rx_list = []
-    stream_data = None
-    while True:
-        stepStatus = reader.BeginStep()
-        logger.info(f"Main: stepStatus = {stepStatus}, currentStep = {reader.CurrentStep()}")
-        if stepStatus:
-            # Read data
-            stream_data = reader.Get(stream_varname, save=False)
-            if stream_attrs is None:
-                if reader.InquireAttribute("stream_attrs"):
-                    stream_attrs = reader.get_attrs("stream_attrs")
-
-            stream_data = reader.Get(stream_varname, save=False)
-            rx_list.append(reader.CurrentStep())
-
-            # Generate message id and publish is
-            msg = AdiosMessage(tstep_idx=reader.CurrentStep(), data=stream_data, attrs=stream_attrs)
-            dq.put_nowait(msg)
-            logger.info(f"Main: Published message {msg}")
-            reader.EndStep()
-        else:
-            logger.info(f"Main: Exiting: StepStatus={stepStatus}")
-            break
-
-        # last_step = reader.CurrentStep()
-
-    logger.info("Main: Exiting main loop")
-    worker.join()
-    logger.info("Main: Workers have joined")
-    dq.join()
-    logger.info("Main: Queue joined")
+    # Each rank relays every size-th stream. Streams are relayed concurrently.
+    stream_cfgs = gen_stream_cfgs(cfg)[rank::size]
+    if len(stream_cfgs) == 0:
+        logger.info(f"Main: Rank {rank}/{size}: No stream to relay")
+    with ThreadPoolExecutor(max_workers=max(len(stream_cfgs), 1)) as executor:
+        relay_list = [executor.submit(relay, stream_cfg, args) for stream_cfg in stream_cfgs]
+    tracer.flush()
+    # Raises the error of a failed relay
+    for fut in relay_list:
+        fut.result()
     logger.info("Main: Finished")
 
 
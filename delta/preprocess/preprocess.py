@@ -4,10 +4,12 @@
 
 
 import logging
+import threading
 import time
 from preprocess.helpers import get_preprocess_routine
 from storage.backend import get_storage_object
 from data_models.kstar_ecei import get_geometry
+from streaming.tracing import get_tracer
 
 
 class preprocessor():
@@ -35,6 +37,7 @@ class preprocessor():
         Used keys from cfg_all:
             * preprocess
             * storage
+            * storage.metadata_batch_size - Number of chunk metadata items per insert. Optional.
 
         """
         self.logger = logging.getLogger("simple")
@@ -53,30 +56,74 @@ class preprocessor():
                 continue
             self.logger.info(f"Added {key} to preprocessing")
 
+        # Metadata is written through a single storage backend.
+        storage_class = get_storage_object(cfg["storage"])
+        self.storage = storage_class(cfg["storage"])
         self.metadata_stored = False
-
-    def _store_metadata(self, timechunk):
+        # Bad channel masks seen in this run, keyed by mask bytes. Values are mask ids.
+        self.bad_channel_masks = {}
+        # Chunk metadata items waiting to be written
+        self.metadata_buffer = []
+        self.metadata_batch_size = cfg["storage"].get("metadata_batch_size", 16)
+        # submit is called from multiple queue worker threads
+        self.metadata_lock = threading.Lock()
+
+    def store_metadata(self, timechunk):
         """Stores metadata that becomes available from timechunks.
 
-        This was added in a hurry in the KSTAR experiments.
+        Channel geometry and sampling interval are static for a run and are stored once,
+        with the first chunk. Each distinct bad channel mask is stored once, together
+        with an id. Per chunk, only the time range and the id of the bad channel mask
+        are kept. These items are buffered and written in batches.
+
+        Called by submit. When chunks are pre-processed on the analysis workers, the
+        dispatcher calls it instead, see :py:mod:`analysis.locality`.
         """
-        cfg_storage = self.cfg["storage"]
-        rpos_arr, zpos_arr, _ = get_geometry(timechunk.params)
-        # Note: We need to convert np.bool to bool too when converting timechunk.bad_channels
-        # into a list
-        chunk_t0, chunk_t1 = timechunk.tb.get_trange()
-        chunk_metadata = {"bad_channels": [bool(c) for c in timechunk.bad_channels],
-                          "tstart": chunk_t0,
-                          "tend": chunk_t1,
-                          "dt": timechunk.tb.dt,
-                          "rarr": list(rpos_arr),
-                          "zarr": list(zpos_arr),
-                          "chunk_idx": timechunk.tb.chunk_idx,
-                          "description_new": "chunk_metadata"}
-
-        storage_class = get_storage_object(cfg_storage)
-        storage = storage_class(cfg_storage)
-        storage.store_metadata(chunk_metadata)
+        items = []
+        with self.metadata_lock:
+            if not self.metadata_stored:
+                rpos_arr, zpos_arr, _ = get_geometry(timechunk.params)
+                items.append({"dt": timechunk.tb.dt,
+                              "rarr": list(rpos_arr),
+                              "zarr": list(zpos_arr),
+                              "description_new": "run_metadata"})
+                self.metadata_stored = True
+
+            mask_key = timechunk.bad_channels.tobytes()
+            if mask_key not in self.bad_channel_masks:
+                self.bad_channel_masks[mask_key] = len(self.bad_channel_masks)
+                # Note: We need to convert np.int64 to int when converting into a list
+                items.append({"mask_id": self.bad_channel_masks[mask_key],
+                              "bad_channels": [int(c) for c in
+                                               timechunk.bad_channels.nonzero()[0]],
+                              "description_new": "bad_channel_mask"})
+
+            chunk_t0, chunk_t1 = timechunk.tb.get_trange()
+            self.metadata_buffer.append({"chunk_idx": timechunk.tb.chunk_idx,
+                                         "tstart": chunk_t0,
+                                         "tend": chunk_t1,
+                                         "mask_id": self.bad_channel_masks[mask_key],
+                                         "description_new": "chunk_metadata"})
+
+            # Static items are written right away, chunk items once a batch is full.
+            if len(self.metadata_buffer) >= self.metadata_batch_size:
+                items += self.metadata_buffer
+                self.metadata_buffer = []
+
+        if len(items) > 0:
+            self.executor.submit(self.storage.store_many, items)
+
+    def flush_metadata(self):
+        """Writes all buffered chunk metadata.
+
+        Needs to be called before the executor is shut down.
+        """
+        with self.metadata_lock:
+            items = self.metadata_buffer
+            self.metadata_buffer = []
+
+        if len(items) > 0:
+            self.executor.submit(self.storage.store_many, items)
 
     def submit(self, timechunk):
         """Launches preprocessing routines on the executor.
@@ -90,11 +137,14 @@ class preprocessor():
                 Pre-processed timechunk data
         """
         self.logger.info(f"Start pre-processing of chunk. attrs={timechunk.params}")
-        self._store_metadata(timechunk)
+        self.store_metadata(timechunk)
 
+        tracer = get_tracer()
+        chunk_idx = timechunk.tb.chunk_idx
         tic = time.perf_counter()
         for item in self.preprocess_list:
-            timechunk = item.process(timechunk, self.executor)
+            with tracer.span(type(item).__name__, chunk_idx):
+                timechunk = item.process(timechunk, self.executor)
 
         toc = time.perf_counter()
         tictoc = toc - tic
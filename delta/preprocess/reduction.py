@@ -0,0 +1,142 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Reduces the data volume of a stream before it is forwarded.
+
+The middleman applies the reduction to each step before forwarding it to the processor.
+Steps are configured in the `reduction` section of the configuration and are applied in
+the order they are given:
+
+.. code-block::
+
+    "reduction":
+    {
+        "bandpass_fir": {"N": 5, "Wn": [0.02, 0.036], "btype": "bandpass", "output": "sos"},
+        "decimate": {"q": 4},
+        "downcast": {"dtype": "float32"}
+    }
+
+The reduction is recorded in the stream attributes, so that the processor can
+construct time chunks with the reduced shape and sampling rate.
+
+Channels can't be selected in the middleman. Analysis tasks and channel geometry index
+the full ECEI array, so the processor needs to receive all channels.
+
+Each time chunk is filtered on its own. The zero-phase filters of bandpass and decimate keep no
+state across chunk boundaries, so the samples at the start and the end of each chunk
+carry edge transients, as when filtering in the processor's pre-processing.
+"""
+
+import copy
+import logging
+
+import numpy as np
+from scipy.signal import sosfiltfilt, decimate
+
+from preprocess.helpers import get_preprocess_routine
+
+
+class reduction():
+    """Reduces a data chunk by filtering, decimation and down-casting.
+
+    The supported steps are:
+
+    * bandpass_fir, bandpass_iir - Filters each channel. Parameters are the same as for
+      :py:class:`preprocess.pre_bandpass.pre_bandpass_fir` and
+      :py:class:`preprocess.pre_bandpass.pre_bandpass_iir`. The mean of each channel is
+      kept, so that the processor can still normalize the data.
+    * decimate - Keeps every q-th sample after applying an anti-aliasing filter.
+      q needs to divide the number of samples per chunk.
+    * downcast - Converts data to dtype, f.ex. float32.
+    """
+
+    def __init__(self, cfg_reduction):
+        """Configures the reduction steps.
+
+        Args:
+            cfg_reduction (dict):
+                Reduction section of the configuration
+
+        Returns:
+            None
+
+        Raises:
+            NameError:
+                If a step can not be matched to a reduction routine.
+            ValueError:
+                If channel_select is requested. See the module docstring.
+        """
+        self.logger = logging.getLogger("simple")
+        self.cfg = cfg_reduction
+        self.steps = []
+        # Decimation factor, applied to the sampling rate in update_attrs
+        self.q = 1
+        for key, params in cfg_reduction.items():
+            if key in ["bandpass_fir", "bandpass_iir"]:
+                # The filter design routines modify their parameters
+                self.sos = get_preprocess_routine(key, copy.deepcopy(params)).sos
+                self.steps.append(self._bandpass)
+            elif key == "decimate":
+                self.q = int(params["q"])
+                self.steps.append(self._decimate)
+            elif key == "channel_select":
+                raise ValueError("channel_select is not supported in the reduction: " +
+                                 "analysis tasks index channels of the full ECEI array")
+            elif key == "downcast":
+                self.dtype = np.dtype(params["dtype"])
+                self.steps.append(self._downcast)
+            else:
+                raise NameError(f"Requested invalid reduction routine: {key}")
+            self.logger.info(f"Added {key} to reduction")
+
+    def _bandpass(self, data):
+        """Bandpass-filters each channel, keeping the mean."""
+        data_mean = data.mean(axis=-1, keepdims=True)
+        return sosfiltfilt(self.sos, data, axis=-1) + data_mean
+
+    def _decimate(self, data):
+        """Decimates by a factor q."""
+        if data.shape[-1] % self.q != 0:
+            raise ValueError(f"Decimation factor {self.q} does not divide " +
+                             f"{data.shape[-1]} samples")
+        return decimate(data, self.q, ftype="fir", axis=-1, zero_phase=True)
+
+    def _downcast(self, data):
+        """Converts data to a narrower data type."""
+        return data.astype(self.dtype)
+
+    def process(self, data):
+        """Applies all reduction steps.
+
+        Args:
+            data (ndarray):
+                Data of a step, with shape (channels, samples)
+
+        Returns:
+            data (ndarray):
+                Reduced data. A new, contiguous array.
+        """
+        for step in self.steps:
+            data = step(data)
+        return np.ascontiguousarray(data)
+
+    def update_attrs(self, stream_attrs):
+        """Returns stream attributes that describe the reduced stream.
+
+        The sampling rate is divided by the decimation factor and the reduction
+        configuration is stored as stream_attrs['reduction'].
+
+        Args:
+            stream_attrs (dict):
+                Attributes of the incoming stream
+
+        Returns:
+            stream_attrs (dict):
+                Attributes of the reduced stream
+        """
+        stream_attrs = copy.deepcopy(stream_attrs)
+        stream_attrs["SampleRate"] = stream_attrs["SampleRate"] / self.q
+        stream_attrs["reduction"] = copy.deepcopy(self.cfg)
+        return stream_attrs
+
+
+# End of file reduction.py
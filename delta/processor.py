@@ -8,14 +8,22 @@ srun -n 4 python -m mpi4py.futures processor_mpi_tasklist.py --config configs/te
 Remember to have adios2 included in $PYTHONPATH
 
 This is the streaming_attrs branch.
+
+Each entry in diagnostic.datasource.channel_range is received on a separate stream, with
+one reader thread per stream. Chunks of all streams are consumed from a single queue,
+oldest chunk first, and share the pre-processing and analysis executors.
 """
 
 from mpi4py import MPI
 
+import os
+import math
 import logging
 import logging.config
 import time
+import copy
 import queue
+import itertools
 import threading
 import json
 import yaml
@@ -26,17 +34,27 @@ from mpi4py.futures import MPIPoolExecutor
 
 from preprocess.preprocess import preprocessor
 from analysis.task_list import tasklist
-from streaming.reader_mpi import reader_gen
-from data_models.helpers import gen_channel_name, gen_var_name, data_model_generator
+from analysis.completion import chunk_tracker
+from analysis.locality import locality_dispatcher
+from streaming.helpers import get_reader
+from streaming.tracing import get_tracer
+from data_models.helpers import gen_channel_name, gen_var_name, gen_stream_cfgs
+from data_models.helpers import data_model_generator
 from storage.backend import get_storage_object
 
 
-def consume(Q, my_task_list, my_preprocessor):
+def consume(Q, task_lists, preprocessors, tracker, dispatchers=None):
     """Dispatch work items from the queue on an executor.
 
-    Executed by a local thread.
+    Executed by a local thread. Items are (chunk_idx, seq, stream_idx, timechunk) tuples.
+    The thread exits when it gets a stop item, see :py:func:`stop_consumers`.
+    Each stream has its own preprocessor and analysis tasklist. The futures of the
+    analysis tasks of each chunk are added to tracker.
+    If dispatchers are given, raw chunks are pre-processed on the analysis workers,
+    see :py:mod:`analysis.locality`.
     """
     logger = logging.getLogger('simple')
+    tracer = get_tracer()
 
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
@@ -44,25 +62,116 @@ def consume(Q, my_task_list, my_preprocessor):
     logger.info("Starting consume")
 
     while True:
-        try:
-            msg = Q.get(timeout=2.0)
-        except queue.Empty:
-            logger.info("Empty queue after waiting until time-out. Exiting")
+        _, _, stream_idx, msg = Q.get()
+        if msg is None:
+            logger.info("All streams have ended. Exiting")
+            Q.task_done()
             break
 
-        logger.info(f"Rank {rank}: Consumed: {msg.tb} Got data type {type(msg)}")
-        msg = my_preprocessor.submit(msg)
-        my_task_list.execute(msg)
+        logger.info(f"Rank {rank}: Consumed: {msg.tb} from stream {stream_idx} " +
+                    f"Got data type {type(msg)}")
+        if dispatchers is not None:
+            with tracer.span("dispatch", msg.tb.chunk_idx, stream=stream_idx):
+                futures = dispatchers[stream_idx].execute(msg)
+        else:
+            with tracer.span("preprocess", msg.tb.chunk_idx, stream=stream_idx):
+                msg = preprocessors[stream_idx].submit(msg)
+            with tracer.span("dispatch", msg.tb.chunk_idx, stream=stream_idx):
+                futures = task_lists[stream_idx].execute(msg)
+        tracker.add_chunk(msg.tb.chunk_idx, futures, stream_idx)
+        logger.info(f"Rank {rank}: {tracker.num_in_flight()} chunks in flight")
         Q.task_done()
 
     logger.info("Task done")
 
 
-def main():
-    """Procesess a stream of data chunks on an executor."""
-    comm = MPI.COMM_WORLD
+def stop_consumers(Q, seq, num_consumers):
+    """Puts a stop item for each consumer thread into the queue.
 
-    # Parse command line arguments and read configuration file
+    Stop items sort after all chunks, so the consumers finish the queued chunks first.
+
+    Args:
+        Q (queue.PriorityQueue):
+            Queue shared by all streams
+        seq (itertools.count):
+            Counter shared by all streams
+        num_consumers (int):
+            Number of threads that execute :py:func:`consume`
+
+    Returns:
+        None
+    """
+    for _ in range(num_consumers):
+        Q.put_nowait((math.inf, next(seq), None, None))
+
+
+def receive(reader, stream_idx, stream_varname, data_model_gen, Q, seq, rx_list):
+    """Reads time chunks from a stream and pushes them into the queue.
+
+    Executed by a local thread for each stream. Q is shared by all streams and
+    ordered by chunk index, so that the oldest chunk across all streams is
+    consumed first. Ties are broken by arrival order, taken from seq.
+
+    Args:
+        reader (reader_gen or reader_shm):
+            Opened reader for the stream
+        stream_idx (int):
+            Index of the stream
+        stream_varname (str):
+            Name of the variable to read
+        data_model_gen (data_model_generator):
+            Creates time chunks from the data of this stream
+        Q (queue.PriorityQueue):
+            Queue shared by all streams
+        seq (itertools.count):
+            Counter shared by all streams
+        rx_list (list):
+            Steps that have been received are appended to this list.
+
+    Returns:
+        None
+    """
+    logger = logging.getLogger('simple')
+    tracer = get_tracer()
+
+    # In a streaming setting, (SST, dataman) attributes can only be accessed after
+    # reading the first time step of a variable.
+    # Initialize stream_attrs with None and load it in the main loop below.
+    stream_attrs = None
+
+    while True:
+        t_begin = time.time()
+        stepStatus = reader.BeginStep(timeoutSeconds=5.0)
+        if stepStatus:
+            # Load attributes
+            if stream_attrs is None:
+                logger.info(f"Stream {stream_idx}: Waiting for attributes")
+                stream_attrs = reader.get_attrs("stream_attrs")
+                logger.info(f"Stream {stream_idx}: Got attributes: {stream_attrs}")
+            # Read data. new_chunk copies the data, so it doesn't need to outlive the step.
+            stream_data = reader.Get(stream_varname, save=False, copy=False)
+            rx_list.append(reader.CurrentStep())
+
+            # Use the chunk index of the trace context, if the writer sends one.
+            chunk_idx = reader.CurrentStep()
+            trace_ctx = reader.get_trace()
+            if trace_ctx is not None:
+                chunk_idx, t_send = trace_ctx
+                tracer.add_span("transport", chunk_idx, t_send, time.time(), stream=stream_idx)
+
+            # Create a datamodel instance from the raw data and push into the queue
+            msg = data_model_gen.new_chunk(stream_data, stream_attrs, chunk_idx)
+            Q.put_nowait((chunk_idx, next(seq), stream_idx, msg))
+            logger.info(f"Stream {stream_idx}: Published tidx {reader.CurrentStep()}")
+            reader.EndStep()
+            tracer.add_span("receive", chunk_idx, t_begin, time.time(), stream=stream_idx)
+        else:
+            logger.info(f"Stream {stream_idx}: Exiting: StepStatus={stepStatus}")
+            break
+
+
+def parse_args():
+    """Parses the command line arguments."""
     parser = argparse.ArgumentParser(description="Receive data and dispatch analysis" +
                                      "tasks to a mpi queue")
     parser.add_argument('--config', type=str, help='Lists the configuration file',
@@ -82,8 +191,119 @@ def main():
     parser.add_argument("--run_id", type=str,
                         help="Name of database collection to store analysis results in",
                         required=True)
+    parser.add_argument("--locality", action="store_true",
+                        help="Pre-process time chunks on the analysis workers and send " +
+                        "raw data instead of Fourier coefficients")
+    parser.add_argument("--locality_shares", type=int,
+                        help="With --locality, number of shares per analysis worker that " +
+                        "the batches of a time chunk are split into",
+                        default=2)
+    return parser.parse_args()
+
+
+def open_readers(cfg_transport, stream_cfgs):
+    """Opens a reader for each stream.
+
+    Args:
+        cfg_transport (dict):
+            Transport section of the configuration
+        stream_cfgs (list of dict):
+            Configuration of each stream, see :py:func:`data_models.helpers.gen_stream_cfgs`
+
+    Returns:
+        reader_list (list):
+            Opened readers, one for each stream
+    """
+    # TODO: (RMC)  Should this be moved to where cfg updated?
+    # (would allow updating channels to process remotely)
+    reader_list = []
+    for stream_cfg in stream_cfgs:
+        reader = get_reader(cfg_transport, gen_channel_name(stream_cfg["diagnostic"]))
+        reader.Open()
+        reader_list.append(reader)
+    return reader_list
+
+
+def create_dispatchers(args, stream_cfgs, executor_pre, executor_anl):
+    """Creates the pre-processing and analysis of each stream.
+
+    Args:
+        args (argparse.Namespace):
+            Command line arguments
+        stream_cfgs (list of dict):
+            Configuration of each stream
+        executor_pre (PoolExecutor):
+            Executor for pre-processing
+        executor_anl (PoolExecutor):
+            Executor for data analysis
+
+    Returns:
+        preprocessor_list (list of preprocessor):
+            Pre-processing of each stream
+        task_list_list (list of tasklist):
+            Analysis tasks of each stream
+        dispatcher_list (list of locality_dispatcher):
+            Dispatchers that pre-process on the analysis workers if args.locality is set.
+            Otherwise None.
+    """
+    logger = logging.getLogger('simple')
 
-    args = parser.parse_args()
+    # Adaptive batching splits the channel pairs of a chunk over the analysis workers
+    for stream_cfg in stream_cfgs:
+        for anl_params in stream_cfg["analysis"].values():
+            if "adaptive_batching" in anl_params:
+                anl_params["adaptive_batching"].setdefault("num_workers",
+                                                           args.num_ranks_analysis)
+
+    # Pre-processing routines may modify their parameters. Workers instantiate them from a copy.
+    cfg_preprocess_list = [copy.deepcopy(stream_cfg["preprocess"]) for stream_cfg in stream_cfgs]
+    preprocessor_list = [preprocessor(executor_pre, stream_cfg) for stream_cfg in stream_cfgs]
+    task_list_list = [tasklist(executor_anl, stream_cfg) for stream_cfg in stream_cfgs]
+    dispatcher_list = None
+    if args.locality:
+        dispatcher_list = [locality_dispatcher(executor_anl, args.num_ranks_analysis,
+                                               cfg_preprocess, my_task_list, my_preprocessor,
+                                               args.locality_shares)
+                           for cfg_preprocess, my_task_list, my_preprocessor
+                           in zip(cfg_preprocess_list, task_list_list, preprocessor_list)]
+        logger.info("Pre-processing time chunks on the analysis workers")
+    return preprocessor_list, task_list_list, dispatcher_list
+
+
+def report(run_id, dt_main, tracker, stream_cfgs, reader_list, rx_lists):
+    """Logs a summary of the run and closes the statistics of the readers.
+
+    Args:
+        run_id (str):
+            Name of the run
+        dt_main (float):
+            Duration of the main loop, in seconds
+        tracker (chunk_tracker):
+            Records the analysis of each chunk
+        stream_cfgs (list of dict):
+            Configuration of each stream
+        reader_list (list):
+            Reader of each stream
+        rx_lists (list of list):
+            Steps received on each stream
+
+    Returns:
+        None
+    """
+    logger = logging.getLogger('simple')
+    logger.info(f"Run {run_id} finished in {dt_main:6.4f}s")
+    logger.info(tracker.summary())
+    for stream_cfg, reader, rx_list in zip(stream_cfgs, reader_list, rx_lists):
+        logger.info(f"{gen_channel_name(stream_cfg['diagnostic'])}: " +
+                    f"Processed {len(rx_list)} time_chunks: {rx_list}")
+        logger.info(reader.transfer_stats())
+        reader.stats.close()
+
+
+def main():
+    """Procesess a stream of data chunks on an executor."""
+    # Parse command line arguments and read configuration file
+    args = parse_args()
 
     with open(args.config, "r") as df:
         cfg = json.load(df)
@@ -95,13 +315,18 @@ def main():
         log_cfg = yaml.safe_load(f.read())
     logging.config.dictConfig(log_cfg)
     logger = logging.getLogger('simple')
+    tracer = get_tracer(cfg.get("tracing", None), "processor")
 
     # PoolExecutor for pre-processing, on-node.
     executor_pre = ThreadPoolExecutor(max_workers=args.num_ranks_preprocess)
+    # Kernel profiling on the analysis workers, see analysis.profiling. Disabled by default.
+    worker_env = {}
+    if "profiling" in cfg:
+        os.makedirs(cfg["profiling"]["basedir"], exist_ok=True)
+        worker_env["DELTA_PROFILE_DIR"] = cfg["profiling"]["basedir"]
+        os.environ.update(worker_env)
     # PoolExecutor for data analysis. off-node
-    executor_anl = MPIPoolExecutor(max_workers=args.num_ranks_analysis)
-
-    stream_varname = gen_var_name(cfg)[0]
+    executor_anl = MPIPoolExecutor(max_workers=args.num_ranks_analysis, env=worker_env)
 
     cfg["run_id"] = args.run_id
     cfg["storage"]["run_id"] = cfg["run_id"]
@@ -112,55 +337,48 @@ def main():
     store_backend = store_type(cfg["storage"])
     store_backend.store_one({"run_id": cfg['run_id'], "run_config": cfg})
 
-    # TODO: (RMC)  Should this be moved to where cfg updated? 
-    # (would allow updating channels to process remotely)
-    reader = reader_gen(cfg[args.transport], gen_channel_name(cfg["diagnostic"]))
-    reader.Open()
+    # Each channel range is received on a separate stream, f.ex. from a generator for each
+    # ECEI device. All streams share the executors and the queue.
+    stream_cfgs = gen_stream_cfgs(cfg)
+    reader_list = open_readers(cfg[args.transport], stream_cfgs)
 
-    dq = queue.Queue()
+    dq = queue.PriorityQueue()
+    seq = itertools.count()
 
-    # In a streaming setting, (SST, dataman) attributes can only be accessed after
-    # reading the first time step of a variable. 
-    # Initialize stream_attrs with None and load it in the main loop below.
-    stream_attrs = None 
-
-    data_model_gen = data_model_generator(cfg["diagnostic"])
-    my_preprocessor = preprocessor(executor_pre, cfg)
-    my_task_list = tasklist(executor_anl, cfg)
+    preprocessor_list, task_list_list, dispatcher_list = \
+        create_dispatchers(args, stream_cfgs, executor_pre, executor_anl)
+    # Records when the analysis of each chunk is complete
+    tracker = chunk_tracker(cfg.get("completion", None))
+    tracker.add_callback(lambda record: tracer.add_span("analysis", record["chunk_idx"],
+                                                        record["t_submit"],
+                                                        record["t_submit"] + record["duration"],
+                                                        stream=record["stream_idx"],
+                                                        status=record["status"]))
 
     worker_thread_list = []
     for _ in range(args.num_queue_threads):
-        new_worker = threading.Thread(target=consume, args=(dq, my_task_list, my_preprocessor))
+        new_worker = threading.Thread(target=consume,
+                                      args=(dq, task_list_list, preprocessor_list, tracker,
+                                            dispatcher_list))
         new_worker.start()
         worker_thread_list.append(new_worker)
 
-    logger.info("Starting main loop")
+    logger.info(f"Starting main loop for {len(stream_cfgs)} streams")
     tic_main = time.perf_counter()
-    rx_list = []
-    while True:
-        stepStatus = reader.BeginStep(timeoutSeconds=5.0)
-        if stepStatus:
-            # Load attributes
-            if stream_attrs is None:
-                logger.info("Waiting for attributes")
-                stream_attrs = reader.get_attrs("stream_attrs")
-                logger.info(f"Got attributes: {stream_attrs}")
-            # Read data
-            stream_data = reader.Get(stream_varname, save=False)
-            # if reader.CurrentStep() in [0, 140]:
-            rx_list.append(reader.CurrentStep())
-
-            # Create a datamodel instance from the raw data and push into the queue
-            msg = data_model_gen.new_chunk(stream_data, stream_attrs, reader.CurrentStep())
-            dq.put_nowait(msg)
-            logger.info(f"Published tidx {reader.CurrentStep()}")
-            reader.EndStep()
-        else:
-            logger.info(f"Exiting: StepStatus={stepStatus}")
-            break
-        
-        # if reader.CurrentStep() > 5:
-        #     break
+    rx_lists = [[] for _ in stream_cfgs]
+    reader_thread_list = []
+    for stream_idx, (reader, stream_cfg) in enumerate(zip(reader_list, stream_cfgs)):
+        new_reader = threading.Thread(target=receive,
+                                      args=(reader, stream_idx, gen_var_name(stream_cfg)[0],
+                                            data_model_generator(stream_cfg["diagnostic"]),
+                                            dq, seq, rx_lists[stream_idx]))
+        new_reader.start()
+        reader_thread_list.append(new_reader)
+
+    for thr in reader_thread_list:
+        thr.join()
+    # All streams have ended. Let the consumers exit after the queued chunks.
+    stop_consumers(dq, seq, args.num_queue_threads)
 
     dq.join()
     logger.info("Queue joined")
@@ -170,15 +388,17 @@ def main():
         thr.join()
 
     logger.info("Workers have joined")
+    for my_preprocessor in preprocessor_list:
+        my_preprocessor.flush_metadata()
 
     # Shutdown the executioner
     executor_anl.shutdown(wait=True)
     executor_pre.shutdown(wait=True)
     # executor.shutdown(wait=True)
 
-    toc_main = time.perf_counter()
-    logger.info(f"Run {cfg['run_id']} finished in {(toc_main - tic_main):6.4f}s")
-    logger.info(f"Processed {len(rx_list)} time_chunks: {rx_list}")
+    report(cfg["run_id"], time.perf_counter() - tic_main, tracker, stream_cfgs, reader_list,
+           rx_lists)
+    tracer.flush()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,18 @@
 # -*- Encoding: UTF-8 -*-
 
 from sources.loader_kstarecei import loader_kstarecei
+from sources.loader_memmap import loader_memmap
+from sources.loader_kstarecei_multi import loader_kstarecei_multi
 
 
 def get_loader(cfg_all):
     """Returns data loader for diagnostic defined in cfg['diagnostic']['name']
 
+    Shots that were converted with :py:func:`sources.loader_memmap.convert_to_memmap`
+    are loaded when cfg['diagnostic']['datasource']['format'] is 'memmap'.
+    If cfg['diagnostic']['datasource']['source_file'] is a list, all devices are
+    loaded together.
+
     Args:
         cfg_all (dict):
             Configuration dictionary
@@ -15,6 +22,10 @@ def get_loader(cfg_all):
             Dataloader object
     """
     if cfg_all["diagnostic"]["name"] == "kstarecei":
+        if cfg_all["diagnostic"]["datasource"].get("format", "hdf5") == "memmap":
+            return loader_memmap(cfg_all)
+        if isinstance(cfg_all["diagnostic"]["datasource"]["source_file"], list):
+            return loader_kstarecei_multi(cfg_all)
         return loader_kstarecei(cfg_all)
     else:
         raise ValueError("No dataloader for " + cfg_all["diagnostic"]["name"])
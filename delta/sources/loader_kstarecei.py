@@ -7,11 +7,13 @@ import numpy as np
 import h5py
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 # from tqdm import tqdm
 
 from data_models.kstar_ecei import ecei_chunk, channel_range_from_str
 from data_models.timebase import timebase_streaming
+from sources.prefetch import chunk_prefetcher
 
 
 class loader_kstarecei():
@@ -32,6 +34,13 @@ class loader_kstarecei():
             * diagnostic.datasource.chunk_size - Number of samples per chunk
             * diagnostic.datahsour.num_chunks - Total number of chunks to load
             * diagnostic.datasource.datatype - Numerical type to use for data
+            * diagnostic.datasource.num_read_threads - Number of threads that read channels
+              from HDF5 concurrently. Optional, defaults to 1. Note that h5py serializes
+              calls into the HDF5 library.
+            * diagnostic.datasource.cache - If true, load all chunks when the loader is
+              instantiated. If false, read chunks while streaming. Optional, defaults to true.
+            * diagnostic.datasource.prefetch - Number of chunks read ahead when not caching.
+              Optional, defaults to 2.
 
 
         Glossary example... :term:`foobar.a1`
@@ -39,6 +48,12 @@ class loader_kstarecei():
         """
         self.ch_range = channel_range_from_str(cfg_all["diagnostic"]["datasource"]
                                                ["channel_range"][0])
+        # Number of vertical and horizontal channels in the range
+        self.num_v = self.ch_range.ch_vf - self.ch_range.ch_vi + 1
+        self.num_h = self.ch_range.ch_hf - self.ch_range.ch_hi + 1
+        # Row of each channel in the data array, keyed by the linear channel index.
+        # Rows and channel indices only coincide when loading the full range.
+        self.ch_rows = {ch.get_idx(): row for row, ch in enumerate(self.ch_range)}
         # Create a list of paths in the HDF5 file, corresponding to the specified channels
         self.filename = cfg_all["diagnostic"]["datasource"]["source_file"]
         # Number of samples in a chunk
@@ -46,6 +61,8 @@ class loader_kstarecei():
         # Total number of chunks
         self.num_chunks = cfg_all["diagnostic"]["datasource"]["num_chunks"]
         self.current_chunk = 0
+        # Number of threads used to read channels concurrently from the HDF5 file.
+        self.num_read_threads = cfg_all["diagnostic"]["datasource"].get("num_read_threads", 1)
 
         if cfg_all["diagnostic"]["datasource"]["datatype"] == "int":
             self.dtype = np.int32
@@ -62,8 +79,10 @@ class loader_kstarecei():
         self.logger = logging.getLogger('simple')
 
         # Whether we use caching for loading data
-        self.cache()
-        self.is_cached = True
+        self.is_cached = cfg_all["diagnostic"]["datasource"].get("cache", True)
+        self.prefetch_depth = cfg_all["diagnostic"]["datasource"].get("prefetch", 2)
+        if self.is_cached:
+            self.cache()
 
     def _read_attributes_from_hdf5(self):
         """Reads attributes from HDF5.
@@ -86,7 +105,9 @@ class loader_kstarecei():
                     # If it is f.ex an ndarray convert it to a list.
                     new_attr = dset[attr_name]
                     if isinstance(new_attr, np.ndarray):
-                        new_attr = list(new_attr)
+                        new_attr = new_attr.tolist()
+                    if isinstance(new_attr, np.generic):
+                        new_attr = new_attr.item()
                     if isinstance(new_attr, bytes):
                         new_attr = new_attr.strip().decode('utf-8')
                     self.attrs.update({attr_name: new_attr})
@@ -99,10 +120,43 @@ class loader_kstarecei():
             self.attrs["SampleRate"] = self.attrs["SampleRate"][0] * 1e3
             # self.attrs["Mode"] = self.attrs["Mode"].strip().decode()
 
+    def _read_channels_from_hdf5(self, array, ch_list, idx_start, idx_end, df=None):
+        """Reads a list of channels from HDF5 directly into array.
+
+        Data is read into the pre-allocated rows of array without intermediate copies
+        and scaled in-place while the row is still in cache.
+
+        Args:
+            array (np.ndarray):
+                Array where we store HDF5 data
+            ch_list (list of channel_2d):
+                Channels to read
+            idx_start (int):
+                First index to read
+            idx_end (int):
+                Last index to read
+            df (h5py.File):
+                Open handle of the HDF5 file. If None, the file is opened for this call.
+
+        Returns:
+            None
+        """
+        if df is None:
+            with h5py.File(self.filename, "r") as df:
+                self._read_channels_from_hdf5(array, ch_list, idx_start, idx_end, df)
+            return
+
+        for ch in ch_list:
+            chname_h5 = f"/ECEI/ECEI_{self.attrs['dev']}{ch.ch_v:02d}{ch.ch_h:02d}/Voltage"
+            row = self.ch_rows[ch.get_idx()]
+            df[chname_h5].read_direct(array, np.s_[idx_start:idx_end], np.s_[row, :])
+            np.multiply(array[row, :], 1e-4, out=array[row, :], casting="unsafe")
+
     def _read_from_hdf5(self, array, idx_start, idx_end):
         """Reads data from HDF5 into array.
 
-        Values in array are changed in-place.
+        Values in array are changed in-place. Channels are distributed over
+        num_read_threads threads. Each thread uses its own file handle.
 
         Args:
             array (np.ndarray):
@@ -115,12 +169,17 @@ class loader_kstarecei():
         Returns:
             None
         """
-        # Cache the data in memory
-        with h5py.File(self.filename, "r",) as df:
-            for ch in self.ch_range:
-                chname_h5 = f"/ECEI/ECEI_{self.attrs['dev']}{ch.ch_v:02d}{ch.ch_h:02d}/Voltage"
-                array[ch.get_idx(), :] = df[chname_h5][idx_start:idx_end].astype(self.dtype)
-        array[:] = array[:] * 1e-4
+        ch_list = list(self.ch_range)
+        if self.num_read_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.num_read_threads) as executor:
+                futures = [executor.submit(self._read_channels_from_hdf5, array,
+                                           ch_list[i::self.num_read_threads], idx_start, idx_end)
+                           for i in range(self.num_read_threads)]
+                # Re-raise exceptions from the reader threads
+                for fut in futures:
+                    fut.result()
+        else:
+            self._read_channels_from_hdf5(array, ch_list, idx_start, idx_end)
 
     def cache(self):
         """Loads data from HDF5 and fills the cache.
@@ -158,37 +217,50 @@ class loader_kstarecei():
             chunk (ecei_chunk)
                 ECEI data from current time chunk, possibly normalized
         """
-        # Pre-allocate temp array in case we are running non-cached.
-        # See if clause in for-loop below
-        if not self.is_cached:
-            _chunk_data = np.zeros([self.ch_range.length(), self.chunk_size], dtype=self.dtype)
-
-        for current_chunk in range(self.num_chunks):
-            # Generate a time-base for the current chunk
-            # Use start-time stored in attrs['TriggerTime'][0]
-            # Use end-time stored in attrs['TriggerTime'][1]
-            tend = min(self.attrs['TriggerTime'][1],
-                       self.attrs['TriggerTime'][0] + 5_000_000 / self.attrs['SampleRate'])
-            tb_chunk = timebase_streaming(self.attrs['TriggerTime'][0],
-                                          tend,
-                                          self.attrs['SampleRate'],
-                                          self.chunk_size, current_chunk)
-
-            # Load current time-chunk from HDF5 file
-            # IF we are running cached, use the data from cache.
-            if self.is_cached:
+        if self.is_cached:
+            for current_chunk in range(self.num_chunks):
                 _chunk_data = self.cache[:, current_chunk *
                                          self.chunk_size:
                                          (current_chunk + 1) *
                                          self.chunk_size]
+                yield ecei_chunk(_chunk_data, self._get_timebase(current_chunk), params=self.attrs,
+                                 num_v=self.num_v, num_h=self.num_h)
+
+        # If we haven't cached, load from HDF5. Chunks are read ahead in a background thread.
+        # The buffer of a chunk is re-used once the consumer requests the next chunk.
+        else:
+            def read_chunk(array, chunk_idx):
+                self._read_from_hdf5(array, chunk_idx * self.chunk_size,
+                                     (chunk_idx + 1) * self.chunk_size)
+
+            prefetcher = chunk_prefetcher(read_chunk, self.get_chunk_shape(), self.dtype,
+                                          self.num_chunks, self.prefetch_depth)
+            try:
+                for current_chunk, buf_idx, _chunk_data in prefetcher:
+                    yield ecei_chunk(_chunk_data, self._get_timebase(current_chunk),
+                                     params=self.attrs, num_v=self.num_v, num_h=self.num_h)
+                    prefetcher.release(buf_idx)
+            finally:
+                prefetcher.stop()
+
+    def _get_timebase(self, current_chunk):
+        """Generates a time-base for a chunk.
+
+        Uses start-time stored in attrs['TriggerTime'][0] and
+        end-time stored in attrs['TriggerTime'][1]
 
-            # If we haven't cached, load from HDF5
-            else:
-                self._read_from_hdf5(_chunk_data, current_chunk * self.chunk_size,
-                                     (current_chunk + 1) * self.chunk_size)
+        Args:
+            current_chunk (int):
+                Index of the chunk
 
-            current_chunk = ecei_chunk(_chunk_data, tb_chunk, params=self.attrs)
-            yield current_chunk
+        Returns:
+            tb_chunk (timebase_streaming):
+                Time-base for the chunk
+        """
+        tend = min(self.attrs['TriggerTime'][1],
+                   self.attrs['TriggerTime'][0] + 5_000_000 / self.attrs['SampleRate'])
+        return timebase_streaming(self.attrs['TriggerTime'][0], tend, self.attrs['SampleRate'],
+                                  self.chunk_size, current_chunk)
 
 # End of file loader_kstarecei.py
 
@@ -0,0 +1,124 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Loader that streams multiple KSTAR ECEI devices in a single pass."""
+
+import logging
+
+import h5py
+
+from data_models.kstar_ecei import ecei_chunk
+from sources.loader_kstarecei import loader_kstarecei
+from sources.prefetch import chunk_prefetcher
+
+
+class loader_kstarecei_multi():
+    """Loads aligned time-chunks from the HDF5 files of multiple ECEI devices, f.ex. L, G, and H.
+
+    Each device is described by a :py:class:`sources.loader_kstarecei.loader_kstarecei`.
+    All device files are opened once. For each time step, the same hyperslab is read from
+    every file into a single pre-allocated buffer. The batch generator yields a list with one
+    ecei_chunk per device.
+    """
+
+    def __init__(self, cfg_all):
+        """Initializes the multi-device dataloader.
+
+        Args:
+            cfg_all: (dict):
+                Global Delta configuration
+
+        Returns:
+            None
+
+        Used keys from cfg_all:
+            * diagnostic.datasource.source_file - List of HDF5 files, one per device
+            * diagnostic.datasource.channel_range - List of channel ranges, one per device
+            * diagnostic.datasource.prefetch - Number of time steps read ahead.
+              Optional, defaults to 2.
+            * All other keys used by :py:class:`sources.loader_kstarecei.loader_kstarecei`
+
+        Raises:
+            ValueError:
+                If the number of files and channel ranges don't match, or if the devices
+                have different chunk shapes.
+        """
+        self.logger = logging.getLogger('simple')
+        cfg_ds = cfg_all["diagnostic"]["datasource"]
+        if len(cfg_ds["source_file"]) != len(cfg_ds["channel_range"]):
+            raise ValueError("loader_kstarecei_multi: Need one channel_range per source_file.")
+
+        # Instantiate a streaming loader for each device.
+        self.loaders = []
+        for source_file, channel_range in zip(cfg_ds["source_file"], cfg_ds["channel_range"]):
+            cfg_dev = {**cfg_all, "diagnostic": {**cfg_all["diagnostic"]}}
+            cfg_dev["diagnostic"]["datasource"] = {**cfg_ds, "source_file": source_file,
+                                                   "channel_range": [channel_range],
+                                                   "cache": False}
+            self.loaders.append(loader_kstarecei(cfg_dev))
+
+        # Each device is streamed on its own stream, see data_models.helpers.gen_stream_cfgs.
+        # Its variable is named after its channel range.
+        self.var_names = list(cfg_ds["channel_range"])
+        # Stream attributes of each device, keyed by variable name
+        self.attrs = {var_name: loader.attrs
+                      for var_name, loader in zip(self.var_names, self.loaders)}
+
+        if len(set([loader.get_chunk_shape() for loader in self.loaders])) > 1:
+            raise ValueError("loader_kstarecei_multi: All devices need the same chunk shape.")
+        self.chunk_size = self.loaders[0].chunk_size
+        self.num_chunks = self.loaders[0].num_chunks
+        self.dtype = self.loaders[0].dtype
+        self.prefetch_depth = cfg_ds.get("prefetch", 2)
+
+    def get_chunk_shape(self):
+        """Returns the size of chunks of a single device.
+
+        Args:
+            None
+
+        Returns:
+            chunk_shape (tuple [int, int]):
+                (Number of channels, time chunk size)
+        """
+        return self.loaders[0].get_chunk_shape()
+
+    def batch_generator(self):
+        """Loads the next time-chunk of all devices.
+
+        Data of a time step is read by a background thread while the previous time step is
+        being sent. The chunks are valid until the next time step is requested.
+
+        >>> for chunk_list in loader.batch_generator():
+        >>>    for var_name, chunk in zip(loader.var_names, chunk_list):
+        >>>        type(chunk) = ecei_chunk
+
+        Returns:
+            chunk_list (list of ecei_chunk)
+                ECEI data of each device for the current time chunk
+        """
+        ch_lists = [list(loader.ch_range) for loader in self.loaders]
+        h5files = [h5py.File(loader.filename, "r") for loader in self.loaders]
+
+        def read_chunk(array, chunk_idx):
+            # Note that h5py serializes calls into the HDF5 library. Reading the devices from
+            # multiple threads would not be faster than reading them one after the other.
+            for loader, ch_list, df, array_dev in zip(self.loaders, ch_lists, h5files, array):
+                loader._read_channels_from_hdf5(array_dev, ch_list, chunk_idx * self.chunk_size,
+                                                (chunk_idx + 1) * self.chunk_size, df)
+
+        prefetcher = chunk_prefetcher(read_chunk, (len(self.loaders), ) + self.get_chunk_shape(),
+                                      self.dtype, self.num_chunks, self.prefetch_depth)
+        try:
+            for current_chunk, buf_idx, _chunk_data in prefetcher:
+                yield [ecei_chunk(_chunk_data[dev_idx], loader._get_timebase(current_chunk),
+                                  params=loader.attrs, num_v=loader.num_v, num_h=loader.num_h,
+                                  copy=False)
+                       for dev_idx, loader in enumerate(self.loaders)]
+                prefetcher.release(buf_idx)
+        finally:
+            prefetcher.stop()
+            for df in h5files:
+                df.close()
+
+
+# End of file loader_kstarecei_multi.py
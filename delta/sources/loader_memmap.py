@@ -0,0 +1,174 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Loader for shots that were converted into memory-mapped .npy files.
+
+Reading a shot from HDF5 decompresses and copies all data each time the shot is read.
+For repeated replay and benchmark runs, a shot can be converted once into a raw .npy file
+using :py:func:`convert_to_memmap`. The file stores all chunks back-to-back, with
+shape=(num_chunks, num_channels, chunk_size), so that every time chunk is a contiguous
+block of memory. The stream attributes are stored in a JSON sidecar file.
+
+.. code-block:: python
+
+    convert_to_memmap(cfg_all, "/scratch/ECEI.022289.GT.npy")
+
+"""
+
+import json
+import logging
+
+import numpy as np
+
+from data_models.kstar_ecei import ecei_chunk, channel_range_from_str
+from data_models.timebase import timebase_streaming
+
+
+def get_sidecar_name(filename):
+    """Returns the name of the JSON sidecar file for a .npy file.
+
+    Args:
+        filename (str):
+            Name of the .npy file
+
+    Returns:
+        sidecar_name (str):
+            filename, with the suffix .npy replaced by .json
+    """
+    if filename.endswith(".npy"):
+        filename = filename[:-4]
+    return filename + ".json"
+
+
+def convert_to_memmap(cfg_all, filename, dtype=np.float32):
+    """Converts the data source defined in cfg_all into a .npy file with JSON sidecar.
+
+    Data is read chunk-wise, using the loader defined in cfg_all, and written into
+    a memory-mapped file. Memory use is bounded by a few chunks.
+
+    Args:
+        cfg_all (dict):
+            Global Delta configuration. Defines the data source to convert.
+        filename (str):
+            Name of the .npy file to write.
+        dtype (type):
+            Data type used in the .npy file. Defaults to np.float32.
+
+    Returns:
+        None
+    """
+    from sources.loader_kstarecei import loader_kstarecei
+
+    cfg_src = {**cfg_all, "diagnostic": {**cfg_all["diagnostic"]}}
+    cfg_src["diagnostic"]["datasource"] = {**cfg_all["diagnostic"]["datasource"], "cache": False}
+    loader = loader_kstarecei(cfg_src)
+
+    shape = (loader.num_chunks, ) + loader.get_chunk_shape()
+    data = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+    for chunk in loader.batch_generator():
+        data[chunk.tb.chunk_idx, :, :] = chunk.data[:]
+    data.flush()
+    del data
+
+    sidecar = {"attrs": loader.attrs,
+               "channel_range": cfg_all["diagnostic"]["datasource"]["channel_range"][0],
+               "chunk_size": loader.chunk_size,
+               "num_chunks": loader.num_chunks}
+    with open(get_sidecar_name(filename), "w") as df:
+        # Attributes read from HDF5 may be numpy scalars
+        json.dump(sidecar, df, default=lambda obj: obj.item())
+
+
+class loader_memmap():
+    """Loads time-chunks from a memory-mapped .npy file, see :py:func:`convert_to_memmap`."""
+
+    def __init__(self, cfg_all):
+        """Initializes the memory-mapped dataloader.
+
+        Args:
+            cfg_all: (dict):
+                Global Delta configuration
+
+        Returns:
+            None
+
+        Used keys from cfg_all:
+            * diagnostic.datasource.source_file - Name of the .npy file
+            * diagnostic.datasource.chunk_size - Number of samples per chunk. Needs to match
+              the chunk size used when converting the file.
+            * diagnostic.datasource.num_chunks - Total number of chunks to load
+            * diagnostic.datasource.channel_range - Channels to load. Needs to be contained
+              in the channel range of the file.
+
+        Raises:
+            ValueError:
+                If chunk_size does not match the chunk size of the file, or if the file
+                does not contain all channels of channel_range.
+        """
+        self.logger = logging.getLogger('simple')
+        self.filename = cfg_all["diagnostic"]["datasource"]["source_file"]
+        with open(get_sidecar_name(self.filename), "r") as df:
+            sidecar = json.load(df)
+
+        self.attrs = sidecar["attrs"]
+        file_range = channel_range_from_str(sidecar["channel_range"])
+        self.ch_range = channel_range_from_str(cfg_all["diagnostic"]["datasource"]
+                                               ["channel_range"][0])
+        # Number of vertical and horizontal channels in the range
+        self.num_v = self.ch_range.ch_vf - self.ch_range.ch_vi + 1
+        self.num_h = self.ch_range.ch_hf - self.ch_range.ch_hi + 1
+        self.chunk_size = sidecar["chunk_size"]
+        if cfg_all["diagnostic"]["datasource"]["chunk_size"] != self.chunk_size:
+            raise ValueError(f"chunk_size={cfg_all['diagnostic']['datasource']['chunk_size']} "
+                             f"does not match chunk_size={self.chunk_size} of {self.filename}")
+
+        # Rows of the requested channels in the file
+        file_rows = {ch.get_idx(): row for row, ch in enumerate(file_range)}
+        try:
+            self.rows = np.array([file_rows[ch.get_idx()] for ch in self.ch_range])
+        except KeyError:
+            raise ValueError(f"{self.filename} contains channels {sidecar['channel_range']}, "
+                             f"which do not include all channels of "
+                             f"{cfg_all['diagnostic']['datasource']['channel_range'][0]}")
+        # Consecutive rows, f.ex. a shard of vertical rows, are selected without a copy
+        if np.array_equal(self.rows, np.arange(self.rows[0], self.rows[0] + self.rows.size)):
+            self.rows = slice(self.rows[0], self.rows[0] + self.rows.size)
+
+        self.data = np.load(self.filename, mmap_mode="r")
+        assert(self.data.shape[1:] == (file_range.length(), self.chunk_size))
+        self.num_chunks = min(cfg_all["diagnostic"]["datasource"]["num_chunks"],
+                              self.data.shape[0])
+        self.dtype = self.data.dtype.type
+
+    def get_chunk_shape(self):
+        """Returns the size of chunks.
+
+        Args:
+            None
+
+        Returns:
+            chunk_shape (tuple [int, int]):
+                (Number of channels, time chunk size)
+        """
+        return (self.ch_range.length(), self.chunk_size)
+
+    def batch_generator(self):
+        """Yields time-chunks that point into the memory-mapped file.
+
+        Chunks of a consecutive block of rows in the file are not copied. Their data is
+        read-only.
+
+        Returns:
+            chunk (ecei_chunk)
+                ECEI data from current time chunk
+        """
+        tend = min(self.attrs['TriggerTime'][1],
+                   self.attrs['TriggerTime'][0] + 5_000_000 / self.attrs['SampleRate'])
+        for current_chunk in range(self.num_chunks):
+            tb_chunk = timebase_streaming(self.attrs['TriggerTime'][0], tend,
+                                          self.attrs['SampleRate'], self.chunk_size,
+                                          current_chunk)
+            yield ecei_chunk(self.data[current_chunk, self.rows], tb_chunk, params=self.attrs,
+                             num_v=self.num_v, num_h=self.num_h, copy=False)
+
+
+# End of file loader_memmap.py
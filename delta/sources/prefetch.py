@@ -0,0 +1,123 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Background prefetching of data chunks into a ring of pre-allocated buffers."""
+
+import logging
+import queue
+import threading
+
+import numpy as np
+
+
+class chunk_prefetcher():
+    """Reads data chunks in a background thread into a ring of pre-allocated buffers.
+
+    While the consumer works on chunk N, the background thread reads chunks N+1 ... N+depth.
+    Memory use is bounded by depth + 1 buffers.
+
+    Each buffer is either free, being filled by the reader thread, ready, or owned by
+    the consumer. A buffer returns to the free list only after the consumer releases it.
+
+    .. code-block:: python
+
+        prefetcher = chunk_prefetcher(read_func, (192, 10_000), np.float64, num_chunks)
+        for chunk_idx, buf_idx, data in prefetcher:
+            do_things_with(data)
+            prefetcher.release(buf_idx)
+
+    """
+
+    def __init__(self, read_func, shape, dtype, num_chunks, depth=2):
+        """Allocates buffers and starts the reader thread.
+
+        Args:
+            read_func (callable):
+                Called as read_func(array, chunk_idx). Fills array with data of chunk chunk_idx.
+            shape (tuple[int]):
+                Shape of a single chunk
+            dtype (type):
+                Data type of a single chunk
+            num_chunks (int):
+                Total number of chunks to read
+            depth (int):
+                Number of chunks that are read ahead of the consumer. Defaults to 2.
+
+        Returns:
+            None
+        """
+        assert(depth > 0)
+        self.logger = logging.getLogger("simple")
+        self.read_func = read_func
+        self.num_chunks = num_chunks
+        # One buffer for each prefetched chunk plus one for the consumer.
+        self.buffers = [np.zeros(shape, dtype=dtype) for _ in range(depth + 1)]
+        # Indices of buffers that can be filled by the reader thread
+        self.free_q = queue.Queue()
+        for buf_idx in range(len(self.buffers)):
+            self.free_q.put(buf_idx)
+        # Tuples (chunk_idx, buf_idx) of filled buffers, in chunk order
+        self.ready_q = queue.Queue()
+        # Buffers currently owned by the consumer
+        self.owned = set()
+        self.stop_event = threading.Event()
+
+        self.reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader_thread.start()
+
+    def _read_loop(self):
+        """Fills free buffers with consecutive chunks. Executed by the reader thread."""
+        try:
+            for chunk_idx in range(self.num_chunks):
+                buf_idx = self.free_q.get()
+                if self.stop_event.is_set():
+                    return
+                self.read_func(self.buffers[buf_idx], chunk_idx)
+                self.ready_q.put((chunk_idx, buf_idx))
+        except Exception as e:
+            self.logger.error(f"chunk_prefetcher: Failed to read chunk: {e}")
+            self.ready_q.put(e)
+            return
+
+        self.ready_q.put(None)
+
+    def __iter__(self):
+        """Yields (chunk_idx, buf_idx, data) in chunk order.
+
+        data is owned by the consumer until release(buf_idx) is called.
+
+        Raises:
+            Exception:
+                Any exception raised by read_func in the reader thread.
+        """
+        while True:
+            item = self.ready_q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            chunk_idx, buf_idx = item
+            self.owned.add(buf_idx)
+            yield chunk_idx, buf_idx, self.buffers[buf_idx]
+
+    def release(self, buf_idx):
+        """Returns a buffer owned by the consumer to the reader thread.
+
+        Args:
+            buf_idx (int):
+                Index of the buffer, as yielded by __iter__
+
+        Returns:
+            None
+        """
+        self.owned.remove(buf_idx)
+        self.free_q.put(buf_idx)
+
+    def stop(self):
+        """Stops the reader thread after it has finished reading the current chunk."""
+        self.stop_event.set()
+        # Wake up the reader thread in case it is waiting for a free buffer
+        self.free_q.put(0)
+        self.reader_thread.join()
+
+
+# End of file prefetch.py
@@ -230,6 +230,9 @@ class backend_mongodb():
     def store_data(self, data, info_dict):
         """Stores analysis data in mongodb.
 
+        The document includes pair_offset and num_pairs of the batch, if info_dict has them.
+        They locate the rows of the data in the sequence of all channel pairs of the task.
+
         Args
             data (ndarray, float):
                 Numeric data to store
@@ -242,6 +245,10 @@ class backend_mongodb():
         """
         size_in_MB = np.prod(data.shape) * data.dtype.itemsize / 1024 / 1024
         self.logger.info(f"In store_data: data.shape{data.shape}, {info_dict}")
+        # BSON can't encode numpy integers
+        pair_info = {key: int(info_dict[key]) for key in ["pair_offset", "num_pairs"]
+                     if key in info_dict}
+        info_dict.update(pair_info)
 
         with mongo_connection(self.cfg_mongo) as mongo:
             client, coll = mongo
@@ -258,7 +265,7 @@ class backend_mongodb():
             elif self.datastore == "numpy":
                 with mongo_storage_numpy(self.cfg_mongo) as fname:
                     tic_io = time.perf_counter()
-                    np.savez(fname, data=data)
+                    np.savez(fname, data=data, **pair_info)
                     toc_io = time.perf_counter()
                     info_dict.update({"unique_filename": fname})
 
@@ -307,6 +314,31 @@ class backend_mongodb():
 
             return inserted_id
 
+    def store_many(self, items):
+        """Store a list of items in the database, using a single insert.
+
+        Args:
+            items (list of dict):
+                Items to store in the database
+
+        Returns:
+            inserted_ids (list of ObjectID):
+                MongoDB ObjectIDs of the inserted objects
+        """
+        timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %X UTC")
+        for item in items:
+            item.update({"timestamp": timestamp})
+
+        with mongo_connection(self.cfg_mongo) as mongo:
+            client, coll = mongo
+            try:
+                result = coll.insert_many(items)
+            except pymongo.errors.PyMongoError as e:
+                self.logger.error(f"An error has occurred in store_many: {e}")
+                raise ValueError(f"An error has occurred in store_many: {e}")
+
+        return result.inserted_ids
+
     def store_one(self, item):
         """Store a single item in the database.
 
@@ -27,4 +27,9 @@ class backend_null():
         self.logger.debug("store_one called:", item)
         return None
 
+    def store_many(self, items):
+        """Does nothing."""
+        self.logger.debug(f"store_many called with {len(items)} items")
+        return None
+
 # End of file backend_null.py
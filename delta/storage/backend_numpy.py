@@ -32,6 +32,11 @@ class backend_numpy():
     def store_data(self, chunk_data, info_dict):
         """Stores data and args in numpy file.
 
+        Besides the data, the file contains the analysis name, chunk index and batch index.
+        pair_offset and num_pairs locate the rows of the data in the sequence of all channel
+        pairs of the task. They are needed to read batches of variable size and are stored
+        if info_dict has them.
+
         Args:
             chunk_data (ndarray):
                 Data to store in file
@@ -41,10 +46,16 @@ class backend_numpy():
         Returns:
             None
         """
-        fname_fq = join(self.basedir, info_dict['analysis_name']) +\
+        fname = info_dict['analysis_name']
+        if "stream" in info_dict:
+            fname = f"{info_dict['stream']}_{fname}"
+        fname_fq = join(self.basedir, fname) +\
             f"_chunk{info_dict['chunk_idx']:05d}_batch{info_dict['channel_batch']:02d}.npz"
+        pair_info = {key: info_dict[key] for key in ["pair_offset", "num_pairs"]
+                     if key in info_dict}
         np.savez(fname_fq, chunk_data, analysis_name=info_dict['analysis_name'],
-                 chunk_idx=info_dict['chunk_idx'], batch=info_dict['channel_batch'])
+                 chunk_idx=info_dict['chunk_idx'], batch=info_dict['channel_batch'],
+                 **pair_info)
         logging.debug("Storing data in " + fname_fq)
 
     def store_metadata(self, cfg):
@@ -92,4 +103,17 @@ class backend_numpy():
 
         return None
 
+    def store_many(self, items):
+        """Stores a list of metadata items. Like store_metadata, this does nothing.
+
+        Args:
+            items (list of dict):
+                Metadata items to store
+
+        Returns:
+            None
+        """
+        logging.debug(f"Storing {len(items)} metadata items in " + self.basedir)
+        return None
+
 # End of file backend_numpy.py
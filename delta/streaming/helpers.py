@@ -0,0 +1,50 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Selects the transport for readers and writers."""
+
+
+def get_writer(cfg_transport, stream_name, comm=None):
+    """Returns a writer for the transport configured in cfg_transport.
+
+    adios2 is only imported when an ADIOS2 engine is used.
+
+    Args:
+        cfg_transport (dict):
+            Transport section of the configuration. If cfg_transport['engine'] is 'shm',
+            steps are passed through shared memory on the same host. Otherwise the
+            ADIOS2 engine of this name is used.
+        stream_name (str):
+            Name of the stream
+        comm (MPI.Comm):
+            Communicator for ADIOS2, see :py:class:`streaming.writers.writer_base`
+
+    Returns:
+        writer (writer_gen or writer_shm)
+    """
+    if cfg_transport["engine"].lower() == "shm":
+        from streaming.transport_shm import writer_shm
+        return writer_shm(cfg_transport, stream_name, comm)
+    from streaming.writers import writer_gen
+    return writer_gen(cfg_transport, stream_name, comm)
+
+
+def get_reader(cfg_transport, stream_name):
+    """Returns a reader for the transport configured in cfg_transport.
+
+    Args:
+        cfg_transport (dict):
+            Transport section of the configuration, see get_writer.
+        stream_name (str):
+            Name of the stream
+
+    Returns:
+        reader (reader_gen or reader_shm)
+    """
+    if cfg_transport["engine"].lower() == "shm":
+        from streaming.transport_shm import reader_shm
+        return reader_shm(cfg_transport, stream_name)
+    from streaming.reader_mpi import reader_gen
+    return reader_gen(cfg_transport, stream_name)
+
+
+# End of file streaming/helpers.py
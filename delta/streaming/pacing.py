@@ -0,0 +1,108 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Paces data streaming to a target rate."""
+
+import time
+
+
+class step_pacer():
+    """Paces streaming steps to a fixed rate.
+
+    Steps are scheduled on a fixed grid, step n starts at t_0 + n * step_interval.
+    Time spent in Put/EndStep is therefore subtracted from the sleep, and a slow step
+    does not shift later steps. If the pacer falls behind, it does not sleep until it
+    has caught up with the schedule.
+
+    .. code-block:: python
+
+        pacer = step_pacer.from_realtime(chunk_size, attrs["SampleRate"], writer.stats)
+        for chunk in batch_gen:
+            pacer.wait()
+            writer.BeginStep()
+            ...
+            writer.EndStep()
+
+    """
+
+    def __init__(self, step_interval, stats=None):
+        """Initializes the pacer.
+
+        Args:
+            step_interval (float):
+                Target time between the start of two steps, in seconds.
+            stats (:py:class:`streaming.stream_stats.stream_stats`):
+                If not None, step start times and lags are recorded here.
+
+        Returns:
+            None
+        """
+        assert(step_interval > 0.0)
+        self.step_interval = step_interval
+        self.stats = stats
+        if self.stats is not None:
+            self.stats.target_interval = step_interval
+        # Time when the first step started. Reference for the schedule.
+        self.t_start = None
+        self.nsteps = 0
+
+    @classmethod
+    def from_realtime(cls, chunk_size, sample_rate, stats=None, speedup=1.0):
+        """Paces steps to the rate at which the diagnostic acquires data.
+
+        Args:
+            chunk_size (int):
+                Number of samples per chunk
+            sample_rate (float):
+                Samples per second, per channel. In Hz.
+            stats (:py:class:`streaming.stream_stats.stream_stats`):
+                Passed to the constructor.
+            speedup (float):
+                Stream faster than real-time by this factor. Defaults to 1.0.
+
+        Returns:
+            pacer (step_pacer)
+        """
+        return cls(chunk_size / sample_rate / speedup, stats)
+
+    @classmethod
+    def from_bandwidth(cls, bytes_per_step, mb_per_sec, stats=None):
+        """Paces steps to a fixed bandwidth.
+
+        Args:
+            bytes_per_step (int):
+                Number of bytes written in a step
+            mb_per_sec (float):
+                Target bandwidth, in MB/s
+            stats (:py:class:`streaming.stream_stats.stream_stats`):
+                Passed to the constructor.
+
+        Returns:
+            pacer (step_pacer)
+        """
+        return cls(bytes_per_step / (mb_per_sec * 1024 * 1024), stats)
+
+    def wait(self):
+        """Sleeps until the next step is scheduled to start.
+
+        Returns:
+            lag (float):
+                Time by which the step starts behind schedule, in seconds.
+        """
+        if self.t_start is None:
+            self.t_start = time.perf_counter()
+            t_target = self.t_start
+        else:
+            t_target = self.t_start + self.nsteps * self.step_interval
+            dt_sleep = t_target - time.perf_counter()
+            if dt_sleep > 0.0:
+                time.sleep(dt_sleep)
+
+        t_now = time.perf_counter()
+        lag = max(0.0, t_now - t_target)
+        if self.stats is not None:
+            self.stats.add_step(t_now, lag)
+        self.nsteps += 1
+        return lag
+
+
+# End of file pacing.py
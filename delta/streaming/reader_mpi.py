@@ -4,6 +4,7 @@ from mpi4py import MPI
 
 import logging
 import json
+import time
 import numpy as np
 import adios2
 
@@ -35,6 +36,9 @@ class reader_base():
         # Keeps track of the past chunk sizes. This allows to construct a dummy time base
         self.reader = None
         self.stream_name = stream_name
+        # To generate statistics
+        self.stats = stream_stats(cfg.get("stats", None), stream_name,
+                                  MPI.COMM_WORLD.Get_rank())
 
     def Open(self, multi_channel_id=None):
         """Opens a new channel.
@@ -57,8 +61,10 @@ class reader_base():
         return None
 
     def BeginStep(self, timeoutSeconds=0.0):
-        """Wrapper for reader.BeginStep."""
+        """Wrapper for reader.BeginStep. The time spent waiting for a step is recorded."""
+        tic = time.perf_counter()
         res = self.reader.BeginStep(adios2.StepMode.Read, timeoutSeconds=timeoutSeconds)
+        self.stats.add_beginstep(time.perf_counter() - tic)
         if res == adios2.StepStatus.OK:
             return(True)
         return(False)
@@ -70,7 +76,9 @@ class reader_base():
 
     def EndStep(self):
         """Wrapper for reader.EndStep."""
+        tic = time.perf_counter()
         res = self.reader.EndStep()
+        self.stats.add_endstep(time.perf_counter() - tic)
         return(res)
 
     def InquireVariable(self, varname: str):
@@ -110,7 +118,7 @@ class reader_base():
         # TODO: Clean up naming conventions for stream attributes
         return stream_attrs
 
-    def Get(self, varname: str, save: bool=False):
+    def Get(self, varname: str, save: bool=False, copy: bool=True, out=None):
         """Get data from varname at current step. This is diagnostic-independent code.
 
         Args:
@@ -118,6 +126,12 @@ class reader_base():
                 variable name to inquire from adios stream
             save (bool):
                 saves data to numpy if true. Default: False
+            copy (bool):
+                If False, the caller only uses the data until EndStep. Transports may then
+                return a view on their buffers. ADIOS2 always reads into a new array.
+            out (ndarray):
+                If given, data is read into this array instead of a new one. Shape and
+                data type need to match the variable.
 
         Returns:
             time_chunk (ndarray)
@@ -133,8 +147,16 @@ class reader_base():
             new_dtype = np.float32
         else:
             raise ValueError(var.Type())
-        time_chunk = np.zeros(var.Shape(), dtype=new_dtype)
+        if out is None:
+            time_chunk = np.zeros(var.Shape(), dtype=new_dtype)
+        elif out.shape != tuple(var.Shape()) or out.dtype != new_dtype:
+            raise ValueError(f"Can't read {varname} with shape {var.Shape()} into " +
+                             f"array with shape {out.shape}, {out.dtype}")
+        else:
+            time_chunk = out
+        tic = time.perf_counter()
         self.reader.Get(var, time_chunk, adios2.Mode.Sync)
+        self.stats.add_transfer(time_chunk.nbytes, time.perf_counter() - tic)
         self.logger.info("Got data")
 
         if save:
@@ -142,6 +164,31 @@ class reader_base():
 
         return time_chunk
 
+    def get_trace(self):
+        """Reads the trace context of the current step.
+
+        Returns:
+            trace_ctx (tuple (int, float)):
+                Index of the chunk and time when it was sent, in seconds since the epoch.
+                None if the writer doesn't send a trace context.
+        """
+        var = self.IO.InquireVariable("trace_ctx")
+        # ADIOS2 returns a falsy Variable if the writer doesn't define trace_ctx
+        if not var:
+            return None
+        trace_ctx = np.zeros(2, dtype=np.float64)
+        self.reader.Get(var, trace_ctx, adios2.Mode.Sync)
+        return int(trace_ctx[0]), trace_ctx[1]
+
+    def transfer_stats(self):
+        """Returns a summary of the transfer statistics."""
+        return self.stats.summary()
+
+    def Close(self):
+        """Wrapper for reader.Close."""
+        self.reader.Close()
+        self.stats.close()
+
 
 class reader_gen(reader_base):
     """I don't know why we have this derived class - RK 2020-12-02."""
@@ -1,20 +1,254 @@
 # -*- Encoding: UTF-8 -*-
 
+"""Collects transfer statistics of readers and writers.
+
+Memory use is fixed. Each quantity keeps its most recent samples in a ring buffer and
+all samples in a histogram with logarithmic buckets, from which percentiles are computed.
+
+Statistics can be exported while running, configured by the `stats` key of a transport
+section:
+
+.. code-block:: json
+
+    "stats": {"export": "jsonl", "filename": "stats_{name}_{rank}.jsonl", "interval": 5.0}
+    "stats": {"export": "prometheus", "port": 9100}
+
+A process serves one Prometheus endpoint per port. It exports all stream_stats objects
+of the process that use this port, labelled by stream name and rank.
+"""
+
+import json
+import logging
+import threading
+import time
+
 import numpy as np
 
+# Prometheus endpoints of this process, port: (server, list of exported stream_stats)
+_http_servers = {}
+_http_servers_lock = threading.Lock()
+
+
+class ring_buffer():
+    """Fixed-size buffer that keeps the most recent values."""
+
+    def __init__(self, capacity=4096, dtype=np.float64):
+        """Allocates the buffer.
+
+        Args:
+            capacity (int):
+                Number of values to keep
+            dtype (type):
+                Data type of the values
+
+        Returns:
+            None
+        """
+        self.data = np.zeros(capacity, dtype=dtype)
+        # Total number of appended values
+        self.count = 0
+
+    def append(self, value):
+        """Appends a value, overwriting the oldest value if the buffer is full."""
+        self.data[self.count % len(self.data)] = value
+        self.count += 1
+
+    def values(self):
+        """Returns the stored values, ordered from oldest to newest."""
+        if self.count <= len(self.data):
+            return self.data[:self.count].copy()
+        idx = self.count % len(self.data)
+        return np.concatenate([self.data[idx:], self.data[:idx]])
+
+    def __len__(self):
+        """Returns the number of stored values."""
+        return min(self.count, len(self.data))
+
+
+class log_histogram():
+    """Histogram with logarithmically spaced buckets, similar to an HDR histogram.
+
+    Values between lowest and highest are recorded with a relative precision of
+    10^(1 / bins_per_decade) - 1, about 2.3% for 100 bins per decade. Smaller and larger
+    values are recorded in the first and last bucket.
+    """
+
+    def __init__(self, lowest=1e-6, highest=1e4, bins_per_decade=100):
+        """Allocates the buckets.
+
+        Args:
+            lowest (float):
+                Lower edge of the first bucket
+            highest (float):
+                Upper edge of the last bucket
+            bins_per_decade (int):
+                Number of buckets per factor of 10
+
+        Returns:
+            None
+        """
+        self.log_lowest = np.log10(lowest)
+        self.bins_per_decade = bins_per_decade
+        num_bins = int(np.ceil((np.log10(highest) - self.log_lowest) * bins_per_decade))
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        # Upper edge of each bucket
+        self.edges = 10.0 ** (self.log_lowest + np.arange(1, num_bins + 1) / bins_per_decade)
+
+    def record(self, value):
+        """Adds a value to the histogram."""
+        if value > 0.0:
+            idx = int((np.log10(value) - self.log_lowest) * self.bins_per_decade)
+            idx = min(max(idx, 0), len(self.counts) - 1)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+
+    def percentile(self, q):
+        """Returns the q-th percentile, as the upper edge of the bucket that contains it.
+
+        Args:
+            q (float):
+                Percentile, between 0 and 100
+
+        Returns:
+            value (float):
+                None if no values were recorded.
+        """
+        total = self.counts.sum()
+        if total == 0:
+            return None
+        idx = np.searchsorted(np.cumsum(self.counts), q / 100.0 * total)
+        return self.edges[min(idx, len(self.edges) - 1)]
+
+
+class metric():
+    """Collects samples of a single quantity, f.ex. Put latency or packet size."""
+
+    def __init__(self, capacity=4096, lowest=1e-6, highest=1e4):
+        """Initializes the metric.
+
+        Args:
+            capacity (int):
+                Number of recent samples to keep
+            lowest (float):
+                Smallest value resolved by the histogram
+            highest (float):
+                Largest value resolved by the histogram
+
+        Returns:
+            None
+        """
+        self.recent = ring_buffer(capacity)
+        self.hist = log_histogram(lowest, highest)
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, value):
+        """Adds a sample."""
+        self.recent.append(value)
+        self.hist.record(value)
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def get_stats(self):
+        """Return sum, max, min, mean, std of all samples."""
+        if self.count == 0:
+            return (0.0, 0.0, 0.0, 0.0, 0.0)
+        mean = self.sum / self.count
+        std = np.sqrt(max(self.sumsq / self.count - mean * mean, 0.0))
+        return (self.sum, self.max, self.min, mean, std)
+
+    def summary(self):
+        """Returns count, sum, mean, min, max, and p50/p95/p99 as a dictionary."""
+        _, v_max, v_min, mean, _ = self.get_stats()
+        return {"count": self.count, "sum": self.sum, "mean": mean, "min": v_min, "max": v_max,
+                "p50": self.hist.percentile(50), "p95": self.hist.percentile(95),
+                "p99": self.hist.percentile(99)}
+
+
 class stream_stats():
-    """Collects statistics for data transfer timings."""
-
-    def __init__(self):
-        """Initialize the object."""
-        # List that stores the size of transferred packets in bytes
-        self.packet_sizes = []
-        # List that stores the time spent in send calls, in seconds
-        self.durations = []
+    """Collects statistics for data transfer timings.
+
+    Writers record Put latency, readers record Get latency as transfer. Both record
+    BeginStep and EndStep latencies and transferred bytes.
+    """
+
+    # Latencies are in seconds, sizes in bytes.
+    latency_names = ["transfer", "begin_step", "end_step", "convert"]
+    size_names = ["bytes", "raw_bytes"]
+
+    def __init__(self, cfg=None, name="stream", rank=0):
+        """Initialize the object.
+
+        Args:
+            cfg (dict):
+                Configuration of the statistics. Optional.
+            name (str):
+                Name of the stream, used in exported statistics.
+            rank (int):
+                MPI rank, used in exported statistics.
+
+        Returns:
+            None
+
+        Used keys from cfg:
+            * capacity - Number of recent samples kept for each quantity. Defaults to 4096.
+            * export - Either 'jsonl' or 'prometheus'. Optional, defaults to no export.
+            * filename - File that 'jsonl' appends to. May include {name} and {rank}.
+              Defaults to stats_{name}_{rank}.jsonl.
+            * interval - Seconds between two exported lines for 'jsonl'. Defaults to 10.
+            * port - Port of the prometheus endpoint. The rank is added to the port.
+              Objects of one process that use the same port share the endpoint.
+        """
+        if cfg is None:
+            cfg = {}
+        self.logger = logging.getLogger("simple")
+        self.name = name
+        self.rank = rank
+        # Reentrant, so that periodic exports can call to_dict while holding it
+        self.lock = threading.RLock()
+
+        capacity = cfg.get("capacity", 4096)
+        self.metrics = {key: metric(capacity, 1e-7, 1e4) for key in self.latency_names}
+        self.metrics.update({key: metric(capacity, 1.0, 1e12) for key in self.size_names})
         # Number of added steps
         self.nsteps = 0
+        # Start times of paced steps, in seconds, see streaming.pacing.step_pacer
+        self.step_starts = ring_buffer(capacity)
+        # Time by which paced steps started behind schedule, in seconds
+        self.step_lags = metric(capacity, 1e-7, 1e4)
+        # Target time between paced steps, in seconds. None if steps are not paced.
+        self.target_interval = None
 
-    def add_transfer(self, num_bytes, duration):
+        # Periodic export
+        self.export = cfg.get("export", None)
+        self.export_interval = cfg.get("interval", 10.0)
+        self.t_last_export = time.perf_counter()
+        self.export_file = None
+        self.http_port = None
+        if self.export == "jsonl":
+            fname = cfg.get("filename", "stats_{name}_{rank}.jsonl").format(name=name, rank=rank)
+            self.export_file = open(fname, "a")
+        elif self.export == "prometheus":
+            self._register_http(cfg.get("port", 9100) + rank)
+        elif self.export is not None:
+            raise ValueError(f"Unsupported stats export: {self.export}")
+
+    def _add(self, key, value):
+        """Adds a sample to a metric and exports statistics if due."""
+        with self.lock:
+            self.metrics[key].add(value)
+            if self.export_file is not None and \
+               time.perf_counter() - self.t_last_export > self.export_interval:
+                self.export_jsonl()
+
+    def add_transfer(self, num_bytes, duration, raw_bytes=None, convert_duration=0.0):
         """Adds a new transfer.
 
         Args:
@@ -22,24 +256,221 @@ class stream_stats():
                 Number of bytes that have been transferred
             duration (float):
                 Duration for the transfer
+            raw_bytes (int):
+                Number of bytes before the data was converted, f.ex. downcast to float32.
+                Defaults to num_bytes.
+            convert_duration (float):
+                Time spent converting the data before the transfer, in seconds.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.metrics["bytes"].add(num_bytes)
+            self.metrics["raw_bytes"].add(num_bytes if raw_bytes is None else raw_bytes)
+            self.metrics["convert"].add(convert_duration)
+            self.nsteps += 1
+        self._add("transfer", duration)
+
+    def add_beginstep(self, duration):
+        """Adds the time spent in a BeginStep call, f.ex. waiting for data, in seconds."""
+        self._add("begin_step", duration)
+
+    def add_endstep(self, duration):
+        """Adds the time spent in an EndStep call, in seconds.
+
+        With deferred Puts, this is where the data is transferred.
+        """
+        self._add("end_step", duration)
+
+    def add_step(self, t_start, lag):
+        """Adds the start of a paced step.
+
+        Args:
+            t_start (float):
+                Time when the step started, in seconds
+            lag (float):
+                Time by which the step started behind schedule, in seconds
 
         Returns:
             None
         """
+        with self.lock:
+            self.step_starts.append(t_start)
+            self.step_lags.add(lag)
+
+    def get_pacing_stats(self):
+        """Return target rate, achieved rate, jitter, and max lag of paced steps.
+
+        Rates are in steps per second. The jitter is the standard deviation of the time
+        between the start of consecutive recent steps, in seconds.
+        """
+        if len(self.step_starts) < 2:
+            return (None, None, None, None)
+        intervals = np.diff(self.step_starts.values())
+        target_rate = None if self.target_interval is None else 1.0 / self.target_interval
+        return (target_rate, 1.0 / intervals.mean(), intervals.std(), self.step_lags.max)
 
-        self.packet_sizes.append(num_bytes)
-        self.durations.append(duration)
-        self.nsteps += 1
+    def get_conversion_stats(self):
+        """Return total bytes before conversion and total time spent converting."""
+        return (self.metrics["raw_bytes"].sum, self.metrics["convert"].sum)
+
+    def get_endstep_stats(self):
+        """Return sum, max, min, avg, std of EndStep durations."""
+        return self.metrics["end_step"].get_stats()
 
     def get_transfer_stats(self):
-        """Return max, min, avg, std of packet sizes."""
-        arr = np.array(self.packet_sizes)
-        return (arr.sum(), arr.max(), arr.min(), arr.mean(), arr.std())
+        """Return sum, max, min, avg, std of packet sizes."""
+        return self.metrics["bytes"].get_stats()
 
     def get_duration_stats(self):
-        """Return max, min, avg, std of transfer durations."""
-        arr = np.array(self.durations)
-        return (arr.sum(), arr.max(), arr.min(), arr.mean(), arr.std())
+        """Return sum, max, min, avg, std of transfer durations."""
+        return self.metrics["transfer"].get_stats()
+
+    def to_dict(self):
+        """Returns a summary of all metrics as a dictionary."""
+        with self.lock:
+            return {"name": self.name, "rank": self.rank, "time": time.time(),
+                    "nsteps": self.nsteps,
+                    **{key: m.summary() for key, m in self.metrics.items()}}
+
+    def prometheus_samples(self):
+        """Returns the samples of all metrics in the Prometheus text format.
+
+        Returns:
+            samples (dict):
+                Lines of samples, keyed by metric name.
+        """
+        samples = {}
+        labels = f'stream="{self.name}",rank="{self.rank}"'
+        with self.lock:
+            for key, m in self.metrics.items():
+                metric_name = f"delta_{key}_seconds" if key in self.latency_names else f"delta_{key}"
+                lines = []
+                for q in [50, 95, 99]:
+                    value = m.hist.percentile(q)
+                    lines.append(f'{metric_name}{{{labels},quantile="{q / 100}"}} '
+                                 f'{"NaN" if value is None else value}')
+                lines.append(f"{metric_name}_sum{{{labels}}} {m.sum}")
+                lines.append(f"{metric_name}_count{{{labels}}} {m.count}")
+                samples[metric_name] = lines
+        return samples
+
+    def to_prometheus(self):
+        """Returns a summary of all metrics in the Prometheus text format."""
+        return prometheus_text([self])
+
+    def export_jsonl(self):
+        """Appends a summary of all metrics as a line of JSON to the export file."""
+        with self.lock:
+            self.t_last_export = time.perf_counter()
+            self.export_file.write(json.dumps(self.to_dict()) + "\n")
+            self.export_file.flush()
+
+    def _register_http(self, port):
+        """Exports this object on the Prometheus endpoint of a port.
+
+        Starts the endpoint if this is the first object of the process on the port.
+        """
+        with _http_servers_lock:
+            if port not in _http_servers:
+                _http_servers[port] = (_start_http_server(port), [])
+                self.logger.info(f"stream_stats: Serving statistics on port {port}")
+            _http_servers[port][1].append(self)
+        self.http_port = port
+
+    def _unregister_http(self):
+        """Stops exporting this object. Stops the endpoint after its last object."""
+        with _http_servers_lock:
+            server, exported = _http_servers[self.http_port]
+            exported.remove(self)
+            if len(exported) == 0:
+                server.shutdown()
+                server.server_close()
+                del _http_servers[self.http_port]
+        self.http_port = None
+
+    def summary(self):
+        """Returns a human-readable summary of all statistics."""
+        du = self.metrics["transfer"].summary()
+        tr_sum = self.metrics["bytes"].sum
+        stats_str = "Summary:\n"
+        stats_str += "========\n"
+        stats_str += f"    total steps:         {self.nsteps}\n"
+        stats_str += f"    total data (MB):     {(tr_sum / 1024 / 1024)}\n"
+        stats_str += f"    raw data (MB):       {(self.metrics['raw_bytes'].sum / 1024 / 1024)}\n"
+        stats_str += f"    conversion (sec):    {self.metrics['convert'].sum}\n"
+        stats_str += f"    transfer times(sec): {(du['sum'])}\n"
+        if du["sum"] > 0.0:
+            stats_str += f"    throughput (MB/sec): {tr_sum / 1024 / 1024 / du['sum']}\n"
+        for key in self.latency_names:
+            m = self.metrics[key].summary()
+            if m["count"] > 0:
+                stats_str += f"    {key} p50/p95/p99 (sec): {m['p50']:.3e} {m['p95']:.3e} " \
+                             f"{m['p99']:.3e}, max {m['max']:.3e}\n"
+
+        target_rate, rate, jitter, max_lag = self.get_pacing_stats()
+        if target_rate is not None:
+            stats_str += f"    target rate (steps/sec):   {target_rate}\n"
+            stats_str += f"    achieved rate (steps/sec): {rate}\n"
+            stats_str += f"    jitter (sec):              {jitter}\n"
+            stats_str += f"    max lag (sec):             {max_lag}\n"
+
+        return stats_str
+
+    def close(self):
+        """Writes a final export and stops exporting."""
+        if self.export_file is not None:
+            self.export_jsonl()
+            self.export_file.close()
+            self.export_file = None
+        if self.http_port is not None:
+            self._unregister_http()
+
+
+def prometheus_text(stats_list):
+    """Returns a summary of the metrics of several stream_stats in the Prometheus text format.
+
+    Args:
+        stats_list (list of stream_stats):
+            Statistics to export. Samples of a metric are grouped under one TYPE line.
+
+    Returns:
+        text (str):
+            Exposition in the Prometheus text format.
+    """
+    families = {}
+    for stats in stats_list:
+        for metric_name, lines in stats.prometheus_samples().items():
+            families.setdefault(metric_name, []).extend(lines)
+    text = []
+    for metric_name, lines in families.items():
+        text.append(f"# TYPE {metric_name} summary")
+        text.extend(lines)
+    return "\n".join(text) + "\n"
+
+
+def _start_http_server(port):
+    """Serves the statistics registered for a port from a background thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with _http_servers_lock:
+                exported = list(_http_servers[port][1]) if port in _http_servers else []
+            body = prometheus_text(exported).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 
-# End of file stream_stats.py
\ No newline at end of file
+# End of file stream_stats.py
@@ -0,0 +1,214 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Per-chunk tracing across generator, middleman, and processor.
+
+Each stage records spans, time intervals tagged with the index of the chunk they work on.
+Spans are written in the `Chrome trace event format
+<https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU>`_,
+which can be loaded into chrome://tracing or https://ui.perfetto.dev.
+Every process writes its own file. Use merge_traces.py to combine them.
+
+Tracing is configured by the `tracing` section of the configuration:
+
+.. code-block:: json
+
+    "tracing": {"enabled": true, "dir": "traces", "flush_interval": 5.0}
+
+.. code-block:: python
+
+    tracer = get_tracer(cfg.get("tracing"), "processor")
+    with tracer.span("preprocess", chunk_idx):
+        ...
+
+Timestamps are taken from the wall-clock, so that spans recorded on different hosts
+can be compared. This assumes that the host clocks are synchronized.
+"""
+
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+class tracer():
+    """Records spans and appends them to a trace file of this process."""
+
+    def __init__(self, cfg=None, component="delta"):
+        """Initializes the tracer.
+
+        Args:
+            cfg (dict):
+                Tracing configuration. If None, or if cfg["enabled"] is false, spans
+                are not recorded.
+            component (str):
+                Name of the component, f.ex. generator or processor.
+
+        Returns:
+            None
+
+        Used keys from cfg:
+            * enabled - Enables tracing. Defaults to false.
+            * dir - Directory where trace files are written. Defaults to the current directory.
+            * flush_interval - Seconds between two writes to the trace file. Defaults to 5.
+        """
+        if cfg is None:
+            cfg = {}
+        self.cfg = cfg
+        self.enabled = cfg.get("enabled", False)
+        self.component = component
+        self.pid = os.getpid()
+        self.flush_interval = cfg.get("flush_interval", 5.0)
+        self.t_last_flush = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            os.makedirs(cfg.get("dir", "."), exist_ok=True)
+            self.filename = os.path.join(cfg.get("dir", "."),
+                                         f"trace_{component}_{socket.gethostname()}_"
+                                         f"{self.pid}.json")
+            # Use the JSON array format. It allows to append events and the closing
+            # bracket is optional.
+            with open(self.filename, "w") as df:
+                df.write("[\n")
+            self.events.append({"name": "process_name", "ph": "M", "pid": self.pid,
+                                "args": {"name": f"{component}@{socket.gethostname()}"}})
+            atexit.register(self.flush)
+
+    def add_span(self, name, chunk_idx, t_start, t_end, **args):
+        """Records a span.
+
+        Args:
+            name (str):
+                Name of the span, f.ex. the name of the stage
+            chunk_idx (int):
+                Index of the chunk
+            t_start (float):
+                Start of the span, in seconds since the epoch, as returned by time.time()
+            t_end (float):
+                End of the span, in seconds since the epoch
+            args:
+                Additional information to store with the span
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        event = {"name": name, "cat": self.component, "ph": "X",
+                 "ts": t_start * 1e6, "dur": (t_end - t_start) * 1e6,
+                 "pid": self.pid, "tid": threading.get_ident(),
+                 "args": {"chunk_idx": int(chunk_idx), **args}}
+        with self.lock:
+            self.events.append(event)
+        if time.perf_counter() - self.t_last_flush > self.flush_interval:
+            self.flush()
+
+    @contextmanager
+    def span(self, name, chunk_idx, **args):
+        """Records a span that covers the body of a with-statement.
+
+        Args:
+            name (str):
+                Name of the span
+            chunk_idx (int):
+                Index of the chunk
+            args:
+                Additional information to store with the span
+        """
+        if not self.enabled:
+            yield
+            return
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, chunk_idx, t_start, time.time(), **args)
+
+    def flush(self):
+        """Appends all recorded spans to the trace file."""
+        if not self.enabled:
+            return
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.t_last_flush = time.perf_counter()
+            if len(events) > 0:
+                with open(self.filename, "a") as df:
+                    df.write("".join([json.dumps(event) + ",\n" for event in events]))
+
+
+# The tracer of this process, see get_tracer.
+_tracer = None
+
+
+def get_tracer(cfg=None, component="delta"):
+    """Returns the tracer of this process.
+
+    The tracer is created on the first call. Arguments of later calls are ignored.
+
+    Args:
+        cfg (dict):
+            Tracing configuration, see :py:class:`tracer`
+        component (str):
+            Name of the component
+
+    Returns:
+        tracer (tracer)
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = tracer(cfg, component)
+    return _tracer
+
+
+def load_trace(filename):
+    """Loads the events from a trace file written by a tracer.
+
+    Args:
+        filename (str):
+            Name of the trace file
+
+    Returns:
+        events (list of dict)
+    """
+    with open(filename, "r") as df:
+        content = df.read().strip()
+    # Remove a trailing comma and close the array, if necessary.
+    if content.endswith(","):
+        content = content[:-1]
+    if not content.endswith("]"):
+        content += "]"
+    return json.loads(content)
+
+
+def chunk_latencies(events):
+    """Calculates the end-to-end latency of each chunk.
+
+    Args:
+        events (list of dict):
+            Trace events, f.ex. merged from all trace files of a run.
+
+    Returns:
+        latencies (dict):
+            Keys are chunk indices, values are tuples (latency in seconds, name of the
+            span that ends last).
+    """
+    t_first, t_last, name_last = {}, {}, {}
+    for event in events:
+        if event.get("ph") != "X":
+            continue
+        chunk_idx = event["args"]["chunk_idx"]
+        t_end = event["ts"] + event["dur"]
+        t_first[chunk_idx] = min(t_first.get(chunk_idx, event["ts"]), event["ts"])
+        if t_end > t_last.get(chunk_idx, -1.0):
+            t_last[chunk_idx] = t_end
+            name_last[chunk_idx] = event["name"]
+    return {chunk_idx: ((t_last[chunk_idx] - t_first[chunk_idx]) * 1e-6, name_last[chunk_idx])
+            for chunk_idx in t_first}
+
+
+# End of file tracing.py
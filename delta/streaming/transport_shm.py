@@ -0,0 +1,521 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Shared-memory transport between processes on the same host.
+
+writer_shm and reader_shm implement the interface of
+:py:class:`streaming.writers.writer_gen` and :py:class:`streaming.reader_mpi.reader_gen`
+that generator, middleman, and processor use. They don't require adios2 or MPI.
+Select them with "engine": "shm" in the transport section, see
+:py:func:`streaming.helpers.get_writer`.
+
+The writer creates a single shared memory segment, named after the stream:
+
+* A header of int64 counters: number of slots, slot size, meta-data version and length,
+  number of steps written and released, and a closed flag.
+* Meta-data as a json string: variable layout, stream attributes.
+* A ring of num_slots slots. Each slot holds the trace context and all variables of a step.
+
+The writer copies data into a free slot and publishes the step by incrementing the
+write counter. The reader maps the variables of a step as arrays directly on the slot,
+without copying, and releases the slot in EndStep. There is a single writer and a single
+reader per stream. Counters are written by only one side each, so no locks are needed.
+This relies on stores becoming visible to other processes in program order, which x86
+guarantees but f.ex. ARM and POWER don't. The transport refuses to run on other machines.
+"""
+
+import hashlib
+import json
+import logging
+import platform
+import time
+
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from streaming.stream_stats import stream_stats
+
+
+# Indices of the int64 header fields
+_NUM_SLOTS, _SLOT_NBYTES, _META_VERSION, _META_LEN, _WRITE_SEQ, _READ_SEQ, _CLOSED = range(7)
+_HEADER_NBYTES = 64
+_META_NBYTES = 65536
+# Each slot starts with the trace context [chunk_idx, t_send]
+_TRACE_NBYTES = 64
+# Alignment of variables in a slot
+_ALIGN = 64
+# Values of platform.machine() with total store order
+_X86_MACHINES = {"x86_64", "amd64", "i386", "i686", "x86"}
+
+
+def gen_shm_name(stream_name):
+    """Generates a name for the shared memory segment of a stream.
+
+    Stream names may contain characters or be longer than allowed for segment names.
+    Use a hash of the stream name instead.
+    """
+    return "delta_" + hashlib.md5(stream_name.encode()).hexdigest()[:16]
+
+
+def _wait_for(condition, timeout=None):
+    """Polls condition until it is true.
+
+    Args:
+        condition (callable):
+            Returns true when the wait is over
+        timeout (float):
+            Maximum time to wait, in seconds. Wait forever if None.
+
+    Returns:
+        success (bool):
+            False if the time-out was reached
+    """
+    tic = time.perf_counter()
+    dt_sleep = 1e-5
+    while not condition():
+        if timeout is not None and time.perf_counter() - tic > timeout:
+            return False
+        time.sleep(dt_sleep)
+        dt_sleep = min(2.0 * dt_sleep, 1e-3)
+    return True
+
+
+def _check_machine():
+    """Raises RuntimeError if stores may become visible out of order on this machine.
+
+    Publishing a step by incrementing a counter, without a memory barrier, is only safe
+    if the slot is visible to the other process before the counter.
+    """
+    if platform.machine().lower() not in _X86_MACHINES:
+        raise RuntimeError(f"transport_shm: Not supported on {platform.machine()}, which "
+                           "doesn't guarantee ordered stores. Use an adios2 engine.")
+
+
+# Names of the segments created by writers in this process
+_created = set()
+
+
+def _attach(name):
+    """Attaches to an existing segment without registering it with the resource tracker.
+
+    Otherwise the resource tracker of the reader process would unlink the segment when
+    the reader exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13. Registering is idempotent, so keep the registration of a writer
+        # in this process.
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class writer_shm():
+    """Writes steps into a shared memory ring buffer."""
+
+    def __init__(self, cfg: dict, stream_name: str, comm=None):
+        """Initializes the writer.
+
+        Args:
+            cfg (dict):
+                Transport section of the configuration
+            stream_name (str):
+                Name of the stream
+            comm (MPI.Comm):
+                Not used. Blocks of a global variable written by multiple ranks are
+                not supported.
+
+        Used keys from cfg:
+            * num_slots - Number of steps that can be in flight. Optional, defaults to 4.
+            * close_timeout - Time, in seconds, that Close waits for the reader to release
+              all steps. Optional, defaults to 60.
+            * stats - Configures export of transfer statistics, see
+              :py:class:`streaming.stream_stats.stream_stats`. Optional.
+
+        Raises:
+            RuntimeError:
+                If the machine is not x86.
+        """
+        _check_machine()
+        self.logger = logging.getLogger("simple")
+        self.stream_name = stream_name
+        self.num_slots = cfg.get("num_slots", 4)
+        self.close_timeout = cfg.get("close_timeout", 60.0)
+        self.stats = stream_stats(cfg.get("stats", None), stream_name, 0)
+
+        # Shape and dtype of all variables, keyed by name
+        self.variables = {}
+        self.var_name = None
+        self.shape = None
+        self.dtype = None
+        self.attrs = {}
+        self.trace_enabled = False
+
+        self.shm = None
+        self.header = None
+        # For each slot: trace context and a dict of arrays, keyed by variable name
+        self.slot_trace = None
+        self.slot_vars = None
+        self.current_slot = None
+
+    def DefineVariable(self, var_name: str, shape: tuple, dtype: type, start=None, count=None):
+        """Defines a variable that is written in each step.
+
+        Args:
+            var_name (str):
+                Variable name
+            shape (tuple[int]):
+                Shape of the variable
+            dtype (type):
+                Datatype of the variable
+            start (tuple[int]):
+                Needs to be zero or None
+            count (tuple[int]):
+                Needs to be shape or None
+
+        Returns:
+            var_name (str)
+
+        Raises:
+            ValueError:
+                If a block of the variable is requested, or if the writer is open.
+        """
+        if (count is not None and tuple(count) != tuple(shape)) or \
+           (start is not None and any(start)):
+            raise ValueError("writer_shm: Blocks of global variables are not supported.")
+        if self.shm is not None:
+            raise ValueError("writer_shm: Variables need to be defined before Open.")
+        self.var_name = var_name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.variables[var_name] = (self.shape, self.dtype)
+        return var_name
+
+    def DefineTraceVariable(self):
+        """Enables sending the trace context, see :py:mod:`streaming.tracing`."""
+        self.trace_enabled = True
+
+    def DefineAttributes(self, attrsname: str, attrs: dict):
+        """Stores an attribute dictionary in the meta-data of the stream.
+
+        Args:
+            attrsname (str):
+                Name of the attribute
+            attrs (dict):
+                Dictionary of key,value pairs. Needs to be json-serializable.
+
+        Returns:
+            None
+        """
+        try:
+            json.dumps(attrs)
+        except TypeError as e:
+            self.logger.error(f"Can't serialize attributes: {e}")
+            raise TypeError(f"Can't serialize data stream attributes: {e}")
+        self.attrs[attrsname] = attrs
+        if self.shm is not None:
+            self._write_meta()
+
+    def _write_meta(self):
+        """Writes the meta-data into the segment.
+
+        The version is odd while the meta-data is written, so that readers can detect
+        partial updates.
+        """
+        meta = json.dumps({"variables": {var_name: {"shape": shape, "dtype": dtype.str,
+                                                    "offset": self.offsets[var_name]}
+                                         for var_name, (shape, dtype) in self.variables.items()},
+                           "attrs": self.attrs,
+                           "trace": self.trace_enabled}).encode()
+        if len(meta) > _META_NBYTES:
+            raise ValueError(f"writer_shm: Meta-data exceeds {_META_NBYTES} bytes.")
+        self.header[_META_VERSION] += 1
+        self.shm.buf[_HEADER_NBYTES:_HEADER_NBYTES + len(meta)] = meta
+        self.header[_META_LEN] = len(meta)
+        self.header[_META_VERSION] += 1
+
+    def Open(self):
+        """Creates the shared memory segment."""
+        if self.shm is not None:
+            return
+        # Offsets of the variables in a slot
+        self.offsets = {}
+        slot_nbytes = _TRACE_NBYTES
+        for var_name, (shape, dtype) in self.variables.items():
+            self.offsets[var_name] = slot_nbytes
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            slot_nbytes += (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+
+        size = _HEADER_NBYTES + _META_NBYTES + self.num_slots * slot_nbytes
+        name = gen_shm_name(self.stream_name)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left-over from a previous run that didn't shut down cleanly
+            self.logger.info(f"writer_shm: Removing stale segment {name}")
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _created.add(name)
+
+        self.header = np.ndarray((7, ), dtype=np.int64, buffer=self.shm.buf)
+        self.header[:] = 0
+        self.header[_NUM_SLOTS] = self.num_slots
+        self.header[_SLOT_NBYTES] = slot_nbytes
+        self.slot_trace = []
+        self.slot_vars = []
+        for slot in range(self.num_slots):
+            slot_offset = _HEADER_NBYTES + _META_NBYTES + slot * slot_nbytes
+            self.slot_trace.append(np.ndarray((2, ), dtype=np.float64, buffer=self.shm.buf,
+                                              offset=slot_offset))
+            self.slot_vars.append({var_name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                                                        offset=slot_offset +
+                                                        self.offsets[var_name])
+                                   for var_name, (shape, dtype) in self.variables.items()})
+        self._write_meta()
+        self.logger.info(f"writer_shm: Opened {self.stream_name} as {name}, {size} bytes")
+
+    def BeginStep(self):
+        """Waits until a slot is free."""
+        tic = time.perf_counter()
+        _wait_for(lambda: self.header[_WRITE_SEQ] - self.header[_READ_SEQ] < self.num_slots)
+        self.stats.add_beginstep(time.perf_counter() - tic)
+        self.current_slot = self.header[_WRITE_SEQ] % self.num_slots
+        return True
+
+    def put_data(self, data_class, var_name=None, deferred=False):
+        """Copies data into the current slot.
+
+        Args:
+            data_class (2d-array type):
+                Data to send
+            var_name (str):
+                Name of the variable to write. Defaults to the last variable defined.
+            deferred (bool):
+                Not used. Data doesn't need to stay valid after this call.
+
+        Returns:
+            None
+        """
+        if var_name is None:
+            var_name = self.var_name
+        buffer = self.slot_vars[self.current_slot][var_name]
+        assert(data_class.data.shape == buffer.shape)
+        tic = time.perf_counter()
+        np.copyto(buffer, data_class.data, casting="same_kind")
+        self.stats.add_transfer(buffer.nbytes, time.perf_counter() - tic,
+                                raw_bytes=data_class.data.nbytes)
+
+    def put_trace(self, chunk_idx):
+        """Writes the trace context of the current step, if DefineTraceVariable was called."""
+        if self.trace_enabled:
+            self.slot_trace[self.current_slot][:] = [chunk_idx, time.time()]
+
+    def EndStep(self):
+        """Publishes the current step."""
+        self.header[_WRITE_SEQ] += 1
+        self.current_slot = None
+
+    def Close(self):
+        """Waits until the reader released all steps and removes the segment."""
+        self.header[_CLOSED] = 1
+        if not _wait_for(lambda: self.header[_READ_SEQ] == self.header[_WRITE_SEQ],
+                         self.close_timeout):
+            self.logger.info(f"writer_shm: {self.header[_WRITE_SEQ] - self.header[_READ_SEQ]} "
+                             "steps were not read.")
+        self.header = None
+        self.slot_trace = None
+        self.slot_vars = None
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.shm.name.lstrip("/"))
+        self.stats.close()
+
+    def transfer_stats(self):
+        """Returns a summary of the transfer statistics."""
+        return self.stats.summary()
+
+
+class reader_shm():
+    """Reads steps from a shared memory ring buffer."""
+
+    def __init__(self, cfg: dict, stream_name: str):
+        """Initializes the reader.
+
+        Args:
+            cfg (dict):
+                Transport section of the configuration
+            stream_name (str):
+                Name of the stream
+
+        Used keys from cfg:
+            * open_timeout - Time, in seconds, that Open waits for the writer to create the
+              stream. Optional, defaults to 60.
+            * stats - Configures export of transfer statistics. Optional.
+
+        Raises:
+            RuntimeError:
+                If the machine is not x86.
+        """
+        _check_machine()
+        self.logger = logging.getLogger("simple")
+        self.stream_name = stream_name
+        self.open_timeout = cfg.get("open_timeout", 60.0)
+        self.stats = stream_stats(cfg.get("stats", None), stream_name, 0)
+        self.shm = None
+        self.header = None
+        self.meta = None
+        self.meta_version = -1
+        self.current_slot = None
+
+    def Open(self):
+        """Attaches to the shared memory segment of the stream.
+
+        Raises:
+            TimeoutError:
+                If the writer didn't create the stream within open_timeout.
+        """
+        name = gen_shm_name(self.stream_name)
+        self.logger.info(f"Waiting to receive channel name {self.stream_name}")
+
+        def try_attach():
+            try:
+                self.shm = _attach(name)
+            except FileNotFoundError:
+                return False
+            except ValueError:
+                # The writer created the segment but didn't set its size yet
+                return False
+            return True
+
+        if not _wait_for(try_attach, self.open_timeout):
+            raise TimeoutError(f"reader_shm: Stream {self.stream_name} was not opened.")
+        self.header = np.ndarray((7, ), dtype=np.int64, buffer=self.shm.buf)
+        # The writer creates the segment before it writes the meta-data
+        _wait_for(lambda: self.header[_META_VERSION] > 0)
+        self._read_meta()
+        self.num_slots = int(self.header[_NUM_SLOTS])
+        self.slot_nbytes = int(self.header[_SLOT_NBYTES])
+        self.logger.info(f"Opened channel {self.stream_name}")
+
+    def _read_meta(self):
+        """Reads the meta-data if it was updated."""
+        while True:
+            version = self.header[_META_VERSION]
+            if version == self.meta_version:
+                return
+            if version % 2 == 1:
+                time.sleep(1e-5)
+                continue
+            meta_len = self.header[_META_LEN]
+            meta = bytes(self.shm.buf[_HEADER_NBYTES:_HEADER_NBYTES + meta_len])
+            if self.header[_META_VERSION] == version:
+                self.meta = json.loads(meta)
+                self.meta_version = version
+                return
+
+    def BeginStep(self, timeoutSeconds=0.0):
+        """Waits for the next step.
+
+        Args:
+            timeoutSeconds (float):
+                Maximum time to wait. If not positive, wait until a step is available or
+                the writer closes the stream.
+
+        Returns:
+            success (bool):
+                True if a step is available. False at time-out or at the end of the stream.
+        """
+        tic = time.perf_counter()
+        _wait_for(lambda: (self.header[_WRITE_SEQ] > self.header[_READ_SEQ]) or
+                  self.header[_CLOSED] == 1,
+                  timeoutSeconds if timeoutSeconds > 0.0 else None)
+        self.stats.add_beginstep(time.perf_counter() - tic)
+        if self.header[_WRITE_SEQ] > self.header[_READ_SEQ]:
+            self.current_slot = self.header[_READ_SEQ] % self.num_slots
+            self._read_meta()
+            return True
+        return False
+
+    def CurrentStep(self):
+        """Returns the index of the current step."""
+        return int(self.header[_READ_SEQ])
+
+    def EndStep(self):
+        """Releases the slot of the current step."""
+        self.header[_READ_SEQ] += 1
+        self.current_slot = None
+
+    def InquireVariable(self, varname: str):
+        """Returns the layout of a variable, or None if it is not defined."""
+        return self.meta["variables"].get(varname, None)
+
+    def InquireAttribute(self, attrname: str):
+        """Returns true if the attribute is defined."""
+        return attrname in self.meta["attrs"]
+
+    def get_attrs(self, attrsname: str):
+        """Returns the attribute dictionary `attrsname`."""
+        return self.meta["attrs"][attrsname]
+
+    def _slot_offset(self):
+        return _HEADER_NBYTES + _META_NBYTES + self.current_slot * self.slot_nbytes
+
+    def Get(self, varname: str, save: bool=False, copy: bool=True, out=None):
+        """Gets data of a variable in the current step.
+
+        Args:
+            varname (str):
+                Variable name
+            save (bool):
+                Saves data to numpy if true. Default: False
+            copy (bool):
+                If False, the returned array is a view on the shared memory, which is only
+                valid until EndStep. Default: True
+            out (ndarray):
+                If given, data is copied into this array, regardless of copy.
+
+        Returns:
+            time_chunk (ndarray)
+                Data of the current step
+        """
+        var = self.meta["variables"][varname]
+        tic = time.perf_counter()
+        time_chunk = np.ndarray(var["shape"], dtype=np.dtype(var["dtype"]), buffer=self.shm.buf,
+                                offset=self._slot_offset() + var["offset"])
+        if out is not None:
+            np.copyto(out, time_chunk, casting="no")
+            time_chunk = out
+        elif copy:
+            time_chunk = time_chunk.copy()
+        self.stats.add_transfer(time_chunk.nbytes, time.perf_counter() - tic)
+
+        if save:
+            np.savez(f"test_data/time_chunk_tr_s{self.CurrentStep():04d}.npz", time_chunk=time_chunk)
+        return time_chunk
+
+    def get_trace(self):
+        """Returns the trace context (chunk_idx, t_send) of the current step, or None."""
+        if not self.meta["trace"]:
+            return None
+        trace_ctx = np.ndarray((2, ), dtype=np.float64, buffer=self.shm.buf,
+                               offset=self._slot_offset())
+        return int(trace_ctx[0]), float(trace_ctx[1])
+
+    def transfer_stats(self):
+        """Returns a summary of the transfer statistics."""
+        return self.stats.summary()
+
+    def Close(self):
+        """Detaches from the shared memory segment."""
+        self.header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            self.logger.info("reader_shm: Arrays returned by Get(copy=False) are still in use.")
+        self.stats.close()
+
+
+# End of file transport_shm.py
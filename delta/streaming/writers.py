@@ -7,6 +7,8 @@ from mpi4py import MPI
 import numpy as np
 import json
 import logging
+import queue
+import threading
 import time
 
 import adios2
@@ -17,28 +19,93 @@ from streaming.adios_helpers import gen_io_name
 
 class writer_base():
     """Generc base class for all ADIOS2 writers."""
-    def __init__(self, cfg: dict, stream_name: str):
-        """Initialize writer_base."""
-        comm = MPI.COMM_WORLD
-        self.rank = comm.Get_rank()
-        self.size = comm.Get_size()
+    def __init__(self, cfg: dict, stream_name: str, comm=None):
+        """Initialize writer_base.
+
+        Args:
+            cfg (dict):
+                Transport section of the configuration
+            stream_name (str):
+                Name for the adios data stream
+            comm (MPI.Comm):
+                Communicator passed to ADIOS2. Use MPI.COMM_WORLD when all ranks write
+                blocks of a single global variable. Defaults to MPI.COMM_SELF.
+
+        Used keys from cfg:
+            * num_buffers - If larger than 1, steps are written asynchronously by a
+              background thread, using this many output buffers. Optional, defaults to 1.
+            * operators - List of ADIOS2 operators that are attached to every defined
+              variable, f.ex. [{"type": "blosc", "params": {"clevel": 5}}] for lossless or
+              [{"type": "zfp", "params": {"accuracy": 1e-4}}] for error-bounded lossy
+              compression. Readers decompress transparently. Optional, defaults to none.
+            * downcast - If "float32", float64 data is converted to float32 before it is
+              written. Optional, defaults to no conversion.
+            * stats - Configures export of transfer statistics, see
+              :py:class:`streaming.stream_stats.stream_stats`. Optional.
+        """
+        self.rank = MPI.COMM_WORLD.Get_rank()
+        self.size = MPI.COMM_WORLD.Get_size()
         self.logger = logging.getLogger("simple")
 
-        self.adios = adios2.ADIOS(MPI.COMM_SELF)
+        self.adios = adios2.ADIOS(MPI.COMM_SELF if comm is None else comm)
         self.IO = self.adios.DeclareIO(gen_io_name(self.rank))
         self.writer = None
         # Adios2 variable that is defined in DefineVariable
         self.variable = None
+        # All variables defined in DefineVariable, keyed by name
+        self.variables = {}
         # The shape used to define self.variable
         self.shape = None
+        # Variable that carries the trace context, see DefineTraceVariable
+        self.trace_variable = None
+        self.trace_ctx = np.zeros(2, dtype=np.float64)
 
         # Generate a descriptive channel name
         self.stream_name = stream_name
 
         # To generate statistics
-        self.stats = stream_stats()
-
-    def DefineVariable(self, var_name: str, shape: tuple, dtype: type):
+        self.stats = stream_stats(cfg.get("stats", None), stream_name, self.rank)
+
+        # ADIOS2 operators that are added to each variable, as tuples (operator, params)
+        self.operators = []
+        for op_idx, op_cfg in enumerate(cfg.get("operators", [])):
+            op_params = {k: str(v) for k, v in op_cfg.get("params", {}).items()}
+            op = self.adios.DefineOperator(f"{op_cfg['type']}_{op_idx}", op_cfg["type"], {})
+            self.operators.append((op, op_params))
+        # Data type that float64 data is converted to before writing. None for no conversion
+        self.downcast = None
+        if cfg.get("downcast", None) == "float32":
+            self.downcast = np.float32
+        elif cfg.get("downcast", None) is not None:
+            raise ValueError(f"Unsupported downcast: {cfg['downcast']}")
+        # Buffers for converted data, keyed by variable name
+        self.downcast_buffers = {}
+
+        # Asynchronous mode: put_data copies data into one of num_buffers output buffers.
+        # EndStep hands the buffer to a sender thread, which performs BeginStep, deferred
+        # Puts, and EndStep on the ADIOS2 engine while the producer fills the next buffer.
+        self.num_buffers = cfg.get("num_buffers", 1)
+        self.is_async = self.num_buffers > 1
+        if self.is_async:
+            # Output buffers for each step, keyed by variable name. Allocated on first use.
+            self.buffers = [{} for _ in range(self.num_buffers)]
+            # Indices of buffers that can be filled by the producer
+            self.free_q = queue.Queue()
+            for buf_idx in range(self.num_buffers):
+                self.free_q.put(buf_idx)
+            # Tuples (buf_idx, list of var_names) of steps that are ready to be sent
+            self.send_q = queue.Queue()
+            # Buffer and variables of the step that is currently filled by the producer
+            self.current_buf = None
+            self.current_vars = []
+            # Trace context of each buffer, and chunk index of the current step
+            self.trace_buffers = [np.zeros(2, dtype=np.float64) for _ in range(self.num_buffers)]
+            self.current_trace = None
+            self.sender_thread = None
+            # Exception raised in the sender thread. Re-raised in the producer thread.
+            self.send_error = None
+
+    def DefineVariable(self, var_name: str, shape: tuple, dtype: type, start=None, count=None):
         """Wrapper around adios2 DefineVariable method.
 
         Args:
@@ -48,17 +115,46 @@ class writer_base():
                 tuple of ints, shape of the variable
             dtype (type):
                 datatype of the variable
+            start (tuple[int]):
+                Offset of the block written by this rank. Defaults to zero.
+            count (tuple[int]):
+                Shape of the block written by this rank. Defaults to shape.
 
         Returns:
             self.variable (adios2.variable)
         """
+        if count is None:
+            count = shape
+        if start is None:
+            start = len(shape) * [0]
+        if self.downcast is not None and np.dtype(dtype) == np.float64:
+            dtype = self.downcast
         self.var_name = var_name
-        self.shape = shape
+        # Shape of the data passed to put_data
+        self.shape = tuple(count)
         self.dtype = dtype
-        self.variable = self.IO.DefineVariable(var_name, np.zeros(shape, dtype),
-                                               shape, len(shape) * [0], shape, adios2.ConstantDims)
+        self.variable = self.IO.DefineVariable(var_name, np.zeros(count, dtype),
+                                               list(shape), list(start), list(count),
+                                               adios2.ConstantDims)
+        for op, op_params in self.operators:
+            self.variable.AddOperation(op, op_params)
+        self.variables[var_name] = self.variable
         return(self.variable)
 
+    def DefineTraceVariable(self):
+        """Defines the variable that carries the trace context.
+
+        The trace context is an array [chunk_idx, t_send], where t_send is the time when
+        the step was sent, in seconds since the epoch. Readers use it to record the time a
+        chunk spent in transport, see :py:mod:`streaming.tracing`.
+
+        Returns:
+            self.trace_variable (adios2.variable)
+        """
+        self.trace_variable = self.IO.DefineVariable("trace_ctx", self.trace_ctx, [2], [0], [2],
+                                                     adios2.ConstantDims)
+        return self.trace_variable
+
     def DefineAttributes(self, attrsname: str, attrs: dict):
         """Wrapper around DefineAttribute.
 
@@ -88,20 +184,86 @@ class writer_base():
         """Opens a new channel."""
         if self.writer is None:
             self.writer = self.IO.Open(self.stream_name, adios2.Mode.Write)
+            if self.is_async:
+                self.sender_thread = threading.Thread(target=self._send_loop, daemon=True)
+                self.sender_thread.start()
 
     def Close(self):
-        """Wrapper for Close."""
+        """Wrapper for Close. In asynchronous mode, waits until all steps are written."""
+        if self.is_async and self.sender_thread is not None:
+            self.send_q.put(None)
+            self.sender_thread.join()
+            self.sender_thread = None
+            self._check_send_error()
         self.writer.Close()
+        self.stats.close()
 
     def BeginStep(self):
-        """Wrapper around writer.BeginStep."""
-        return self.writer.BeginStep()
+        """Wrapper around writer.BeginStep.
+
+        In asynchronous mode, waits until an output buffer is free.
+        """
+        if self.is_async:
+            self._check_send_error()
+            tic = time.perf_counter()
+            self.current_buf = self.free_q.get()
+            self.stats.add_beginstep(time.perf_counter() - tic)
+            self.current_vars = []
+            self.current_trace = None
+            return adios2.StepStatus.OK
+        tic = time.perf_counter()
+        res = self.writer.BeginStep()
+        self.stats.add_beginstep(time.perf_counter() - tic)
+        return res
 
     def EndStep(self):
-        """Wrapper around writer.EndStep."""
-        return self.writer.EndStep()
+        """Wrapper around writer.EndStep.
 
-    def put_data(self, data_class):
+        In asynchronous mode, hands the step to the sender thread and returns immediately.
+        """
+        if self.is_async:
+            self.send_q.put((self.current_buf, self.current_vars, self.current_trace))
+            self.current_buf = None
+            return None
+        tic = time.perf_counter()
+        res = self.writer.EndStep()
+        self.stats.add_endstep(time.perf_counter() - tic)
+        return res
+
+    def _send_loop(self):
+        """Writes steps handed over by EndStep. Executed by the sender thread."""
+        while True:
+            item = self.send_q.get()
+            if item is None:
+                return
+            buf_idx, var_names, chunk_idx = item
+            try:
+                if self.send_error is None:
+                    self.writer.BeginStep()
+                    if chunk_idx is not None:
+                        self.trace_buffers[buf_idx][:] = [chunk_idx, time.time()]
+                        self.writer.Put(self.trace_variable, self.trace_buffers[buf_idx],
+                                        adios2.Mode.Deferred)
+                    for var_name in var_names:
+                        self.writer.Put(self.variables[var_name],
+                                        self.buffers[buf_idx][var_name],
+                                        adios2.Mode.Deferred)
+                    # Deferred Puts are performed in EndStep
+                    tic = time.perf_counter()
+                    self.writer.EndStep()
+                    self.stats.add_endstep(time.perf_counter() - tic)
+            except Exception as e:
+                self.logger.error(f"writer_base: Failed to write step: {e}")
+                self.send_error = e
+            finally:
+                self.free_q.put(buf_idx)
+
+    def _check_send_error(self):
+        """Re-raises an exception that occured in the sender thread."""
+        if self.send_error is not None:
+            raise self.send_error
+
+    def put_data(self, data_class, var_name=None, deferred=False):
         """Opens a new stream and send data through it.
 
         ADIOS2 requires that the data array is contiguous in memory in
@@ -110,45 +272,88 @@ class writer_base():
         Args:
             data_class (2d-array type)
                 Data to send.
-            attrs (dict):
-                Additional meta-data
+            var_name (str):
+                Name of the variable to write. Defaults to the last variable defined.
+            deferred (bool):
+                If True, use a deferred Put. The data needs to stay valid until EndStep.
+                This allows to write multiple variables in a single step.
+                Asynchronous writers always use deferred Puts.
 
         Returns:
             None
         """
         assert(data_class.data.shape == self.shape)
+        variable = self.variable if var_name is None else self.variables[var_name]
+
+        if self.is_async:
+            # Copy data into the output buffer of the current step. The Put is performed
+            # by the sender thread. Data doesn't need to stay valid after this call.
+            if var_name is None:
+                var_name = self.var_name
+            tic = time.perf_counter()
+            buffer = self.buffers[self.current_buf].get(var_name)
+            if buffer is None:
+                buffer = np.zeros(self.shape, dtype=self.dtype)
+                self.buffers[self.current_buf][var_name] = buffer
+            np.copyto(buffer, data_class.data, casting="same_kind")
+            self.current_vars.append(var_name)
+            toc = time.perf_counter()
+            self.stats.add_transfer(buffer.nbytes, toc - tic, raw_bytes=data_class.data.nbytes)
+
+        elif self.writer is not None:
+            data = data_class.data
+            # Convert data into a buffer of the variable's type, f.ex. float64 to float32.
+            dt_convert = 0.0
+            if data.dtype != self.dtype:
+                tic = time.perf_counter()
+                if var_name not in self.downcast_buffers:
+                    self.downcast_buffers[var_name] = np.zeros(self.shape, dtype=self.dtype)
+                data = self.downcast_buffers[var_name]
+                np.copyto(data, data_class.data, casting="same_kind")
+                dt_convert = time.perf_counter() - tic
 
-        if self.writer is not None:
             # Assert that the data is continuous, as implicitly required by ADIOS2.
             # The burden to produce contiguous data is on the data producer.
-            assert(data_class.data.flags.contiguous)
+            assert(data.flags.contiguous)
             tic = time.perf_counter()
-            self.writer.Put(self.variable, data_class.data, adios2.Mode.Sync)
+            self.writer.Put(variable, data,
+                            adios2.Mode.Deferred if deferred else adios2.Mode.Sync)
             toc = time.perf_counter()
 
-            num_bytes = np.product(data_class.data.shape) * data_class.data.itemsize
+            num_bytes = np.prod(data.shape) * data.itemsize
             dt = toc - tic
-            self.stats.add_transfer(num_bytes, dt)
+            self.stats.add_transfer(num_bytes, dt, raw_bytes=data_class.data.nbytes,
+                                    convert_duration=dt_convert)
 
-    def transfer_stats(self):
-        """Calculates bandwidth statistics from the transfer."""
-        tr_sum, tr_max, tr_min, tr_mean, tr_std = self.stats.get_transfer_stats()
-        du_sum, du_max, du_min, du_mean, du_std = self.stats.get_duration_stats()
+    def put_trace(self, chunk_idx):
+        """Writes the trace context of the current step.
 
-        stats_str = "Summary:\n"
-        stats_str += "========"
-        stats_str += ""
-        stats_str += f"    total steps:         {self.stats.nsteps}"
-        stats_str += f"    total data (MB):     {(tr_sum / 1024 / 1024)}"
-        stats_str += f"    transfer times(sec): {(du_sum)}"
-        stats_str += f"    throughput (MB/sec): {tr_sum / 1024 / 1024 / du_sum}"
+        Does nothing if DefineTraceVariable was not called.
 
-        return stats_str
+        Args:
+            chunk_idx (int):
+                Index of the chunk sent in the current step
+
+        Returns:
+            None
+        """
+        if self.trace_variable is None:
+            return
+        if self.is_async:
+            # The send time is taken by the sender thread
+            self.current_trace = chunk_idx
+        elif self.writer is not None:
+            self.trace_ctx[:] = [chunk_idx, time.time()]
+            self.writer.Put(self.trace_variable, self.trace_ctx, adios2.Mode.Sync)
+
+    def transfer_stats(self):
+        """Returns a summary of the transfer statistics."""
+        return self.stats.summary()
 
 
 class writer_gen(writer_base):
     """I don't know why this is here - RK 2020-11-29."""
-    def __init__(self, cfg_transport, stream_name):
+    def __init__(self, cfg_transport, stream_name, comm=None):
         """Instantiates a writer.
 
         Control Adios method and params through transport section cfg
@@ -158,11 +363,13 @@ class writer_gen(writer_base):
                 This corresponds to the transport section.
             stream_name (str):
                 Name for the adios data stream
+            comm (MPI.Comm):
+                Communicator passed to ADIOS2. Defaults to MPI.COMM_SELF.
 
         Returns:
             None
         """
-        super().__init__(cfg_transport, stream_name)
+        super().__init__(cfg_transport, stream_name, comm)
         self.IO.SetEngine(cfg_transport["engine"])
         self.IO.SetParameters(cfg_transport["params"])
 
@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+
+"""Summarizes the kernel profiles written by the analysis workers.
+
+Prints kernel throughput and storage bandwidth per rank and per node.
+
+    python summarize_profiles.py --dir .
+"""
+
+import argparse
+
+from analysis.profiling import find_profiles, summarize_profiles
+
+parser = argparse.ArgumentParser(description="Summarizes profiles of analysis workers.")
+parser.add_argument('--dir', type=str, help="Directory with the profile files", default=".")
+args = parser.parse_args()
+
+per_rank, per_node = summarize_profiles(find_profiles(args.dir))
+
+
+def format_summary(summary):
+    """Formats the throughput summary of a rank or a node as a single line."""
+    return (f"{summary['num_tasks']:6d} tasks, {summary['num_pairs']:9d} pairs, "
+            f"kernel {summary['t_kernel']:9.3f}s ({summary['pairs_per_sec']:10.1f} pairs/s), "
+            f"storage {summary['t_io']:9.3f}s ({summary['io_MB_per_sec']:8.2f} MB/s), "
+            f"utilization {100.0 * summary['utilization']:5.1f}%")
+
+
+print("Per rank:")
+for (hostname, rank) in sorted(per_rank.keys()):
+    print(f"{hostname:>20s} {rank:4d}: {format_summary(per_rank[(hostname, rank)])}")
+print("Per node:")
+for hostname in sorted(per_node.keys()):
+    print(f"{hostname:>20s}     : {format_summary(per_node[hostname])}")
+
+# End of file summarize_profiles.py
@@ -14,4 +14,10 @@ def lint(session):
     """Syntax and docstring linting."""
     session.run("flake8")
 
+
+@nox.session()
+def benchmarks(session):
+    """Spectral kernel benchmarks. Pass arguments after --, f.ex. -- --compare base.json."""
+    session.run("python", "benchmarks/bench_kernels.py", *session.posargs)
+
 # End of file noxfile.py
@@ -0,0 +1,76 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Verify that the kernel benchmark harness runs and detects regressions."""
+
+
+def test_bench_kernels():
+    """Run the kernel benchmarks on a small problem."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('benchmarks'))
+    from types import SimpleNamespace
+    from unittest import mock
+    from bench_kernels import get_backends, get_batches, run_benchmarks, compare_results
+
+    batches = get_batches(300, 128)
+    assert([len(batch) for batch in batches] == [128, 128, 44])
+
+    backends = {"numpy.crosspower": get_backends()["numpy.crosspower"]}
+    results = run_benchmarks([64], [4], [100], [1, 2], batch_size=64, repeat=1,
+                             backends=backends)
+    assert(len(results) == 2)
+    for res in results:
+        assert(res["num_pairs"] == 100)
+        assert(res["pairs_per_sec"] > 0.0)
+        assert(res["GB_per_sec"] > 0.0)
+
+    # A baseline that is twice as fast flags all benchmarks as regressions
+    baseline = [{**res, "pairs_per_sec": 2.0 * res["pairs_per_sec"]} for res in results]
+    assert(len(compare_results(results, baseline, tolerance=0.2)) == 2)
+    assert(len(compare_results(results, results, tolerance=0.2)) == 0)
+
+    # Cython kernels match the precision of the input data
+    kernels_cy = SimpleNamespace(**{f"kernel_{name}_{prec}_cy": (name, prec)
+                                    for name in ["coherence", "crosspower", "crossphase"]
+                                    for prec in ["32", "64"]})
+    with mock.patch.dict(sys.modules, {"analysis.kernels_spectral_cy": kernels_cy}):
+        assert(get_backends(float32=True)["cython.coherence"] == ("coherence", "32"))
+        assert(get_backends()["cython.crossphase"] == ("crossphase", "64"))
+
+
+def test_bench_pipeline(tmp_path):
+    """Verify the synthetic data and the trace summary of the pipeline benchmark."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('benchmarks'))
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from bench_pipeline import write_synthetic_ecei, make_config, summarize_traces
+    from sources.loader_kstarecei import loader_kstarecei
+    from streaming.tracing import tracer
+
+    cfg = make_config(str(tmp_path), 2, 1000, ["coherence"], 512, str(tmp_path / "traces"))
+    assert(cfg["analysis"]["coherence"]["channel_chunk_size"] == 512)
+    write_synthetic_ecei(cfg["diagnostic"]["datasource"]["source_file"], 2000)
+    loader = loader_kstarecei(cfg)
+    chunks = [chunk.data.copy() for chunk in loader.batch_generator()]
+    assert(len(chunks) == 2)
+    assert(chunks[0].shape == (192, 1000))
+    assert(np.all(np.isfinite(chunks[1])))
+
+    # Two chunks, each received, then analyzed 0.5s later
+    tr = tracer(cfg["tracing"], "processor")
+    for chunk_idx in range(2):
+        tr.add_span("receive", chunk_idx, chunk_idx, chunk_idx + 0.1)
+        tr.add_span("task_coherence", chunk_idx, chunk_idx + 0.5, chunk_idx + 1.0)
+    tr.flush()
+
+    summary = summarize_traces(cfg["tracing"]["dir"])
+    assert(summary["num_chunks"] == 2)
+    assert(np.isclose(summary["chunks_per_sec"], 1.0))
+    assert(np.isclose(summary["latency"]["median"], 1.0))
+    assert(summary["stages"]["receive"]["count"] == 2)
+    assert(np.isclose(summary["stages"]["task_coherence"]["mean"], 0.5))
+
+
+# End of file test_benchmarks.py
@@ -0,0 +1,60 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for tracking the completion of analysis tasks."""
+
+
+def test_chunk_tracker():
+    """Verify that completed, failed and expired chunks are recorded."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from analysis.completion import chunk_tracker
+
+    def task(duration, fail=False):
+        time.sleep(duration)
+        if fail:
+            raise AttributeError("'list' object has no attribute 'shape'")
+        return duration
+
+    tracker = chunk_tracker({"deadline": 0.3})
+    records = []
+    tracker.add_callback(records.append)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Chunk 0 completes, a batch of chunk 1 fails.
+        tracker.add_chunk(0, [executor.submit(task, 0.01) for _ in range(3)])
+        tracker.add_chunk(1, [executor.submit(task, 0.01), executor.submit(task, 0.01, True)],
+                          stream_idx=1)
+        assert(tracker.wait(timeout=5.0))
+        assert(tracker.num_in_flight() == 0)
+
+        # Chunk 2 misses its deadline. The second batch is cancelled before it starts.
+        blocker = threading.Event()
+        futures = [executor.submit(blocker.wait, 5.0), executor.submit(task, 0.01)]
+        tracker.add_chunk(2, futures)
+        assert(tracker.num_in_flight() == 1)
+        time.sleep(0.5)
+        assert(futures[1].cancelled())
+        blocker.set()
+        assert(tracker.wait(timeout=5.0))
+
+    # A chunk without batches is complete right away
+    tracker.add_chunk(3, [])
+
+    records = {record["chunk_idx"]: record for record in records}
+    assert(records[0]["status"] == "ok" and records[0]["num_tasks"] == 3)
+    assert(records[1]["status"] == "failed" and records[1]["stream_idx"] == 1)
+    assert(records[1]["num_failed"] == 1 and "shape" in records[1]["errors"][0])
+    assert(records[2]["status"] == "expired" and records[2]["num_cancelled"] == 1)
+    assert(records[2]["duration"] >= 0.3)
+    assert(records[3]["status"] == "ok")
+    stats = tracker.to_dict()
+    assert((stats["num_ok"], stats["num_failed"], stats["num_expired"]) == (2, 1, 1))
+    assert(stats["num_in_flight"] == 0)
+    assert(stats["duration"]["count"] == 4)
+
+
+# End of file test_completion.py
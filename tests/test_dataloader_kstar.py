@@ -66,9 +66,10 @@ def test_dataloader_ecei_cached(config_all, stream_attrs_018431):
 
 
 def test_dataloader_ecei_nocache(config_all, stream_attrs_018431):
-    """Verify that _dataloader_ecei works correctly when using cached data."""
+    """Verify that _dataloader_ecei works correctly when streaming data."""
     import sys
     import os
+    import copy
     sys.path.append(os.path.abspath('delta'))
     import numpy as np
     # # Import packages as delta.... so that we can run pytest as 
@@ -80,18 +81,182 @@ def test_dataloader_ecei_nocache(config_all, stream_attrs_018431):
     def read_attrs_dummy(cls):
         return read_attributes_from_hdf5_dummy(cls, stream_attrs_018431)
 
-    cfg_all = config_all
+    cfg_all = copy.deepcopy(config_all)
+    cfg_all["diagnostic"]["datasource"]["cache"] = False
     # Instantiate a loader where _read_from_hdf5 is replaced with load_dummy_data
     # with mock.patch.object(_loader_ecei, "_read_from_hdf5", new=read_from_hdf5_dummy):
     with mock.patch.multiple(loader_kstarecei, _read_from_hdf5=read_from_hdf5_dummy,
                              _read_attributes_from_hdf5=read_attrs_dummy):
 
         my_loader = loader_kstarecei(cfg_all)
+        assert(not my_loader.is_cached)
 
         assert(my_loader.get_chunk_shape() == (192, cfg_all["diagnostic"]["datasource"]["chunk_size"]))
+        num_batches = 0
         for batch in my_loader.batch_generator():
             # Mean should be roughly 3.5, depending on what use as dummy data
             assert(np.abs(np.mean(batch.data) - 3.5) < 1e-2)
+            assert(batch.tb.chunk_idx == num_batches)
+            num_batches += 1
+        assert(num_batches == my_loader.num_chunks)
+
+
+def write_ecei_hdf5_dummy(fname, num_samples, dev="L"):
+    """Writes a dummy ECEI HDF5 file, using the layout of KSTAR ECEI files.
+
+    Returns:
+        voltages (ndarray):
+            Data written into the file, shape=(192, num_samples)
+    """
+    import h5py
+
+    voltages = np.random.randint(-1000, 40000, [192, num_samples]).astype(np.float64)
+    with h5py.File(fname, "w") as df:
+        grp = df.create_group("ECEI")
+        grp.attrs["SampleRate"] = np.array([500.0])
+        grp.attrs["TriggerTime"] = np.array([-0.1, 61.1, 60.0])
+        grp.attrs["TFcurrent"] = 18.0
+        grp.attrs["Mode"] = b"X"
+        grp.attrs["LoFreq"] = 79.5
+        grp.attrs["LensFocus"] = 503
+        grp.attrs["LensZoom"] = 200
+        for ch_v in range(1, 25):
+            for ch_h in range(1, 9):
+                grp.create_dataset(f"ECEI_{dev}{ch_v:02d}{ch_h:02d}/Voltage",
+                                   data=voltages[(ch_v - 1) * 8 + ch_h - 1, :].astype(np.int32),
+                                   chunks=(500, ))
+
+    return voltages
+
+
+def test_dataloader_ecei_hdf5(config_all, tmp_path):
+    """Verify that channels read from HDF5 are scaled and placed in the correct rows."""
+    import sys
+    import os
+    import copy
+    sys.path.append(os.path.abspath('delta'))
+    from delta.sources.loader_kstarecei import loader_kstarecei
+
+    cfg_all = copy.deepcopy(config_all)
+    cfg_all["diagnostic"]["datasource"]["chunk_size"] = 1000
+    cfg_all["diagnostic"]["datasource"]["num_chunks"] = 3
+    cfg_all["diagnostic"]["datasource"]["source_file"] = str(tmp_path / "ECEI.022289.L.h5")
+    voltages = write_ecei_hdf5_dummy(cfg_all["diagnostic"]["datasource"]["source_file"], 3000)
+
+    for num_read_threads, cache in [(1, True), (4, True), (1, False)]:
+        cfg_all["diagnostic"]["datasource"]["num_read_threads"] = num_read_threads
+        cfg_all["diagnostic"]["datasource"]["cache"] = cache
+        my_loader = loader_kstarecei(cfg_all)
+        assert(my_loader.attrs["SampleRate"] == 5e5)
+        for idx, batch in enumerate(my_loader.batch_generator()):
+            assert(np.allclose(batch.data, voltages[:, idx * 1000:(idx + 1) * 1000] * 1e-4))
+
+
+def test_dataloader_memmap(config_all, tmp_path):
+    """Verify that a converted shot is replayed from a memory-mapped file without copies."""
+    import sys
+    import os
+    import copy
+    sys.path.append(os.path.abspath('delta'))
+    from delta.sources.loader_memmap import convert_to_memmap
+    from delta.sources.helpers import get_loader
+
+    cfg_all = copy.deepcopy(config_all)
+    cfg_all["diagnostic"]["datasource"]["chunk_size"] = 1000
+    cfg_all["diagnostic"]["datasource"]["num_chunks"] = 3
+    cfg_all["diagnostic"]["datasource"]["source_file"] = str(tmp_path / "ECEI.022289.L.h5")
+    voltages = write_ecei_hdf5_dummy(cfg_all["diagnostic"]["datasource"]["source_file"], 3000)
+    convert_to_memmap(cfg_all, str(tmp_path / "ECEI.022289.L.npy"))
+
+    cfg_all["diagnostic"]["datasource"]["format"] = "memmap"
+    cfg_all["diagnostic"]["datasource"]["source_file"] = str(tmp_path / "ECEI.022289.L.npy")
+    my_loader = get_loader(cfg_all)
+    assert(my_loader.dtype == np.float32)
+    assert(my_loader.attrs["dev"] == "L")
+    assert(my_loader.get_chunk_shape() == (192, 1000))
+
+    num_batches = 0
+    for idx, batch in enumerate(my_loader.batch_generator()):
+        assert(batch.data.flags.contiguous)
+        assert(np.shares_memory(batch.data, my_loader.data))
+        assert(np.allclose(batch.data, voltages[:, idx * 1000:(idx + 1) * 1000] * 1e-4))
+        num_batches += 1
+    assert(num_batches == 3)
+
+    # A shard of the channel range selects its rows from the file
+    cfg_all["diagnostic"]["datasource"]["channel_range"] = ["L0701-1208"]
+    my_loader = get_loader(cfg_all)
+    assert(my_loader.get_chunk_shape() == (48, 1000))
+    for idx, batch in enumerate(my_loader.batch_generator()):
+        assert((batch.num_v, batch.num_h) == (6, 8))
+        assert(np.shares_memory(batch.data, my_loader.data))
+        assert(np.allclose(batch.data, voltages[48:96, idx * 1000:(idx + 1) * 1000] * 1e-4))
+
+
+def test_dataloader_ecei_multi(config_all, tmp_path):
+    """Verify that aligned time-chunks of multiple devices are read in a single pass."""
+    import sys
+    import os
+    import copy
+    sys.path.append(os.path.abspath('delta'))
+    from delta.sources.helpers import get_loader
+
+    cfg_all = copy.deepcopy(config_all)
+    cfg_all["diagnostic"]["datasource"]["chunk_size"] = 1000
+    cfg_all["diagnostic"]["datasource"]["num_chunks"] = 3
+    cfg_all["diagnostic"]["datasource"]["source_file"] = []
+    cfg_all["diagnostic"]["datasource"]["channel_range"] = []
+    voltages = []
+    for dev in ["L", "G", "H"]:
+        fname = str(tmp_path / f"ECEI.022289.{dev}.h5")
+        voltages.append(write_ecei_hdf5_dummy(fname, 3000, dev))
+        cfg_all["diagnostic"]["datasource"]["source_file"].append(fname)
+        cfg_all["diagnostic"]["datasource"]["channel_range"].append(f"{dev}0101-2408")
+
+    my_loader = get_loader(cfg_all)
+    assert(my_loader.var_names == ["L0101-2408", "G0101-2408", "H0101-2408"])
+    assert([attrs["dev"] for attrs in my_loader.attrs.values()] == ["L", "G", "H"])
+    assert(my_loader.get_chunk_shape() == (192, 1000))
+
+    num_batches = 0
+    for idx, chunk_list in enumerate(my_loader.batch_generator()):
+        assert(len(chunk_list) == 3)
+        for chunk, voltages_dev in zip(chunk_list, voltages):
+            assert(chunk.tb.chunk_idx == idx)
+            assert(chunk.data.flags.contiguous)
+            assert(np.allclose(chunk.data, voltages_dev[:, idx * 1000:(idx + 1) * 1000] * 1e-4))
+        num_batches += 1
+    assert(num_batches == 3)
+
+
+def test_dataloader_ecei_shards(config_all, tmp_path):
+    """Verify that shards of a channel range load disjoint blocks of rows."""
+    import sys
+    import os
+    import copy
+    sys.path.append(os.path.abspath('delta'))
+    from delta.sources.loader_kstarecei import loader_kstarecei
+    from delta.data_models.kstar_ecei import shard_channel_range
+
+    assert(shard_channel_range("L0101-2408", 1, 4) == ("L0701-1208", 48))
+    assert(shard_channel_range("L0101-2408", 4, 5) == ("L2101-2408", 160))
+
+    cfg_all = copy.deepcopy(config_all)
+    cfg_all["diagnostic"]["datasource"]["chunk_size"] = 1000
+    cfg_all["diagnostic"]["datasource"]["num_chunks"] = 2
+    cfg_all["diagnostic"]["datasource"]["source_file"] = str(tmp_path / "ECEI.022289.L.h5")
+    voltages = write_ecei_hdf5_dummy(cfg_all["diagnostic"]["datasource"]["source_file"], 2000)
+
+    num_shards = 5
+    shard_data = []
+    for rank in range(num_shards):
+        shard_str, row_offset = shard_channel_range("L0101-2408", rank, num_shards)
+        cfg_all["diagnostic"]["datasource"]["channel_range"] = [shard_str]
+        my_loader = loader_kstarecei(cfg_all)
+        assert(row_offset == sum([data.shape[0] for data in shard_data]))
+        shard_data.append(np.hstack([batch.data for batch in my_loader.batch_generator()]))
+
+    assert(np.allclose(np.vstack(shard_data), voltages * 1e-4))
 
 
 # End of file test_dataloader_kstar.py
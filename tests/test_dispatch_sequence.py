@@ -0,0 +1,65 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for bad-channel aware dispatch sequences."""
+
+
+def test_filter_dispatch_sequence(config_all):
+    """Verify that pairs including bad channels are removed from the dispatch sequence."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from data_models.helpers import get_dispatch_sequence, filter_dispatch_sequence
+
+    params = config_all["analysis"]["coherence"]
+    dispatch_seq = get_dispatch_sequence(params["ref_channels"], params["cmp_channels"], 1000)
+
+    bad_channels = np.zeros(192, dtype=bool)
+    # Without bad channels, all batches are passed through unchanged.
+    for (ch_it, pair_idx), ch_it_orig in zip(filter_dispatch_sequence(dispatch_seq, bad_channels),
+                                             dispatch_seq):
+        assert(pair_idx is None)
+        assert(len(ch_it) == len(ch_it_orig))
+
+    bad_channels[[3, 17, 100]] = True
+    filtered_seq = filter_dispatch_sequence(dispatch_seq, bad_channels)
+    assert(len(filtered_seq) == len(dispatch_seq))
+    for (ch_it, pair_idx), ch_it_orig in zip(filtered_seq, dispatch_seq):
+        if pair_idx is None:
+            pair_idx = np.arange(len(ch_it_orig))
+        assert(len(ch_it) == len(pair_idx))
+        for ch_pair, idx in zip(ch_it, pair_idx):
+            assert(ch_pair == ch_it_orig[idx])
+            assert(not bad_channels[ch_pair.ch1.get_idx()])
+            assert(not bad_channels[ch_pair.ch2.get_idx()])
+
+    # 192 * 193 / 2 unique pairs. 189 * 190 / 2 of them don't include a bad channel.
+    assert(sum([len(ch_it) for ch_it, _ in filtered_seq]) == 189 * 190 // 2)
+
+
+def test_expand_result(gen_sine_waves):
+    """Verify that results of filtered batches keep the layout of the full batch."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from analysis.kernels_spectral import kernel_coherence
+    from analysis.task_base import expand_result
+    from data_models.channels_2d import channel_2d, channel_pair
+
+    ch1 = channel_2d(1, 1, 2, 1, "horizontal")
+    ch2 = channel_2d(2, 1, 2, 1, "horizontal")
+    ch_it = [channel_pair(ch1, ch1), channel_pair(ch1, ch2), channel_pair(ch2, ch2)]
+
+    fft_data = gen_sine_waves
+    result_all = kernel_coherence(fft_data, ch_it, None)
+    pair_idx = np.array([0, 2])
+    result = expand_result(kernel_coherence(fft_data, [ch_it[i] for i in pair_idx], None),
+                           pair_idx, len(ch_it))
+
+    assert(result.shape == result_all.shape)
+    assert(np.all(np.isnan(result[1, :])))
+    assert(np.allclose(result[pair_idx, :], result_all[pair_idx, :]))
+
+
+# End of file test_dispatch_sequence.py
@@ -0,0 +1,69 @@
+# -*- Encoding: UTF-8 -*-
+
+"""End-to-end test of the streams written by the generator."""
+
+from tests.test_dataloader_kstar import write_ecei_hdf5_dummy
+
+
+def test_generator_multi_device(config_all, tmp_path):
+    """Verify that each device is streamed on the stream that the processor reads."""
+    import sys
+    import os
+    import copy
+    import json
+    import subprocess
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from streaming.helpers import get_reader
+    from data_models.helpers import gen_stream_cfgs, gen_channel_name, gen_var_name
+    from data_models.helpers import data_model_generator
+
+    cfg = copy.deepcopy(config_all)
+    cfg["diagnostic"]["dev"] = "LGH"
+    cfg["diagnostic"]["datasource"]["chunk_size"] = 1000
+    cfg["diagnostic"]["datasource"]["num_chunks"] = 3
+    # Chunks are not normalized
+    cfg["diagnostic"]["datasource"]["t_norm"] = [9.0, 9.1]
+    cfg["diagnostic"]["datasource"]["source_file"] = []
+    cfg["diagnostic"]["datasource"]["channel_range"] = []
+    voltages = []
+    for dev in ["L", "G", "H"]:
+        fname = str(tmp_path / f"ECEI.022289.{dev}.h5")
+        voltages.append(write_ecei_hdf5_dummy(fname, 3000, dev))
+        cfg["diagnostic"]["datasource"]["source_file"].append(fname)
+        cfg["diagnostic"]["datasource"]["channel_range"].append(f"{dev}0101-2408")
+    cfg["diagnostic"]["shotnr"] = os.getpid()
+    cfg["transport_tx"] = {"engine": "shm", "num_slots": 4, "close_timeout": 30.0}
+    del cfg["analysis"]
+    with open(tmp_path / "generator.json", "w") as df:
+        json.dump(cfg, df)
+
+    proc = subprocess.Popen([sys.executable, "generator.py", "--config",
+                             str(tmp_path / "generator.json"), "--slow", "0.0"],
+                            cwd=os.path.abspath("delta"))
+    try:
+        # Read the streams like the processor does
+        for stream_cfg, dev, voltages_dev in zip(gen_stream_cfgs(cfg), ["L", "G", "H"],
+                                                 voltages):
+            reader = get_reader({"engine": "shm", "open_timeout": 30.0},
+                                gen_channel_name(stream_cfg["diagnostic"]))
+            reader.Open()
+            data_model_gen = data_model_generator(stream_cfg["diagnostic"])
+            num_steps = 0
+            while reader.BeginStep(timeoutSeconds=30.0):
+                stream_attrs = reader.get_attrs("stream_attrs")
+                assert(stream_attrs["dev"] == dev)
+                chunk = data_model_gen.new_chunk(reader.Get(gen_var_name(stream_cfg)[0]),
+                                                 stream_attrs, reader.CurrentStep())
+                idx = chunk.tb.chunk_idx
+                assert(np.allclose(chunk.data, voltages_dev[:, idx * 1000:(idx + 1) * 1000] * 1e-4))
+                num_steps += 1
+                reader.EndStep()
+            reader.Close()
+            assert(num_steps == 3)
+        assert(proc.wait(timeout=30.0) == 0)
+    finally:
+        proc.kill()
+
+
+# End of file test_generator_streams.py
@@ -248,4 +248,48 @@ def test_ecei_channel_geom(stream_attrs_018431, stream_attrs_022289):
 
         assert(np.linalg.norm(pos_true - pos_delta) < 1e-8)
 
+
+def test_abcd_vectorized():
+    """Verify ABCD matrices for an array of Rinit against reference and scalar values."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from delta.data_models.kstar_ecei import get_abcd
+
+    # Reference values from the per-channel matrix products, for Rinit=1.6 and 2.3
+    abcd_ref = {"L": [[[-1.2932958729, -465.96094827], [-3.0924050378e-4, -0.88463438440]],
+                      [[-1.0768275203, 153.28312082], [-3.0924050378e-4, -0.88463438440]]],
+                "H": [[[-1.2930176408, -461.06482931], [-6.7691817879e-5, -0.79752223319]],
+                      [[-1.2456333683, 97.200733924], [-6.7691817879e-5, -0.79752223319]]],
+                "G": [[[-2.2396080270, 211.88571318], [-4.9026774552e-5, -0.44186836044]],
+                      [[-2.2052892848, 521.19356548], [-4.9026774552e-5, -0.44186836044]]],
+                "GT": [[[-1.4042148625, -493.06004796], [-2.6582984316e-4, -0.80548219890]],
+                       [[-1.2181339723, 70.777491277], [-2.6582984316e-4, -0.80548219890]]],
+                "HT": [[[-0.8859561509, -1017.7705478], [-1.4912292611e-4, -1.3000337782]],
+                       [[-0.7815701026, -107.74690310], [-1.4912292611e-4, -1.3000337782]]]}
+    abcd_ref["GR"] = abcd_ref["GT"]
+
+    rinit_arr = np.linspace(1.6, 2.3, 17)
+    for dev in ['L', 'H', 'G', 'GT', 'GR', 'HT']:
+        abcd_arr = get_abcd(503, 200, rinit_arr, dev)
+        assert(abcd_arr.shape == (rinit_arr.size, 2, 2))
+        assert(np.allclose(abcd_arr[[0, -1]], abcd_ref[dev], rtol=1e-9, atol=0.0))
+        for rinit, abcd in zip(rinit_arr, abcd_arr):
+            assert(np.allclose(get_abcd(503, 200, rinit, dev), abcd))
+
+
+def test_ecei_geometry_cached(stream_attrs_022289):
+    """Verify that geometry is cached and can't be modified by the caller."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import pytest
+    from delta.data_models.kstar_ecei import get_geometry
+
+    rpos_arr, zpos_arr, apos_arr = get_geometry(stream_attrs_022289)
+    assert(get_geometry(dict(stream_attrs_022289))[0] is rpos_arr)
+    with pytest.raises(ValueError):
+        zpos_arr[0] = 0.0
+
 # End of file test_kstar_ecei_helpers.py
@@ -0,0 +1,102 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for pre-processing time chunks on the analysis workers."""
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+def test_locality_dispatcher(stream_attrs_022289, monkeypatch, tmp_path):
+    """Verify that locality-aware dispatch gives the same results as on-node pre-processing."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import copy
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from types import SimpleNamespace
+    import numpy as np
+    from data_models.kstar_ecei import ecei_chunk
+    from data_models.timebase import timebase_streaming
+    from preprocess.preprocess import preprocessor
+    from analysis.task_base import task_base
+    from analysis.locality import locality_dispatcher
+    from analysis import profiling
+
+    # Write the kernel profile to tmp_path
+    monkeypatch.setenv("DELTA_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "_profiler", None)
+
+    def kernel_power(data, ch_it, params):
+        """Returns the mean power of the reference channel of each pair."""
+        return np.array([(np.abs(data[p.ch1.get_idx()]) ** 2).mean() for p in ch_it])
+
+    stored = []
+
+    class storage_list():
+        def __init__(self, cfg):
+            pass
+
+        def store_metadata(self, params):
+            pass
+
+        def store_data(self, result, info_dict):
+            stored.append((result, info_dict))
+
+    class task_power(task_base):
+        def _get_kernel(self):
+            return kernel_power
+
+    cfg = {"preprocess": {"bandpass_fir": {"N": 4, "Wn": [0.02, 0.2], "btype": "bandpass",
+                                           "output": "sos"},
+                          "stft": {"nfft": 256, "fs": 500000, "window": "hann", "overlap": 0.5,
+                                   "detrend": "constant", "full": True}},
+           "storage": {"backend": "null"}}
+    params = {"channel_chunk_size": 100, "ref_channels": [1, 1, 4, 8], "cmp_channels": [1, 1, 4, 8]}
+    with mock.patch("analysis.task_base.get_storage_object", return_value=storage_list):
+        my_task = task_power(params, {"backend": "list"})
+    my_task_list = SimpleNamespace(tasklist=[my_task])
+
+    rng = np.random.default_rng(1)
+    tb = timebase_streaming(-0.1, 9.9, 5e5, 10_000, 0)
+    data = rng.normal(1.0, 0.1, [192, 10_000])
+
+    def get_results():
+        rows = sorted(stored, key=lambda item: item[1]["channel_batch"])
+        stored.clear()
+        return np.concatenate([res for res, _ in rows])
+
+    cfg_preprocess = copy.deepcopy(cfg["preprocess"])
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        my_preprocessor = preprocessor(executor, cfg)
+        # Pre-process on-node, send Fourier coefficients to the workers
+        chunk = my_preprocessor.submit(ecei_chunk(data.copy(), tb, params=stream_attrs_022289))
+        wait(my_task.execute(chunk, executor))
+        expected = get_results()
+
+        # Send the raw chunk to the workers
+        dispatcher = locality_dispatcher(executor, 3, cfg_preprocess, my_task_list,
+                                         my_preprocessor, shares_per_worker=1)
+        futures = dispatcher.execute(ecei_chunk(data.copy(), tb, params=stream_attrs_022289))
+        wait(futures)
+        result = get_results()
+
+        # The number of shares is given by num_workers, not by the executor.
+        # By default, each worker gets 2 shares.
+        dispatcher = locality_dispatcher(executor, 2, cfg_preprocess, my_task_list,
+                                         my_preprocessor)
+        futures_2 = dispatcher.execute(ecei_chunk(data.copy(), tb, params=stream_attrs_022289))
+        wait(futures_2)
+        result_2 = get_results()
+
+    assert(len(futures) == 3)
+    assert(all([fut.exception() is None for fut in futures]))
+    # 6 batches of 100 pairs on 3 workers
+    assert([len(fut.result()) for fut in futures] == [2, 2, 2])
+    assert(np.allclose(result, expected))
+    assert([len(fut.result()) for fut in futures_2] == [2, 2, 1, 1])
+    assert(np.allclose(result_2, expected))
+
+
+# End of file test_locality.py
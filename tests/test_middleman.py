@@ -0,0 +1,111 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for forwarding in the middleman."""
+
+
+class fake_reader():
+    """Returns num_steps steps with constant data."""
+    def __init__(self, num_steps):
+        self.num_steps = num_steps
+        self.step = -1
+        self.out_list = []
+
+    def BeginStep(self):
+        self.step += 1
+        return self.step < self.num_steps
+
+    def CurrentStep(self):
+        return self.step
+
+    def EndStep(self):
+        pass
+
+    def InquireAttribute(self, attrname):
+        return True
+
+    def get_attrs(self, attrsname):
+        return {"SampleRate": 500.0}
+
+    def get_trace(self):
+        return None
+
+    def Get(self, varname, save=False, copy=True, out=None):
+        import numpy as np
+        self.out_list.append(out)
+        if out is None:
+            out = np.zeros((4, 16))
+        out[:] = self.step
+        return out
+
+
+def test_middleman_forward():
+    """Verify that each step is read once and forwarded from pooled buffers."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import queue
+    import threading
+    from unittest.mock import MagicMock
+    import numpy as np
+    from middleman import buffer_pool, receive, forward
+
+    num_steps = 5
+    reader = fake_reader(num_steps)
+    writer = MagicMock()
+    put_list = []
+    # Record the buffer and its content when it is written
+    writer.put_data.side_effect = lambda msg, deferred: put_list.append((msg.data,
+                                                                         msg.data[0, 0],
+                                                                         deferred))
+
+    Q = queue.Queue()
+    pool = buffer_pool(2)
+    worker = threading.Thread(target=forward, args=(Q, writer, "L0101-2408", pool))
+    worker.start()
+    rx_list = receive(reader, "L0101-2408", Q, pool)
+    worker.join()
+
+    assert(rx_list == list(range(num_steps)))
+    # Data is read once per step. Only the first two reads allocate a buffer.
+    assert(len(reader.out_list) == num_steps)
+    assert(reader.out_list[0] is None and reader.out_list[1] is None)
+    assert(all([out is not None for out in reader.out_list[2:]]))
+    # The data of each step is forwarded with a deferred Put from the receive buffer
+    assert([val for _, val, _ in put_list] == list(range(num_steps)))
+    assert(all([deferred for _, _, deferred in put_list]))
+    assert(len(set([id(buf) for buf, _, _ in put_list])) <= 2)
+    writer.DefineVariable.assert_called_once_with("L0101-2408", (4, 16), np.float64)
+    writer.DefineAttributes.assert_called_once_with("stream_attrs", {"SampleRate": 500.0})
+    assert(writer.EndStep.call_count == num_steps)
+    writer.Close.assert_called_once()
+
+
+def test_middleman_forward_error():
+    """Verify that receive stops with an error when the forward thread fails."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import MagicMock
+    import pytest
+    from middleman import buffer_pool, receive, forward_or_abort
+
+    reader = fake_reader(100)
+    writer = MagicMock()
+    writer.EndStep.side_effect = IOError("Connection lost")
+
+    Q = queue.Queue()
+    pool = buffer_pool(2)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fut = executor.submit(forward_or_abort, Q, writer, "L0101-2408", pool)
+        with pytest.raises(RuntimeError) as excinfo:
+            receive(reader, "L0101-2408", Q, pool)
+
+    assert(isinstance(fut.exception(), IOError))
+    assert(excinfo.value.__cause__ is fut.exception())
+    # Receive stops once it runs out of buffers
+    assert(reader.step < 5)
+
+
+# End of file test_middleman.py
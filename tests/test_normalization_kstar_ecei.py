@@ -53,8 +53,42 @@ def test_normalization(gen_dummy_data, caplog):
     assert(np.abs(my_chunk.data.mean()) < 1e-8)
 
 
+def test_mark_bad_channels(gen_dummy_data):
+    """Verify that bad channels are marked with the correct reason code."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from data_models.kstar_ecei import ecei_chunk, bad_channel_summary
+    from data_models.kstar_ecei import BAD_LOW_SIGNAL, BAD_SAT_BOTTOM, BAD_SAT_TOP
+    from data_models.helpers import normalize_mean
+
+    data = gen_dummy_data
+    # Channel 3 has a constant offset: bottom saturated.
+    # Channel 7 has a constant signal: top saturated.
+    # Channel 11 has a small signal level: low signal.
+    data_norm = data.copy()
+    data_norm[3, :] = 1.0
+    data[7, :] = 5.0
+    data[11, :] = data_norm[11, :] + 1e-3
+
+    my_chunk = ecei_chunk(data, tb=None)
+    norm = normalize_mean(data_norm)
+    norm(my_chunk)
 
+    reason = my_chunk.bad_channel_reason
+    assert(reason.dtype == np.uint8)
+    assert(reason[3] & BAD_SAT_BOTTOM)
+    assert(reason[7] & BAD_SAT_TOP)
+    assert(reason[11] & BAD_LOW_SIGNAL)
+    assert(np.array_equal(my_chunk.bad_channels, reason > 0))
+    assert("SAT signal: 1 [0108]" in bad_channel_summary(reason))
 
+    # Channels that were marked before remain marked
+    my_chunk.bad_channels[20] = True
+    my_chunk.mark_bad_channels()
+    assert(my_chunk.bad_channels[20] and my_chunk.bad_channels[3])
+    assert(my_chunk.bad_channel_reason[3] & BAD_SAT_BOTTOM)
 
 
-# # End of file test_normalization_kstar_ecei.py
+# End of file test_normalization_kstar_ecei.py
@@ -0,0 +1,117 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for the 2D decomposition of the pair matrix."""
+
+
+def test_grid_pairs():
+    """Verify that the ranks of a grid compute each unique pair once and share the work."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from analysis.pair_grid import get_grid_pairs
+
+    for num_channels in [192, 576]:
+        for grid_size in [1, 2, 3, 4]:
+            pairs = [get_grid_pairs(num_channels, grid_size, row, col)
+                     for row in range(grid_size) for col in range(grid_size)]
+            all_pairs = np.concatenate(pairs)
+            assert((all_pairs[:, 0] <= all_pairs[:, 1]).all())
+            assert(len(all_pairs) == num_channels * (num_channels + 1) // 2)
+            assert(len(np.unique(all_pairs, axis=0)) == len(all_pairs))
+            num_pairs = [len(p) for p in pairs]
+            assert(max(num_pairs) - min(num_pairs) <= num_channels)
+
+
+def test_pair_grid():
+    """Verify that a grid computes the same result as a kernel on all spectra."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from mpi4py import MPI
+    from analysis.pair_grid import pair_grid, block_channel
+    from analysis.kernels_spectral import kernel_crossphase
+    from data_models.channels_2d import channel_pair
+
+    rng = np.random.default_rng(1)
+    fft_data = rng.normal(size=(192, 16, 5)) + 1j * rng.normal(size=(192, 16, 5))
+    bad_channels = np.zeros(192, dtype=bool)
+    bad_channels[17] = True
+
+    grid = pair_grid(MPI.COMM_SELF, 192)
+    start, stop = grid.get_owned_range()
+    assert((start, stop) == (0, 192))
+    pairs, result = grid.compute(kernel_crossphase, fft_data[start:stop], None, bad_channels)
+
+    assert(len(pairs) == 192 * 193 // 2 - 192)
+    assert(not (pairs == 17).any())
+    ch_it = [channel_pair(block_channel(ch1), block_channel(ch2)) for ch1, ch2 in pairs]
+    assert(np.allclose(result, kernel_crossphase(fft_data, ch_it, None)))
+
+
+def check_pair_grid_world():
+    """Computes the pairs of each rank of MPI_COMM_WORLD and checks them on rank 0.
+
+    Executed on 4 ranks by test_pair_grid_mpi.
+    """
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from mpi4py import MPI
+    from analysis.pair_grid import pair_grid, block_channel
+    from analysis.kernels_spectral import kernel_crossphase
+    from data_models.channels_2d import channel_pair
+
+    comm = MPI.COMM_WORLD
+    # All ranks generate the same spectra and use the channels they own
+    rng = np.random.default_rng(1)
+    fft_data = rng.normal(size=(192, 16, 5)) + 1j * rng.normal(size=(192, 16, 5))
+    bad_channels = np.zeros(192, dtype=bool)
+    bad_channels[[17, 150]] = True
+
+    grid = pair_grid(comm, 192)
+    start, stop = grid.get_owned_range()
+    pairs, result = grid.compute(kernel_crossphase, fft_data[start:stop], None, bad_channels)
+    all_pairs = comm.gather(pairs, root=0)
+    all_results = comm.gather(result, root=0)
+    if comm.Get_rank() != 0:
+        return
+
+    assert(grid.grid_size == 2)
+    pairs = np.concatenate(all_pairs)
+    result = np.concatenate(all_results)
+    assert(len(pairs) == 190 * 191 // 2)
+    assert(len(np.unique(pairs, axis=0)) == len(pairs))
+    ch_it = [channel_pair(block_channel(ch1), block_channel(ch2)) for ch1, ch2 in pairs]
+    assert(np.allclose(result, kernel_crossphase(fft_data, ch_it, None)))
+    print("check_pair_grid_world: OK")
+
+
+def test_pair_grid_mpi():
+    """Verify that 4 ranks in a 2 x 2 grid compute each pair once, with the correct result.
+
+    The ranks are launched with mpiexec. Skipped if mpiexec is not available.
+    """
+    import sys
+    import os
+    import shutil
+    import subprocess
+    import pytest
+
+    mpiexec = shutil.which("mpiexec")
+    if mpiexec is None:
+        pytest.skip("mpiexec not found")
+    # Allow Open MPI to start 4 ranks on fewer cores, also as root. Other MPIs ignore these.
+    env = {**os.environ, "OMPI_MCA_rmaps_base_oversubscribe": "1",
+           "OMPI_ALLOW_RUN_AS_ROOT": "1", "OMPI_ALLOW_RUN_AS_ROOT_CONFIRM": "1"}
+    proc = subprocess.run([mpiexec, "-n", "4", sys.executable, "-c",
+                           "from tests.test_pair_grid import check_pair_grid_world; " +
+                           "check_pair_grid_world()"],
+                          env=env, capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    assert("check_pair_grid_world: OK" in proc.stdout)
+
+
+# End of file test_pair_grid.py
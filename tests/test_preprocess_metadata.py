@@ -0,0 +1,55 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for chunk metadata storage in the pre-processing pipeline."""
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+def test_store_metadata(config_all, stream_attrs_022289):
+    """Verify that static metadata is stored once and chunk metadata is batched."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from data_models.kstar_ecei import ecei_chunk
+    from data_models.timebase import timebase_streaming
+    from preprocess.preprocess import preprocessor
+    from storage.backend_null import backend_null
+
+    cfg = {"preprocess": {}, "storage": {"backend": "null", "metadata_batch_size": 4}}
+    stored_items = []
+
+    def store_many_dummy(cls, items):
+        stored_items.extend(items)
+
+    with mock.patch.object(backend_null, "store_many", new=store_many_dummy):
+        executor = ThreadPoolExecutor(max_workers=2)
+        my_preprocessor = preprocessor(executor, cfg)
+
+        for chunk_idx in range(10):
+            tb = timebase_streaming(-0.1, 9.9, 5e5, 10_000, chunk_idx)
+            chunk = ecei_chunk(np.zeros([192, 10]), tb, params=stream_attrs_022289)
+            if chunk_idx >= 5:
+                chunk.bad_channels[17] = True
+            my_preprocessor.store_metadata(chunk)
+
+        my_preprocessor.flush_metadata()
+        executor.shutdown(wait=True)
+
+    descriptions = [item["description_new"] for item in stored_items]
+    assert(descriptions.count("run_metadata") == 1)
+    assert(descriptions.count("bad_channel_mask") == 2)
+    assert(descriptions.count("chunk_metadata") == 10)
+
+    masks = {item["mask_id"]: item["bad_channels"] for item in stored_items
+             if item["description_new"] == "bad_channel_mask"}
+    for item in stored_items:
+        if item["description_new"] == "chunk_metadata":
+            assert(masks[item["mask_id"]] == ([17] if item["chunk_idx"] >= 5 else []))
+
+
+# End of file test_preprocess_metadata.py
@@ -0,0 +1,56 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for the processor."""
+
+
+def test_consume_stop():
+    """Verify that consumers process all queued chunks before they exit on a stop item."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import itertools
+    import queue
+    import threading
+    from types import SimpleNamespace
+    from processor import consume, stop_consumers
+
+    class fake_tracker():
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.chunks = []
+
+        def add_chunk(self, chunk_idx, futures, stream_idx):
+            with self.lock:
+                self.chunks.append((chunk_idx, stream_idx))
+
+        def num_in_flight(self):
+            return 0
+
+    class fake_dispatcher():
+        def execute(self, msg):
+            return []
+
+    Q = queue.PriorityQueue()
+    seq = itertools.count()
+    tracker = fake_tracker()
+    num_consumers = 3
+    num_chunks = 10
+    for chunk_idx in range(num_chunks):
+        for stream_idx in range(2):
+            msg = SimpleNamespace(tb=SimpleNamespace(chunk_idx=chunk_idx))
+            Q.put_nowait((chunk_idx, next(seq), stream_idx, msg))
+    stop_consumers(Q, seq, num_consumers)
+
+    threads = [threading.Thread(target=consume, args=(Q, None, None, tracker,
+                                                      [fake_dispatcher(), fake_dispatcher()]))
+               for _ in range(num_consumers)]
+    for thr in threads:
+        thr.start()
+    Q.join()
+    for thr in threads:
+        thr.join(timeout=10.0)
+        assert(not thr.is_alive())
+    assert(sorted(tracker.chunks) == [(c, s) for c in range(num_chunks) for s in range(2)])
+
+
+# End of file test_processor.py
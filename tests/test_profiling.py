@@ -0,0 +1,57 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for profiling of analysis tasks."""
+
+
+def test_task_profiler(tmpdir):
+    """Verify that entries are written in bulk and summarized per rank and node."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from analysis.profiling import task_profiler, load_profile, summarize_profiles, find_profiles
+
+    profilers = [task_profiler(rank, basedir=str(tmpdir), capacity=4) for rank in range(2)]
+    for chunk_idx in range(5):
+        for rank, prof in enumerate(profilers):
+            # Rank 1 computes twice as many pairs per second as rank 0
+            prof.record("task_spectral", chunk_idx, rank, 100, 10.0 * chunk_idx,
+                        10.0 * chunk_idx + 2.0 / (rank + 1), 0.5, 1024 * 1024)
+    # The first 4 entries were written when the buffer was full.
+    assert(profilers[0].num_entries == 1)
+    assert(load_profile(profilers[0].filename).size == 4)
+    for prof in profilers:
+        prof.flush()
+
+    entries = load_profile(profilers[1].filename)
+    assert(entries.size == 5)
+    assert(np.all(entries["chunk_idx"] == np.arange(5)))
+    assert(np.all(entries["analysis_name"] == b"task_spectral"))
+
+    per_rank, per_node = summarize_profiles(find_profiles(str(tmpdir)))
+    hostname = os.uname()[1]
+    assert(np.isclose(per_rank[(hostname, 0)]["pairs_per_sec"], 50.0))
+    assert(np.isclose(per_rank[(hostname, 1)]["pairs_per_sec"], 100.0))
+    assert(np.isclose(per_rank[(hostname, 0)]["io_MB_per_sec"], 2.0))
+    assert(per_node[hostname]["num_tasks"] == 10)
+    assert(per_node[hostname]["num_pairs"] == 1000)
+
+
+def test_profiler_disabled(monkeypatch, tmpdir):
+    """Verify that the profiler writes no files unless DELTA_PROFILE_DIR is set."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from analysis import profiling
+
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.delenv("DELTA_PROFILE_DIR", raising=False)
+    monkeypatch.setattr(profiling, "_profiler", None)
+    prof = profiling.get_profiler()
+    assert(not prof.enabled)
+    prof.record("task_spectral", 0, 0, 100, 0.0, 1.0, 0.5, 1024)
+    prof.flush()
+    assert(profiling.find_profiles(str(tmpdir)) == [])
+
+
+# End of file test_profiling.py
@@ -0,0 +1,64 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for the data reduction in the middleman."""
+
+
+def test_reduction():
+    """Verify shape, data type and stream attributes of reduced data."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from preprocess.reduction import reduction
+    from data_models.helpers import data_model_generator
+
+    cfg_reduction = {"bandpass_fir": {"N": 5, "Wn": [0.02, 0.2], "btype": "bandpass",
+                                      "output": "sos"},
+                     "decimate": {"q": 4},
+                     "downcast": {"dtype": "float32"}}
+    my_reduction = reduction(cfg_reduction)
+    # Filter design doesn't modify the configuration
+    assert("N" in cfg_reduction["bandpass_fir"])
+
+    # 10 kHz signal with an offset, sampled at 500 kHz
+    chunk_size = 10_000
+    tt = np.arange(chunk_size) / 5e5
+    data = 2.0 + np.tile(np.sin(2.0 * np.pi * 1e4 * tt), (192, 1))
+    data[::2, :] += 0.1
+    reduced = my_reduction.process(data)
+
+    assert(reduced.shape == (192, chunk_size // 4))
+    assert(reduced.dtype == np.float32)
+    assert(reduced.flags.contiguous)
+    # The mean of each channel is kept, the in-band signal passes the filter
+    assert(np.allclose(reduced.mean(axis=-1), data.mean(axis=-1), atol=1e-2))
+    assert(np.abs(reduced[0, 500:2000] - 2.1).max() > 0.9)
+
+    stream_attrs = {"TriggerTime": [-0.1, 1.0, 60.0], "SampleRate": 5e5, "dev": "L"}
+    reduced_attrs = my_reduction.update_attrs(stream_attrs)
+    assert(stream_attrs["SampleRate"] == 5e5)
+    assert(reduced_attrs["SampleRate"] == 1.25e5)
+    assert(reduced_attrs["reduction"] == cfg_reduction)
+
+    # The processor constructs chunks with the reduced shape
+    cfg_diagnostic = {"name": "kstarecei",
+                      "datasource": {"chunk_size": chunk_size, "t_norm": [-0.099, -0.089]}}
+    chunk = data_model_generator(cfg_diagnostic).new_chunk(reduced, reduced_attrs, 3)
+    assert(chunk.num_v == 24)
+    assert(chunk.tb.samples_per_chunk == chunk_size // 4)
+
+    try:
+        reduction({"median": {}})
+        assert(False)
+    except NameError:
+        pass
+
+    # Analysis tasks need all channels of the ECEI array
+    try:
+        reduction({"channel_select": {"rows": [5, 12]}})
+        assert(False)
+    except ValueError:
+        pass
+
+
+# End of file test_reduction.py
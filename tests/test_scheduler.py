@@ -0,0 +1,184 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for adaptive batching of analysis tasks."""
+
+
+def test_adaptive_batcher():
+    """Verify that batches cover all pairs and shrink towards the end of a chunk."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from analysis.scheduler import adaptive_batcher
+
+    batcher = adaptive_batcher({"target_time": 0.1, "min_batch_size": 16}, 1024)
+    # Without a cost estimate, batches are at most initial_batch_size
+    batches = batcher.get_batches(18528, 4)
+    sizes = [size for _, size in batches]
+    assert(max(sizes) == 1024)
+    assert(sum(sizes) == 18528)
+    assert(all([offset == sum(sizes[:i]) for i, (offset, _) in enumerate(batches)]))
+    assert(all([s1 >= s2 for s1, s2 in zip(sizes[:-1], sizes[1:])]))
+    assert(sizes[-2] == 16)
+
+    # 1ms per pair: 100 pairs take target_time
+    batcher.update(100, 0.1)
+    assert(batcher.get_batch_size() == 100)
+    batcher.update(0, 1.0)
+    batcher.update(100, 0.6)
+    assert(abs(batcher.pair_cost - 0.002) < 1e-9)
+    assert(batcher.get_batch_size() == 50)
+    # Batch sizes are limited to max_batch_size and min_batch_size
+    batcher = adaptive_batcher({"target_time": 0.1, "min_batch_size": 16}, 1024)
+    batcher.update(1000, 1e-6)
+    assert(batcher.get_batch_size() == 1024)
+    batcher = adaptive_batcher({"target_time": 0.1, "min_batch_size": 16}, 1024)
+    batcher.update(1, 10.0)
+    assert(batcher.get_batch_size() == 16)
+
+
+def test_task_adaptive_batching(monkeypatch, tmp_path):
+    """Verify that a task with adaptive batching computes every pair once."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from types import SimpleNamespace
+    import numpy as np
+    from analysis.task_base import task_base
+    from analysis import profiling
+
+    # Write the kernel profile to tmp_path
+    monkeypatch.setenv("DELTA_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "_profiler", None)
+
+    def kernel_pair_idx(data, ch_it, params):
+        """Returns the channel indices of each pair."""
+        return np.array([[p.ch1.get_idx(), p.ch2.get_idx()] for p in ch_it], dtype=np.float64)
+
+    stored = []
+
+    class storage_list():
+        def __init__(self, cfg):
+            pass
+
+        def store_metadata(self, params):
+            pass
+
+        def store_data(self, result, info_dict):
+            stored.append((result, info_dict))
+
+    class task_pairs(task_base):
+        def _get_kernel(self):
+            return kernel_pair_idx
+
+    params = {"channel_chunk_size": 512, "ref_channels": [1, 1, 4, 8],
+              "cmp_channels": [1, 1, 4, 8],
+              "adaptive_batching": {"target_time": 0.01, "min_batch_size": 8,
+                                    "num_workers": 2}}
+    from unittest import mock
+    with mock.patch("analysis.task_base.get_storage_object", return_value=storage_list):
+        task = task_pairs(params, {"backend": "list"})
+
+    # Batches are split over the number of workers in the configuration
+    batch_sizes = [size for _, size in task.batcher.get_batches(len(task.pairs), 2)]
+    assert([len(ch_it) for ch_it, _, _, _ in task._get_batches(None)] == batch_sizes)
+
+    bad_channels = np.zeros(192, dtype=bool)
+    bad_channels[3] = True
+    timechunk = SimpleNamespace(tb=SimpleNamespace(chunk_idx=0), data=None, params=None,
+                                bad_channels=bad_channels)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = task.execute(timechunk, executor)
+        wait(futures)
+
+    assert(all([fut.exception() is None for fut in futures]))
+    assert(task.batcher.pair_cost is not None)
+    # The flat pair list is filtered once per bad channel mask
+    with mock.patch("analysis.task_base.filter_dispatch_sequence") as filter_mock:
+        task._get_batches(bad_channels)
+        filter_mock.assert_not_called()
+    # Stored rows in the order of the flat pair list, filtered pairs are NaN
+    stored.sort(key=lambda item: item[1]["pair_offset"])
+    result = np.concatenate([res for res, _ in stored])
+    expected = np.array([[p.ch1.get_idx(), p.ch2.get_idx()] for p in task.pairs], dtype=np.float64)
+    is_bad = (expected == 3).any(axis=1)
+    assert(np.array_equal(result[~is_bad], expected[~is_bad]))
+    assert(np.isnan(result[is_bad]).all())
+    assert(len(stored) > 1)
+    assert([info["num_pairs"] for _, info in stored] == [len(res) for res, _ in stored])
+    profiling.get_profiler().flush()
+    assert(len(profiling.load_profile(profiling.find_profiles(str(tmp_path))[0])) == len(stored))
+
+
+def test_skip_empty_batches():
+    """Verify that batches without good channel pairs are not dispatched."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from types import SimpleNamespace
+    from unittest import mock
+    import numpy as np
+    from analysis.task_spectral import task_crossphase, task_null
+
+    class storage_null():
+        def __init__(self, cfg):
+            pass
+
+        def store_metadata(self, params):
+            pass
+
+    params = {"channel_chunk_size": 8, "ref_channels": [1, 1, 1, 8],
+              "cmp_channels": [1, 1, 2, 8]}
+    with mock.patch("analysis.task_base.get_storage_object", return_value=storage_null):
+        task = task_crossphase(params, {"backend": "null"})
+        null_task = task_null(params, {"backend": "null"})
+    # task_null doesn't modify the parameters of the caller
+    assert("skip_bad_channels" not in params)
+    assert(not null_task.skip_bad_channels)
+
+    # The first batches only have pairs of channels in row 1
+    bad_channels = np.zeros(192, dtype=bool)
+    bad_channels[:8] = True
+    timechunk = SimpleNamespace(tb=SimpleNamespace(chunk_idx=0), bad_channels=bad_channels)
+    work_items = task.get_work_items(timechunk, None)
+    num_empty = sum([all([p.ch1.get_idx() < 8 or p.ch2.get_idx() < 8 for p in ch_it])
+                     for ch_it in task.dispatch_seq])
+    assert(num_empty > 0)
+    assert(len(work_items) == len(task.dispatch_seq) - num_empty)
+    assert(all([len(ch_it) > 0 for _, _, _, ch_it, _, _ in work_items]))
+    assert(len(null_task.get_work_items(timechunk, None)) == len(task.dispatch_seq))
+
+
+def test_store_pair_offset(tmp_path):
+    """Verify that the storage backends persist pair_offset and num_pairs of a batch."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from unittest import mock
+    import numpy as np
+    from storage.backend_numpy import backend_numpy
+    from storage.backend_mongodb import backend_mongodb
+
+    data = np.ones((100, 4))
+    info_dict = {"analysis_name": "task_pairs", "chunk_idx": 3, "channel_batch": 2,
+                 "num_pairs": np.int64(100), "pair_offset": np.int64(412)}
+
+    backend_numpy({"basedir": str(tmp_path)}).store_data(data, info_dict)
+    with np.load(tmp_path / "task_pairs_chunk00003_batch02.npz") as df:
+        assert(df["pair_offset"] == 412)
+        assert(df["num_pairs"] == 100)
+
+    coll = mock.MagicMock()
+    with mock.patch("storage.backend_mongodb.mongo_connection") as conn:
+        conn.return_value.__enter__.return_value = (mock.MagicMock(), coll)
+        backend = backend_mongodb({"datastore": "numpy", "datadir": str(tmp_path),
+                                   "run_id": "run"})
+        backend.store_data(data, dict(info_dict))
+    doc = coll.insert_one.call_args[0][0]
+    assert(doc["pair_offset"] == 412 and type(doc["pair_offset"]) is int)
+    assert(doc["num_pairs"] == 100 and type(doc["num_pairs"]) is int)
+    with np.load(doc["unique_filename"]) as df:
+        assert(df["pair_offset"] == 412)
+
+
+# End of file test_scheduler.py
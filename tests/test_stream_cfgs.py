@@ -0,0 +1,62 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for processing multiple streams in a single processor."""
+
+
+def test_gen_stream_cfgs(config_all):
+    """Verify that each channel range is configured as a separate stream."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import copy
+    from data_models.helpers import gen_stream_cfgs, gen_channel_name, gen_var_name
+
+    cfg = copy.deepcopy(config_all)
+    cfg["diagnostic"]["dev"] = "L"
+
+    # A single stream uses the configuration as-is
+    stream_cfgs = gen_stream_cfgs(cfg)
+    assert(len(stream_cfgs) == 1)
+    assert(stream_cfgs[0] is cfg)
+    assert("stream" not in cfg["analysis"]["crosspower"])
+
+    cfg["diagnostic"]["datasource"]["channel_range"] = ["L0101-1208", "L1301-2408"]
+    stream_cfgs = gen_stream_cfgs(cfg)
+    assert(len(stream_cfgs) == 2)
+    stream_names = [gen_channel_name(stream_cfg["diagnostic"]) for stream_cfg in stream_cfgs]
+    assert(stream_names == ["KSTAR_18431_ECEI_L_L0101-1208", "KSTAR_18431_ECEI_L_L1301-2408"])
+    assert([gen_var_name(stream_cfg)[0] for stream_cfg in stream_cfgs] ==
+           ["L0101-1208", "L1301-2408"])
+    for stream_cfg, stream_name in zip(stream_cfgs, stream_names):
+        for anl_params in stream_cfg["analysis"].values():
+            assert(anl_params["stream"] == stream_name)
+    # The original configuration is unchanged
+    assert(len(cfg["diagnostic"]["datasource"]["channel_range"]) == 2)
+    assert("stream" not in cfg["analysis"]["crosspower"])
+
+    # Middleman configurations have no analysis section
+    del cfg["analysis"]
+    stream_cfgs = gen_stream_cfgs(cfg)
+    assert([gen_channel_name(stream_cfg["diagnostic"]) for stream_cfg in stream_cfgs] ==
+           stream_names)
+    assert(all(["analysis" not in stream_cfg for stream_cfg in stream_cfgs]))
+
+
+def test_store_stream_numpy(tmp_path):
+    """Verify that results of different streams are stored in separate files."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from storage.backend_numpy import backend_numpy
+
+    backend = backend_numpy({"basedir": str(tmp_path)})
+    info_dict = {"analysis_name": "crosspower", "chunk_idx": 3, "channel_batch": 0}
+    backend.store_data(np.zeros(4), info_dict)
+    backend.store_data(np.ones(4), {**info_dict, "stream": "KSTAR_18431_ECEI_L_L0101-1208"})
+
+    assert(os.path.isfile(tmp_path / "crosspower_chunk00003_batch00.npz"))
+    assert(os.path.isfile(tmp_path / "KSTAR_18431_ECEI_L_L0101-1208_crosspower_chunk00003_batch00.npz"))
+
+
+# End of file test_stream_cfgs.py
@@ -0,0 +1,40 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for pacing of streaming steps."""
+
+
+def test_step_pacer():
+    """Verify that the pacer subtracts time spent in a step from the sleep."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import time
+    import numpy as np
+    from streaming.pacing import step_pacer
+    from streaming.stream_stats import stream_stats
+
+    stats = stream_stats()
+    # 10 chunks with 1,000 samples each at 500 kHz
+    pacer = step_pacer.from_realtime(1000, 5e5, stats, speedup=0.2)
+    assert(np.isclose(pacer.step_interval, 0.01))
+
+    tic = time.perf_counter()
+    for _ in range(10):
+        pacer.wait()
+        # Emulate a Put that takes most of the step interval
+        time.sleep(0.007)
+    toc = time.perf_counter()
+
+    # With a fixed sleep, 10 steps would take 0.17s.
+    assert(toc - tic < 0.15)
+    target_rate, rate, jitter, max_lag = stats.get_pacing_stats()
+    assert(np.isclose(target_rate, 100.0))
+    assert(abs(rate - target_rate) < 20.0)
+    assert(jitter < 0.01)
+    assert(max_lag >= 0.0)
+
+    pacer = step_pacer.from_bandwidth(1024 * 1024, 100.0)
+    assert(np.isclose(pacer.step_interval, 0.01))
+
+
+# End of file test_stream_pacing.py
@@ -0,0 +1,94 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for transfer statistics."""
+
+
+def test_ring_buffer_histogram():
+    """Verify that ring buffers keep the latest values and histograms give percentiles."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from streaming.stream_stats import ring_buffer, log_histogram
+
+    buf = ring_buffer(capacity=4)
+    for value in range(10):
+        buf.append(value)
+    assert(len(buf) == 4)
+    assert(np.all(buf.values() == [6, 7, 8, 9]))
+
+    hist = log_histogram(1e-6, 1e4, bins_per_decade=100)
+    assert(hist.percentile(50) is None)
+    values = np.random.default_rng(0).uniform(1e-3, 2e-3, 10_000)
+    for value in values:
+        hist.record(value)
+    for q in [50, 95, 99]:
+        # Precision is about 2.3% for 100 bins per decade
+        assert(abs(hist.percentile(q) / np.percentile(values, q) - 1.0) < 0.025)
+
+
+def test_stream_stats_export(tmp_path):
+    """Verify that statistics are exported to JSON lines and prometheus text format."""
+    import sys
+    import os
+    import json
+    sys.path.append(os.path.abspath('delta'))
+    from streaming.stream_stats import stream_stats
+
+    fname = str(tmp_path / "stats_{name}_{rank}.jsonl")
+    stats = stream_stats({"export": "jsonl", "filename": fname, "interval": 0.0, "capacity": 8},
+                         "test_stream", 3)
+    for step in range(20):
+        stats.add_beginstep(1e-3)
+        stats.add_transfer(1024, 2e-3)
+        stats.add_endstep(1e-4)
+    stats.close()
+
+    assert(stats.nsteps == 20)
+    assert(stats.get_transfer_stats()[0] == 20 * 1024)
+    assert(len(stats.metrics["transfer"].recent) == 8)
+
+    with open(str(tmp_path / "stats_test_stream_3.jsonl")) as df:
+        lines = [json.loads(line) for line in df]
+    assert(len(lines) > 1)
+    assert(lines[-1]["nsteps"] == 20)
+    assert(lines[-1]["transfer"]["count"] == 20)
+    assert(abs(lines[-1]["transfer"]["p99"] / 2e-3 - 1.0) < 0.025)
+
+    prom_str = stats.to_prometheus()
+    assert('delta_transfer_seconds_count{stream="test_stream",rank="3"} 20' in prom_str)
+    assert('delta_bytes_sum{stream="test_stream",rank="3"} 20480' in prom_str)
+
+
+def test_stream_stats_prometheus_shared_port():
+    """Verify that stream_stats of one process share the prometheus endpoint of a port."""
+    import sys
+    import os
+    import socket
+    import urllib.request
+    sys.path.append(os.path.abspath('delta'))
+    from streaming import stream_stats as stats_module
+    from streaming.stream_stats import stream_stats
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    cfg = {"export": "prometheus", "port": port}
+    stats_list = [stream_stats(cfg, f"ch{i}", 0) for i in range(2)]
+    for i, stats in enumerate(stats_list):
+        stats.add_transfer(1024 * (i + 1), 1e-3)
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+        prom_str = resp.read().decode("utf-8")
+    assert(prom_str.count("# TYPE delta_bytes summary") == 1)
+    assert('delta_bytes_sum{stream="ch0",rank="0"} 1024' in prom_str)
+    assert('delta_bytes_sum{stream="ch1",rank="0"} 2048' in prom_str)
+
+    stats_list[0].close()
+    assert(port in stats_module._http_servers)
+    stats_list[1].close()
+    assert(port not in stats_module._http_servers)
+
+
+# End of file test_stream_stats.py
@@ -0,0 +1,78 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for per-chunk tracing."""
+
+
+def test_tracer(tmpdir):
+    """Verify that spans are written as Chrome trace events and can be merged."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import time
+    from streaming.tracing import tracer, load_trace, chunk_latencies
+
+    # A disabled tracer doesn't record spans
+    tr = tracer(None, "test")
+    with tr.span("load", 0):
+        pass
+    assert(len(tr.events) == 0)
+
+    tr_gen = tracer({"enabled": True, "dir": str(tmpdir)}, "generator")
+    tr_proc = tracer({"enabled": True, "dir": str(tmpdir), "flush_interval": 0.0}, "processor")
+    t0 = time.time()
+    for chunk_idx in range(3):
+        with tr_gen.span("send", chunk_idx):
+            time.sleep(0.001)
+        tr_proc.add_span("transport", chunk_idx, t0 + chunk_idx, t0 + chunk_idx + 0.5)
+        with tr_proc.span("preprocess", chunk_idx, stage="bandpass"):
+            pass
+    # Spans of the processor are flushed on each span. Spans of the generator are buffered.
+    assert(len(tr_proc.events) == 0)
+    assert(len(tr_gen.events) == 4)
+    tr_gen.flush()
+
+    events = load_trace(tr_gen.filename) + load_trace(tr_proc.filename)
+    spans = [event for event in events if event["ph"] == "X"]
+    assert(len(spans) == 9)
+    assert(set([event["args"]["name"] for event in events if event["ph"] == "M"]) ==
+           set([f"generator@{os.uname()[1]}", f"processor@{os.uname()[1]}"]))
+    for event in spans:
+        assert(event["dur"] >= 0.0)
+        assert(set(event.keys()) >= set(["name", "cat", "ts", "pid", "tid", "args"]))
+
+    latencies = chunk_latencies(events)
+    assert(sorted(latencies.keys()) == [0, 1, 2])
+    # The preprocess span of chunk 2 starts before its transport span ends.
+    assert(latencies[2][1] == "transport")
+    assert(latencies[2][0] >= 0.5)
+
+
+def test_reader_get_trace():
+    """Verify that the ADIOS2 reader returns no trace context if the writer doesn't send one."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    from unittest import mock
+    from streaming.reader_mpi import reader_gen
+
+    class null_variable():
+        """Like the Variable returned by IO.InquireVariable for unknown names."""
+        def __bool__(self):
+            return False
+
+    # Skip the constructor, which opens an ADIOS2 IO
+    reader = reader_gen.__new__(reader_gen)
+    reader.IO = mock.MagicMock()
+    reader.reader = mock.MagicMock()
+    reader.IO.InquireVariable.return_value = null_variable()
+    assert(reader.get_trace() is None)
+    reader.reader.Get.assert_not_called()
+
+    def get_trace_ctx(var, trace_ctx, mode):
+        trace_ctx[:] = [7, 1.5]
+    reader.IO.InquireVariable.return_value = mock.MagicMock()
+    reader.reader.Get.side_effect = get_trace_ctx
+    assert(reader.get_trace() == (7, 1.5))
+
+
+# End of file test_tracing.py
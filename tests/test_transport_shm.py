@@ -0,0 +1,112 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for the shared-memory transport."""
+
+
+def write_steps(stream_name, num_steps):
+    """Writes num_steps steps of two variables. Executed in a separate process."""
+    import numpy as np
+    from types import SimpleNamespace
+    from streaming.helpers import get_writer
+
+    writer = get_writer({"engine": "shm", "num_slots": 2}, stream_name)
+    writer.DefineVariable("L0101-2408", (192, 100), np.float64)
+    writer.DefineVariable("G0101-2408", (192, 100), np.float64)
+    writer.DefineTraceVariable()
+    writer.Open()
+    writer.DefineAttributes("stream_attrs", {"SampleRate": 5e5})
+
+    data = np.zeros((192, 100))
+    for step in range(num_steps):
+        writer.BeginStep()
+        data[:] = step
+        writer.put_data(SimpleNamespace(data=data), "L0101-2408")
+        writer.put_data(SimpleNamespace(data=-data), "G0101-2408")
+        writer.put_trace(step + 10)
+        writer.EndStep()
+    writer.Close()
+
+
+def test_transport_shm():
+    """Verify that steps written by another process are received in order."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import multiprocessing
+    import numpy as np
+    from streaming.helpers import get_reader
+
+    stream_name = f"test_shm_{os.getpid()}"
+    num_steps = 20
+    proc = multiprocessing.get_context("fork").Process(target=write_steps,
+                                                       args=(stream_name, num_steps))
+    proc.start()
+
+    reader = get_reader({"engine": "shm", "open_timeout": 10.0}, stream_name)
+    reader.Open()
+    steps = []
+    while reader.BeginStep(timeoutSeconds=10.0):
+        if reader.InquireAttribute("stream_attrs"):
+            assert(reader.get_attrs("stream_attrs") == {"SampleRate": 5e5})
+        data_L = reader.Get("L0101-2408", copy=False)
+        data_G = reader.Get("G0101-2408")
+        # Views on the shared memory don't own their data
+        assert(not data_L.flags.owndata)
+        assert(np.all(data_L == reader.CurrentStep()))
+        assert(np.all(data_G == -reader.CurrentStep()))
+        chunk_idx, t_send = reader.get_trace()
+        assert(chunk_idx == reader.CurrentStep() + 10)
+        steps.append(reader.CurrentStep())
+        del data_L
+        reader.EndStep()
+    reader.Close()
+    proc.join(timeout=10.0)
+
+    assert(proc.exitcode == 0)
+    assert(steps == list(range(num_steps)))
+    assert(reader.stats.metrics["begin_step"].count == num_steps + 1)
+
+
+def test_transport_shm_timeout():
+    """Verify that the reader times out while the writer is open but idle."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    import pytest
+    from streaming.transport_shm import writer_shm, reader_shm
+
+    stream_name = f"test_shm_timeout_{os.getpid()}"
+    with pytest.raises(TimeoutError):
+        reader_shm({"open_timeout": 0.01}, stream_name).Open()
+
+    writer = writer_shm({"close_timeout": 0.01}, stream_name)
+    with pytest.raises(ValueError):
+        writer.DefineVariable("L0101-1208", (96, 10), np.float64, start=(96, 0), count=(96, 10))
+    writer.DefineVariable("L0101-1208", (96, 10), np.float64)
+    writer.Open()
+    reader = reader_shm({}, stream_name)
+    reader.Open()
+    assert(not reader.BeginStep(timeoutSeconds=0.01))
+    writer.Close()
+    assert(not reader.BeginStep(timeoutSeconds=1.0))
+    reader.Close()
+
+
+def test_transport_shm_machine(monkeypatch):
+    """Verify that the transport refuses to run on machines without ordered stores."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import platform
+    import pytest
+    from streaming.transport_shm import writer_shm, reader_shm
+
+    monkeypatch.setattr(platform, "machine", lambda: "aarch64")
+    with pytest.raises(RuntimeError):
+        writer_shm({}, "test_shm_machine")
+    with pytest.raises(RuntimeError):
+        reader_shm({}, "test_shm_machine")
+
+
+# End of file test_transport_shm.py
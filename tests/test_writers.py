@@ -0,0 +1,113 @@
+# -*- Encoding: UTF-8 -*-
+
+"""Unit tests for writers, using a dummy ADIOS2 engine."""
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+class engine_dummy():
+    """Records the data of deferred Puts when EndStep is called."""
+
+    def __init__(self):
+        self.puts = []
+        self.steps = []
+
+    def BeginStep(self):
+        self.puts = []
+
+    def Put(self, variable, data, mode):
+        self.puts.append(data)
+
+    def EndStep(self):
+        self.steps.append([data.copy() for data in self.puts])
+
+    def Close(self):
+        pass
+
+
+def test_writer_async():
+    """Verify that steps are written in order and producers can re-use their arrays."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from types import SimpleNamespace
+    import streaming.writers
+    from streaming.writers import writer_base
+
+    engine = engine_dummy()
+    adios2_dummy = mock.MagicMock()
+    adios2_dummy.ADIOS.return_value.DeclareIO.return_value.Open.return_value = engine
+
+    with mock.patch.object(streaming.writers, "adios2", new=adios2_dummy):
+        writer = writer_base({"num_buffers": 2}, "test_stream")
+        assert(writer.is_async)
+        writer.DefineVariable("L0101-2408", (192, 100), np.float64)
+        writer.DefineTraceVariable()
+        writer.Open()
+
+        data = np.zeros((192, 100))
+        for step in range(10):
+            data[:] = step
+            writer.BeginStep()
+            writer.put_data(SimpleNamespace(data=data))
+            writer.put_trace(step + 100)
+            writer.EndStep()
+        writer.Close()
+
+    assert(len(engine.steps) == 10)
+    for step, puts in enumerate(engine.steps):
+        # The trace context [chunk_idx, t_send] is written together with the data.
+        assert(len(puts) == 2)
+        assert(puts[0][0] == step + 100)
+        assert(np.all(puts[1] == step))
+    assert(writer.stats.metrics["end_step"].count == 10)
+    assert(writer.stats.nsteps == 10)
+
+
+def test_writer_operators_downcast():
+    """Verify that operators are attached to variables and downcasting is opt-in."""
+    import sys
+    import os
+    sys.path.append(os.path.abspath('delta'))
+    import numpy as np
+    from types import SimpleNamespace
+    import streaming.writers
+    from streaming.writers import writer_base
+
+    engine = engine_dummy()
+    adios2_dummy = mock.MagicMock()
+    adios2_dummy.ADIOS.return_value.DeclareIO.return_value.Open.return_value = engine
+    variable = adios2_dummy.ADIOS.return_value.DeclareIO.return_value.DefineVariable.return_value
+
+    cfg = {"operators": [{"type": "zfp", "params": {"accuracy": 1e-4}}], "downcast": "float32"}
+    with mock.patch.object(streaming.writers, "adios2", new=adios2_dummy):
+        writer = writer_base(cfg, "test_stream")
+        writer.DefineVariable("L0101-2408", (192, 100), np.float64)
+        writer.Open()
+        for step in range(3):
+            writer.BeginStep()
+            writer.put_data(SimpleNamespace(data=np.full((192, 100), step, dtype=np.float64)))
+            writer.EndStep()
+
+    variable.AddOperation.assert_called_once()
+    assert(variable.AddOperation.call_args[0][1] == {"accuracy": "0.0001"})
+    assert(writer.dtype == np.float32)
+    for step, puts in enumerate(engine.steps):
+        assert(puts[0].dtype == np.float32)
+        assert(np.all(puts[0] == step))
+    raw_bytes, _ = writer.stats.get_conversion_stats()
+    assert(raw_bytes == 3 * 192 * 100 * 8)
+    assert(writer.stats.get_transfer_stats()[0] == 3 * 192 * 100 * 4)
+
+    # Without downcast, float64 data is written as-is.
+    with mock.patch.object(streaming.writers, "adios2", new=adios2_dummy):
+        writer = writer_base({}, "test_stream")
+        writer.DefineVariable("L0101-2408", (192, 100), np.float64)
+    assert(writer.dtype == np.float64)
+
+
+# End of file test_writer_async.py